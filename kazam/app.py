@@ -28,7 +28,7 @@ import gettext
 import logging
 
 from subprocess import Popen
-from gi.repository import Gtk, Gdk, GObject
+from gi.repository import Gtk, Gdk, GObject, GLib
 from gettext import gettext as _
 
 from kazam.utils import *
@@ -37,6 +37,10 @@ from kazam.backend.grabber import Grabber
 from kazam.frontend.main_menu import MainMenu
 from kazam.frontend.window_area import AreaWindow
 from kazam.backend.gstreamer import Screencast
+from kazam.backend.jobs import JobQueue, make_job, JOB_FINALIZE, JOB_TRANSCODE, JOB_SPLIT, JOB_MOVE, JOB_THUMBNAIL
+from kazam.backend.recovery import OrphanRecovery
+from kazam.backend.calibrate import Calibration
+from kazam.backend.timing import remove_sidecar
 from kazam.frontend.preferences import Preferences
 from kazam.frontend.about_dialog import AboutDialog
 from kazam.frontend.indicator import KazamIndicator
@@ -102,6 +106,8 @@ class KazamApp(GObject.GObject):
         self.main_y = 0
         self.countdown = None
         self.tempfile = ""
+        self.tempfile_codec = None
+        self.pending = []
         self.recorder = None
         self.area_window = None
         self.select_window = None
@@ -131,6 +137,7 @@ class KazamApp(GObject.GObject):
         self.indicator.connect("indicator-pause-request", self.cb_pause_request)
         self.indicator.connect("indicator-unpause-request", self.cb_unpause_request)
         self.indicator.connect("indicator-about-request", self.cb_about_request)
+        self.indicator.connect("indicator-replay-request", self.cb_replay_request)
 
         self.mainmenu.connect("file-quit", self.cb_quit_request)
         self.mainmenu.connect("file-preferences", self.cb_preferences_request)
@@ -289,6 +296,32 @@ class KazamApp(GObject.GObject):
         HW.get_current_screen(self.window)
         self.startup = False
 
+        #
+        # Post-processing jobs left over from the last session resume right
+        # away. Then look for recordings a crashed instance left behind,
+        # skipping whatever those jobs are still working on.
+        #
+        self.job_queue = JobQueue()
+        self.job_queue.connect("jobs-progress", self.cb_jobs_progress)
+        self.job_queue.connect("chain-done", self.cb_chain_done)
+        self.job_queue.start()
+
+        self.recovery = OrphanRecovery()
+        self.recovery.connect("orphan-recovered", self.cb_orphan_recovered)
+        GLib.idle_add(self.recovery.scan, prefs.video_dest, self.job_queue.get_files())
+
+        #
+        # On first run we find out what this machine can record with,
+        # instead of just taking the best codec that is installed. A codec
+        # the user already picked, in an older kazam.conf, is left alone.
+        #
+        self.calibration = None
+        if prefs.first_run and HW.screens and not prefs.config.is_set("main", "codec"):
+            screen = HW.screens[HW.get_current_screen()]
+            self.calibration = Calibration(screen["width"], screen["height"], prefs.framerate)
+            self.calibration.connect("calibration-done", self.cb_calibration_done)
+            GLib.idle_add(self.cb_calibration_start)
+
     #
     # Callbacks, go down here ...
     #
@@ -506,13 +539,19 @@ class KazamApp(GObject.GObject):
         self.gdk_win.set_cursor(self.default_cursor)
         (prefs.main_x, prefs.main_y) = self.window.get_position()
         try:
-            os.remove(self.recorder.tempfile)
+            if self.recorder.tempfile not in self.job_queue.get_files():
+                os.remove(self.recorder.tempfile)
             os.remove("{0}.mux".format(self.recorder.tempfile))
         except OSError:
             logger.info("Unable to delete one of the temporary files. Check your temporary directory.")
-        except AttributeError:
+        except (AttributeError, TypeError):
             pass
 
+        if self.recorder:
+            self.recorder.teardown()
+
+        self.job_queue.shutdown()
+
         prefs.save_config()
 
         if prefs.sound:
@@ -582,6 +621,9 @@ class KazamApp(GObject.GObject):
             logger.debug("Cancel countdown request.")
             self.countdown.cancel_countdown()
             self.countdown = None
+            if self.main_mode == MODE_SCREENCAST:
+                self.recorder.cancel_recording()
+                self.job_queue.resume()
             self.indicator.menuitem_finish.set_label(_("Finish recording"))
             self.window.set_sensitive(True)
             self.window.show()
@@ -592,33 +634,24 @@ class KazamApp(GObject.GObject):
             logger.debug("Stop request.")
             self.recorder.stop_recording()
             self.tempfile = self.recorder.get_tempfile()
+            self.tempfile_codec = self.recorder.get_codec()
             logger.debug("Recorded tmp file: {0}".format(self.tempfile))
             logger.debug("Waiting for data to flush.")
 
     def cb_flush_done(self, widget):
-        if self.main_mode == MODE_SCREENCAST and prefs.autosave_video:
-            logger.debug("Autosaving enabled.")
-            fname = get_next_filename(prefs.autosave_video_dir,
-                                      prefs.autosave_video_file,
-                                      CODEC_LIST[prefs.codec][3])
-
-            shutil.move(self.tempfile, fname)
-
-            self.window.set_sensitive(True)
-            self.window.show()
-            self.window.present()
-        elif self.main_mode == MODE_SCREENCAST:
-            self.done_recording = DoneRecording(self.icons,
-                                            self.tempfile,
-                                            prefs.codec,
-                                            self.old_vid_path)
-            logger.debug("Done Recording initialized.")
-            self.done_recording.connect("save-done", self.cb_save_done)
-            self.done_recording.connect("save-cancel", self.cb_save_cancel)
-            self.done_recording.connect("edit-request", self.cb_edit_request)
-            logger.debug("Done recording signals connected.")
-            self.done_recording.show_all()
-            self.window.set_sensitive(False)
+        if self.main_mode == MODE_SCREENCAST:
+            self.job_queue.resume()
+            jobs = self.get_jobs()
+            if jobs:
+                source = self.recorder.get_segment_glob() or self.tempfile
+                self.job_queue.submit(source, jobs, self.tempfile_codec, not prefs.autosave_video)
+                self.window.set_sensitive(True)
+                self.window.show()
+                self.window.present()
+            else:
+                self.pending.append((self.tempfile, self.tempfile_codec))
+            self.add_outputs(self.recorder.get_outputs())
+            self.offer_pending()
 
         elif self.main_mode == MODE_SCREENSHOT:
             if self.outline_window:
@@ -642,6 +675,108 @@ class KazamApp(GObject.GObject):
             else:
                 self.grabber.save_capture(self.old_pic_path)
 
+    def show_done_recording(self):
+        self.done_recording = DoneRecording(self.icons,
+                                        self.tempfile,
+                                        self.tempfile_codec,
+                                        self.old_vid_path)
+        logger.debug("Done Recording initialized.")
+        self.done_recording.connect("save-done", self.cb_save_done)
+        self.done_recording.connect("save-cancel", self.cb_save_cancel)
+        self.done_recording.connect("edit-request", self.cb_edit_request)
+        logger.debug("Done recording signals connected.")
+        self.done_recording.show_all()
+        self.window.set_sensitive(False)
+
+    def get_jobs(self):
+        #
+        # Segments are joined, intermediates from two-stage recording are
+        # transcoded, autosaved recordings are moved and get a thumbnail.
+        # All of that happens in the background, in the job queue.
+        #
+        jobs = []
+        if self.recorder.get_segment_glob():
+            jobs.append(make_job(JOB_FINALIZE, output=self.tempfile, muxer=self.recorder.get_muxer()))
+        if self.tempfile_codec != prefs.codec and prefs.transcode_chunk_seconds > 0:
+            jobs.append(make_job(JOB_SPLIT, codec=prefs.codec, chunk_seconds=prefs.transcode_chunk_seconds))
+        elif self.tempfile_codec != prefs.codec:
+            jobs.append(make_job(JOB_TRANSCODE, codec=prefs.codec))
+        return jobs + self.get_autosave_jobs(prefs.codec)
+
+    def get_autosave_jobs(self, codec):
+        if not prefs.autosave_video:
+            return []
+        logger.debug("Autosaving enabled.")
+        return [make_job(JOB_MOVE,
+                         dir=prefs.autosave_video_dir,
+                         name=prefs.autosave_video_file,
+                         ext=CODEC_LIST[codec][3]),
+                make_job(JOB_THUMBNAIL)]
+
+    def add_outputs(self, outputs):
+        #
+        # Extra outputs are already in their final codec,
+        # they are autosaved or offered after the main recording.
+        #
+        for (fname, codec) in outputs:
+            jobs = self.get_autosave_jobs(codec)
+            if jobs:
+                self.job_queue.submit(fname, jobs, codec, False)
+            else:
+                self.pending.append((fname, codec))
+
+    def cb_replay_request(self, widget):
+        if self.recording and self.recorder is not None:
+            logger.debug("Replay requested.")
+            self.recorder.save_replay()
+
+    def cb_replay_saved(self, recorder, fname):
+        #
+        # Replays are saved while the capture goes on, autosaved ones wait
+        # in the job queue, the rest are offered once recording is over.
+        #
+        logger.debug("Replay saved: {0}".format(fname))
+        jobs = self.get_autosave_jobs(prefs.codec)
+        if jobs:
+            self.job_queue.submit(fname, jobs, prefs.codec, False)
+        else:
+            self.pending.append((fname, prefs.codec))
+            self.offer_pending()
+
+    def cb_jobs_progress(self, job_queue, jobs, progress):
+        self.indicator.set_progress(jobs, progress)
+
+    def cb_chain_done(self, job_queue, fname, codec, offer):
+        if offer:
+            self.pending.append((fname, codec))
+            self.offer_pending()
+
+    def cb_calibration_start(self):
+        if self.calibration is not None and not self.recording and not self.in_countdown:
+            self.calibration.start(detect_codecs())
+        return False
+
+    def cb_calibration_done(self, calibration, success):
+        self.calibration = None
+
+    def cb_orphan_recovered(self, recovery, fname, codec):
+        logger.debug("Recovered recording: {0}".format(fname))
+        self.pending.append((fname, codec))
+        self.offer_pending()
+
+    def offer_pending(self):
+        #
+        # Recordings are offered one at a time,
+        # whenever we are not busy recording or saving something else.
+        #
+        if not self.pending or self.recording or self.in_countdown or not self.window.get_sensitive():
+            return
+        (self.tempfile, self.tempfile_codec) = self.pending.pop(0)
+        self.show_done_recording()
+
+    def cb_stats_updated(self, stats, snapshot):
+        self.indicator.set_stats(snapshot)
+
     def cb_pause_request(self, widget):
         logger.debug("Pause requested.")
         self.recording_paused = True
@@ -663,11 +798,13 @@ class KazamApp(GObject.GObject):
         self.window.show_all()
         self.window.present()
         self.window.move(prefs.main_x, prefs.main_y)
+        self.offer_pending()
 
     def cb_save_cancel(self, widget):
         try:
             logger.debug("Save canceled, removing {0}".format(self.tempfile))
             os.remove(self.tempfile)
+            remove_sidecar(self.tempfile)
         except OSError:
             logger.info("Failed to remove tempfile {0}".format(self.tempfile))
         except AttributeError:
@@ -678,6 +815,7 @@ class KazamApp(GObject.GObject):
         self.window.show_all()
         self.window.present()
         self.window.move(prefs.main_x, prefs.main_y)
+        self.offer_pending()
 
     def cb_help_about(self, widget):
         AboutDialog(self.icons)
@@ -690,7 +828,7 @@ class KazamApp(GObject.GObject):
         #
         fname = get_next_filename(prefs.video_dest,
                                   prefs.autosave_video_file,
-                                  CODEC_LIST[prefs.codec][3])
+                                  CODEC_LIST[self.tempfile_codec][3])
 
         shutil.move(self.tempfile, fname)
         arg_list.append(fname)
@@ -701,6 +839,7 @@ class KazamApp(GObject.GObject):
             logger.warning("Failed to open selected editor.")
         self.window.set_sensitive(True)
         self.window.show_all()
+        self.offer_pending()
 
     def cb_check_cursor(self, widget):
         prefs.capture_cursor = widget.get_active()
@@ -731,6 +870,13 @@ class KazamApp(GObject.GObject):
     #
 
     def run_counter(self):
+        #
+        # Calibrating next to a recording would measure nothing useful and
+        # could change the codec under it.
+        #
+        if self.calibration is not None:
+            self.calibration.cancel()
+
         #
         # Annoyances with the menus
         #
@@ -785,14 +931,30 @@ class KazamApp(GObject.GObject):
             video_source = HW.screens[screen]
 
         if self.main_mode == MODE_SCREENCAST:
-            self.recorder = Screencast()
+            #
+            # Background jobs are put on hold until the capture is over.
+            #
+            self.job_queue.suspend()
+
+            #
+            # One recorder for the whole session, its pipeline is kept in READY
+            # between takes and only the parts that changed get rebuilt.
+            #
+            if self.recorder is None:
+                self.recorder = Screencast()
+                self.recorder.connect("flush-done", self.cb_flush_done)
+                self.recorder.connect("replay-saved", self.cb_replay_saved)
+                self.recorder.stats.connect("stats-updated", self.cb_stats_updated)
+
             self.recorder.setup_sources(video_source,
                                         audio_source,
                                         audio2_source,
                                         prefs.area if self.record_mode == MODE_AREA else None,
-                                        prefs.xid if self.record_mode == MODE_WIN else None)
+                                        prefs.xid if self.record_mode == MODE_WIN else None,
+                                        HW.screens if self.record_mode == MODE_ALL and prefs.split_screens else None)
 
-            self.recorder.connect("flush-done", self.cb_flush_done)
+            if prefs.warm_start:
+                self.recorder.preroll_recording()
 
         elif self.main_mode == MODE_SCREENSHOT:
             self.grabber = Grabber()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+#       adaptive.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import time
+import logging
+import threading
+logger = logging.getLogger("Adaptive")
+
+from gi.repository import GLib, Gst
+
+# Poll interval in milliseconds
+ADAPT_INTERVAL = 1000
+
+#
+# Encoder latency (seconds, on top of the lowest we have seen, encoders
+# with lookahead always hold a few frames) or input queue fill (fraction of
+# its time limit) above which we step down, and below which we may step
+# back up. Stepping up waits for a few calm polls in a row, so we don't flap.
+#
+ADAPT_HIGH_LATENCY = 0.5
+ADAPT_LOW_LATENCY = 0.1
+ADAPT_HIGH_FILL = 0.5
+ADAPT_LOW_FILL = 0.1
+ADAPT_CALM_POLLS = 5
+
+#
+# CPU usage against the CPU limit, when there is one. Above 1.0 we step
+# down, stepping up needs some room so we don't climb right back over.
+#
+ADAPT_HIGH_CPU = 1.0
+ADAPT_LOW_CPU = 0.8
+
+#
+# Steps from the profile settings down to the cheapest we are willing to go.
+# Each step lists the properties that change, everything not mentioned
+# keeps the value of the step above it.
+#
+ADAPT_LADDERS = {
+    "vp8enc": [{"cpu-used": 4},
+               {"cpu-used": 8, "deadline": 1},
+               {"cpu-used": 12, "deadline": 1},
+               {"cpu-used": 16, "deadline": 1}],
+    "x264enc": [{"speed-preset": "superfast", "quantizer": 18},
+                {"speed-preset": "ultrafast", "quantizer": 21},
+                {"speed-preset": "ultrafast", "quantizer": 25},
+                {"speed-preset": "ultrafast", "quantizer": 30}],
+}
+
+#
+# Properties where a higher value is cheaper. Steps never take these below
+# what the profile started with.
+#
+ADAPT_CHEAPER_UP = ("cpu-used", "quantizer")
+
+#
+# Frames in flight we keep track of, in case an encoder eats some.
+#
+ADAPT_MAX_PENDING = 256
+
+
+class AdaptiveQuality(object):
+    """Trades encoder quality for speed while recording, and back.
+
+    Encoder latency is measured with probes on both encoder pads, queue
+    fill is read from the queue in front of the encoder. When either gets
+    too high the encoder is moved one step down its ladder, when both stay
+    low for a while it goes one step back up. With a CPU limit the usage
+    fed in with set_cpu_load() counts too. Only properties that can be
+    changed in the PLAYING state are touched. Every change is logged and
+    kept for the end of recording summary.
+    """
+    def __init__(self):
+        self.timer = None
+        self.probes = []
+        self.lock = threading.Lock()
+        self.encoder = None
+        self.ladder = []
+        self.adjustments = []
+        self.step = 0
+        self.cpu_load = 0.0
+
+    def start(self, pipeline, queue_name):
+        self.encoder = pipeline.get_by_name("video_encoder")
+        self.queue = pipeline.get_by_name(queue_name)
+        self.ladder = []
+        self.adjustments = []
+        if self.encoder is None:
+            return
+
+        factory = self.encoder.get_factory().get_name()
+        self.ladder = [self.mutable(step) for step in ADAPT_LADDERS.get(factory, [])]
+        self.ladder = [step for step in self.ladder if step]
+        if not self.ladder:
+            logger.debug("Nothing to adapt on {0}.".format(factory))
+            return
+
+        #
+        # Step 0 is whatever the profile set up.
+        #
+        props = set(prop for step in self.ladder for prop in step)
+        base = dict((prop, self.encoder.get_property(prop)) for prop in props)
+        for step in self.ladder:
+            for prop in ADAPT_CHEAPER_UP:
+                if prop in step:
+                    step[prop] = max(step[prop], base[prop])
+        self.ladder.insert(0, base)
+        self.step = 0
+        self.calm = 0
+        self.start_time = time.time()
+        self.pending = {}
+        self.latency = 0.0
+        self.floor = None
+
+        for (pad, cb) in ((self.encoder.get_static_pad("sink"), self.cb_sink_probe),
+                          (self.encoder.get_static_pad("src"), self.cb_src_probe)):
+            self.probes.append((pad, pad.add_probe(Gst.PadProbeType.BUFFER, cb, None)))
+        self.timer = GLib.timeout_add(ADAPT_INTERVAL, self.cb_poll)
+        logger.debug("Adapting {0} over {1} step(s).".format(factory, len(self.ladder) - 1))
+
+    def mutable(self, step):
+        changes = {}
+        for (prop, value) in step.items():
+            pspec = self.encoder.find_property(prop)
+            if pspec is not None and pspec.flags & Gst.PARAM_MUTABLE_PLAYING:
+                changes[prop] = value
+        return changes
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        for (pad, probe) in self.probes:
+            pad.remove_probe(probe)
+        self.probes = []
+        if self.adjustments:
+            logger.debug("Quality adjustments: {0}, ended on step {1}.".format(len(self.adjustments), self.step))
+        #
+        # The pipeline may be reused for the next take, which starts from the profile again.
+        #
+        if self.step:
+            for (prop, value) in self.ladder[0].items():
+                self.encoder.set_property(prop, value)
+            self.step = 0
+
+    def set_cpu_load(self, load):
+        """Takes CPU usage as a fraction of the CPU limit."""
+        self.cpu_load = load
+
+    def cb_sink_probe(self, pad, info, data):
+        pts = info.get_buffer().pts
+        with self.lock:
+            if len(self.pending) < ADAPT_MAX_PENDING:
+                self.pending[pts] = time.time()
+        return Gst.PadProbeReturn.OK
+
+    def cb_src_probe(self, pad, info, data):
+        pts = info.get_buffer().pts
+        with self.lock:
+            start = self.pending.pop(pts, None)
+            if start is not None:
+                self.latency = max(self.latency, time.time() - start)
+                #
+                # Frames the encoder dropped or reordered past this one are gone for good.
+                #
+                for stale in [p for p in self.pending if p < pts]:
+                    del self.pending[stale]
+        return Gst.PadProbeReturn.OK
+
+    def get_fill(self):
+        limit = self.queue.get_property("max-size-time") if self.queue else 0
+        if not limit:
+            return 0.0
+        return float(self.queue.get_property("current-level-time")) / limit
+
+    def cb_poll(self):
+        with self.lock:
+            latency = self.latency
+            self.latency = 0.0
+        if latency > 0:
+            self.floor = latency if self.floor is None else min(self.floor, latency)
+            latency -= self.floor
+        fill = self.get_fill()
+
+        cpu = self.cpu_load
+
+        if latency > ADAPT_HIGH_LATENCY or fill > ADAPT_HIGH_FILL or cpu > ADAPT_HIGH_CPU:
+            self.calm = 0
+            if self.step < len(self.ladder) - 1:
+                self.set_step(self.step + 1, latency, fill)
+        elif latency < ADAPT_LOW_LATENCY and fill < ADAPT_LOW_FILL and cpu < ADAPT_LOW_CPU:
+            self.calm += 1
+            if self.step > 0 and self.calm >= ADAPT_CALM_POLLS:
+                self.calm = 0
+                self.set_step(self.step - 1, latency, fill)
+        else:
+            self.calm = 0
+        return True
+
+    def set_step(self, step, latency, fill):
+        props = {}
+        for s in self.ladder[:step + 1]:
+            props.update(s)
+        for (prop, value) in props.items():
+            self.encoder.set_property(prop, value)
+
+        when = time.time() - self.start_time
+        logger.info("{0:.2f} s: {1} to step {2} (latency {3:.0f} ms, queue {4:.0%}, cpu {5:.0%}): {6}".format(
+            when,
+            "degrading" if step > self.step else "restoring",
+            step,
+            latency * 1000,
+            fill,
+            self.cpu_load,
+            ", ".join("{0}={1}".format(prop, value) for (prop, value) in sorted(props.items()))))
+        self.adjustments.append({"time": when, "step": step, "props": props})
+        self.step = step
+
+    def get_report(self):
+        return self.adjustments
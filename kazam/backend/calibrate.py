@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+#       calibrate.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import time
+import logging
+logger = logging.getLogger("Calibrate")
+
+from gi.repository import GObject, GLib, Gst
+
+from kazam.backend.prefs import *
+from kazam.backend.threads import ThreadBudget
+from kazam.backend.pipeline import set_properties
+from kazam.backend.encoders import get_encoder_props
+
+#
+# Seconds of video encoded per trial, and how much faster than real time
+# an encoder has to be to count as sustainable. The headroom covers the
+# capture and colour conversion running next to it.
+#
+CALIBRATION_SECONDS = 1
+CALIBRATION_HEADROOM = 1.5
+
+#
+# No new trial is started once calibration has taken this many seconds.
+#
+CALIBRATION_BUDGET = 4
+
+#
+# Codecs in order of preference and profiles from the best looking down.
+# The first profile that keeps up wins, the rest are skipped.
+#
+CALIBRATION_CODECS = (CODEC_H264, CODEC_VP8)
+CALIBRATION_PROFILES = ("small-file", "balanced", "low-cpu")
+
+#
+# Something that moves, a still test pattern is free to encode.
+#
+CALIBRATION_PIPELINE = ("videotestsrc name=src pattern=smpte horizontal-speed=8 ! "
+                        "video/x-raw, width={0}, height={1}, framerate={2}/1 ! "
+                        "videoconvert ! {3} name=encoder ! fakesink sync=false")
+
+
+class Calibration(GObject.GObject):
+    """Finds the best codec and encoder profile this machine can sustain.
+
+    A second of synthetic video at the recording size and framerate is
+    encoded with every candidate, as fast as it goes, until one keeps up or
+    the time budget runs out. Results are written to the calibration section
+    of kazam.conf, the winner becomes the codec and encoder profile in prefs.
+    cancel() stops a calibration without touching prefs.
+    """
+    __gsignals__ = {"calibration-progress": (GObject.SIGNAL_RUN_LAST,
+                                             None,
+                                             [GObject.TYPE_FLOAT],),
+                    "calibration-done": (GObject.SIGNAL_RUN_LAST,
+                                         None,
+                                         [GObject.TYPE_BOOLEAN],),
+                    }
+
+    def __init__(self, width, height, framerate):
+        GObject.GObject.__init__(self)
+        self.width = width - width % 2
+        self.height = height - height % 2
+        self.framerate = int(framerate)
+        self.pipeline = None
+        self.timer = None
+        self.trials = []
+        self.results = {}
+        self.count = 0
+        self.cancelled = False
+
+    def start(self, codecs):
+        logger.debug("Calibrating for {0}x{1} at {2} fps.".format(self.width, self.height, self.framerate))
+        self.start_time = time.time()
+        self.trials = [(codec, profile) for codec in CALIBRATION_CODECS if codec in codecs
+                       for profile in CALIBRATION_PROFILES]
+        self.count = len(self.trials)
+        self.next_trial()
+
+    def next_trial(self):
+        if self.cancelled:
+            return False
+        if self.trials and time.time() - self.start_time > CALIBRATION_BUDGET:
+            logger.debug("Out of time, skipping {0} trial(s).".format(len(self.trials)))
+            self.trials = []
+        if not self.trials:
+            self.finish()
+            return False
+
+        (codec, profile) = self.trials.pop(0)
+        factory = CODEC_LIST[codec][1]
+        frames = self.framerate * CALIBRATION_SECONDS
+
+        self.pipeline = Gst.parse_launch(CALIBRATION_PIPELINE.format(self.width, self.height,
+                                                                     self.framerate, factory))
+        self.pipeline.get_by_name("src").set_property("num-buffers", frames)
+        props = get_encoder_props(factory, profile)
+        props["threads"] = ThreadBudget().plan({"encoder": factory})["video"]["encoder"]
+        set_properties(self.pipeline.get_by_name("encoder"), props)
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        self.bus_watch = bus.connect("message", self.on_message, codec, profile)
+        self.timer = GLib.timeout_add(CALIBRATION_SECONDS * 2000, self.cb_timeout, codec, profile)
+        self.trial_start = time.time()
+        self.pipeline.set_state(Gst.State.PLAYING)
+        return False
+
+    def stop_trial(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        bus = self.pipeline.get_bus()
+        bus.disconnect(self.bus_watch)
+        bus.remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline = None
+
+    def cancel(self):
+        logger.debug("Calibration cancelled.")
+        self.cancelled = True
+        self.trials = []
+        if self.pipeline is not None:
+            self.stop_trial()
+        self.emit("calibration-done", False)
+
+    def end_trial(self, codec, profile, speed):
+        self.stop_trial()
+
+        logger.debug("{0} / {1}: {2:.2f}x real time".format(CODEC_LIST[codec][2], profile, speed))
+        self.results[(codec, profile)] = speed
+        if speed >= CALIBRATION_HEADROOM:
+            # Good enough, everything after it is worse looking or less preferred.
+            self.trials = []
+
+        self.emit("calibration-progress", 1.0 - float(len(self.trials)) / max(self.count, 1))
+        GLib.idle_add(self.next_trial)
+
+    def cb_timeout(self, codec, profile):
+        self.timer = None
+        self.end_trial(codec, profile, 0.0)
+        return False
+
+    def on_message(self, bus, message, codec, profile):
+        t = message.type
+        if t == Gst.MessageType.EOS:
+            elapsed = time.time() - self.trial_start
+            self.end_trial(codec, profile, CALIBRATION_SECONDS / max(elapsed, 0.001))
+        elif t == Gst.MessageType.ERROR:
+            logger.warning("Calibration of {0} failed: {1}".format(CODEC_LIST[codec][2], message.parse_error()[1]))
+            self.end_trial(codec, profile, 0.0)
+
+    def finish(self):
+        section = "calibration"
+        for ((codec, profile), speed) in self.results.items():
+            prefs.config.set(section, "{0}.{1}".format(codec, profile), "{0:.2f}".format(speed))
+
+        best = None
+        for codec in CALIBRATION_CODECS:
+            for profile in CALIBRATION_PROFILES:
+                if self.results.get((codec, profile), 0) >= CALIBRATION_HEADROOM:
+                    best = (codec, profile)
+                    break
+            if best:
+                break
+
+        if best:
+            (prefs.codec, prefs.encoder_profile) = best
+            logger.info("Calibration picked {0} with the {1} profile.".format(CODEC_LIST[best[0]][2], best[1]))
+        else:
+            logger.info("Nothing keeps up in real time, keeping {0}.".format(CODEC_LIST[prefs.codec][2]))
+        prefs.calibration = "{0}x{1}@{2}".format(self.width, self.height, self.framerate)
+        prefs.save_config()
+
+        logger.debug("Calibration took {0:.1f} s.".format(time.time() - self.start_time))
+        self.emit("calibration-done", best is not None)
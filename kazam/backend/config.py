@@ -59,6 +59,31 @@ class KazamConfig(ConfigParser):
                          "shutter_sound":          "True",
                          "shutter_type":           "0",
                          "first_run":              "True",
+                         "warm_start":             "True",
+                         "damage_mode":            "0",
+                         "vfr_codecs":             "",
+                         "queue_profile":          "default",
+                         "segment_mode":           "False",
+                         "segment_seconds":        "60",
+                         "segment_megabytes":      "0",
+                         "mp4_fragmented":         "False",
+                         "mp4_fragment_duration":  "1000",
+                         "two_stage":              "False",
+                         "two_stage_codec":        "3",
+                         "transcode_chunk_seconds": "60",
+                         "replay_mode":            "False",
+                         "replay_seconds":         "30",
+                         "replay_megabytes":       "256",
+                         "extra_outputs":          "",
+                         "output_scale":           "",
+                         "scale_method":           "bilinear",
+                         "split_screens":          "False",
+                         "encoder_profile":        "balanced",
+                         "calibration":            "",
+                         "adaptive_quality":       "False",
+                         "cpu_limit":              "0",
+                         "thread_priorities":      "False",
+                         "timing_sidecar":         "False",
                          },
                 },
                 {"name": "keyboard_shortcuts",
@@ -76,7 +101,8 @@ class KazamConfig(ConfigParser):
         ConfigParser.__init__(self, self.DEFAULTS[0]['keys'])
         if not os.path.isdir(self.CONFIGDIR):
             os.makedirs(self.CONFIGDIR)
-        if not os.path.isfile(self.CONFIGFILE):
+        self.new = not os.path.isfile(self.CONFIGFILE)
+        if self.new:
             self.create_default()
             self.write()
         self.read(self.CONFIGFILE)
@@ -112,6 +138,12 @@ class KazamConfig(ConfigParser):
             self.write()
             return default
 
+    def is_set(self, section, key):
+        """Tells whether key was in kazam.conf before we wrote defaults to it."""
+        if self.new or not self.has_section(section):
+            return False
+        return key in self._sections[section]
+
     def getboolean(self, section, key):
         val = self.get(section, key)
         if val.lower() == 'true' or val.lower == "on" or val.lower() == "yes":
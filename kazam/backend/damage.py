@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+#       damage.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import time
+import logging
+logger = logging.getLogger("Damage")
+
+from collections import deque
+
+from gi.repository import Gst
+
+from kazam.backend.prefs import *
+from kazam.backend.sampling import FrameSampler
+
+#
+# Fraction of the frame that has to change, on average, before XDamage
+# is switched off and back on again. The gap between them keeps us from
+# flapping between the two modes.
+#
+DAMAGE_HIGH_WATER = 0.35
+DAMAGE_LOW_WATER = 0.15
+
+#
+# A rough activity figure is all we need, so only every DAMAGE_FRAME_STEP-th
+# frame is sampled and only every DAMAGE_ROW_STEP-th row of it.
+#
+DAMAGE_FRAME_STEP = 2
+DAMAGE_ROW_STEP = 16
+
+#
+# XDamage is kept off for the first second of a recording to measure what a
+# full copy costs the capture thread. Savings are reported against that.
+#
+DAMAGE_BASELINE = 1.0
+
+
+class DamageController(object):
+    """Keeps an eye on how much of the screen changes and drives ximagesrc
+    use-damage accordingly.
+
+    With XDamage ximagesrc copies only the changed rectangles, which is a big
+    win on idle screens and a loss during heavy motion. In DAMAGE_ADAPTIVE
+    mode we sample the frames and switch XDamage off when most of the screen
+    is moving, in DAMAGE_ON mode only statistics are collected.
+
+    Sampling is done on pad, which should sit behind the capture queue, so
+    the ximagesrc thread only pays for a timestamp per frame. That timestamp
+    gives the capture CPU time per frame with XDamage on and off.
+    """
+    def __init__(self, videosrc, pad, mode, framerate):
+        self.videosrc = videosrc
+        self.mode = mode
+        self.window = deque(maxlen=max(1, int(framerate) // DAMAGE_FRAME_STEP))
+        self.baseline_frames = max(1, int(framerate * DAMAGE_BASELINE))
+        self.sampler = FrameSampler(row_step=DAMAGE_ROW_STEP)
+        self.src_pad = videosrc.get_static_pad("src")
+        self.pad = pad
+        self.probes = []
+
+    def start(self):
+        self.sampler.reset()
+        self.window.clear()
+        self.damage = False
+        self.videosrc.set_property("use-damage", False)
+        self.frames = 0
+        self.damage_frames = 0
+        self.switches = 0
+        self.bytes_full = 0
+        self.bytes_copied = 0
+        self.last_cpu = None
+        self.capture_cpu = {False: 0.0, True: 0.0}
+        self.capture_frames = {False: 0, True: 0}
+        self.probes = [(self.src_pad, self.src_pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_capture_probe, None)),
+                       (self.pad, self.pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_buffer_probe, None))]
+
+    def stop(self):
+        for (pad, probe) in self.probes:
+            pad.remove_probe(probe)
+        self.probes = []
+        self.log_summary()
+
+    def cb_capture_probe(self, pad, info, data):
+        #
+        # Runs on the capture thread, the CPU time it used since the last
+        # frame is what producing this one cost.
+        #
+        now = time.thread_time()
+        if self.last_cpu is not None:
+            self.capture_cpu[self.damage] += now - self.last_cpu
+            self.capture_frames[self.damage] += 1
+        self.last_cpu = now
+        return Gst.PadProbeReturn.OK
+
+    def cb_buffer_probe(self, pad, info, data):
+        buf = info.get_buffer()
+        size = buf.get_size()
+
+        self.frames += 1
+        self.bytes_full += size
+        if self.damage:
+            #
+            # XDamage works with bounding rectangles, so this is a lower bound.
+            #
+            self.damage_frames += 1
+            changed = self.window[-1] if self.window else 1.0
+            self.bytes_copied += int(size * changed)
+        else:
+            self.bytes_copied += size
+
+        if self.frames == self.baseline_frames:
+            logger.debug("Baseline measured, XDamage on.")
+            self.damage = True
+            self.videosrc.set_property("use-damage", True)
+
+        if self.frames % DAMAGE_FRAME_STEP:
+            return Gst.PadProbeReturn.OK
+
+        if self.sampler.height is None:
+            self.sampler.set_caps(pad.get_current_caps())
+        changed = self.sampler.sample(buf)
+        if self.sampler.frames == 1:
+            return Gst.PadProbeReturn.OK
+        self.window.append(changed)
+
+        if self.mode == DAMAGE_ADAPTIVE and self.frames > self.baseline_frames:
+            if len(self.window) < self.window.maxlen:
+                return Gst.PadProbeReturn.OK
+            activity = sum(self.window) / len(self.window)
+            if self.damage and activity > DAMAGE_HIGH_WATER:
+                self.set_damage(False, activity)
+            elif not self.damage and activity < DAMAGE_LOW_WATER:
+                self.set_damage(True, activity)
+
+        return Gst.PadProbeReturn.OK
+
+    def set_damage(self, damage, activity):
+        logger.debug("{0}: screen activity {1:.0%}, XDamage {2}.".format(
+            self.videosrc.get_name(), activity, "on" if damage else "off"))
+        self.damage = damage
+        self.switches += 1
+        self.videosrc.set_property("use-damage", damage)
+
+    def get_summary(self):
+        copy_saved = 1.0 - float(self.bytes_copied) / self.bytes_full if self.bytes_full else 0.0
+
+        #
+        # Capture CPU per frame without XDamage (baseline) and with it.
+        # What the XDamage frames would have cost at the baseline rate, less
+        # what they did cost and less the sampling, is the CPU time saved.
+        #
+        (base_frames, damage_frames) = (self.capture_frames[False], self.capture_frames[True])
+        baseline = self.capture_cpu[False] / base_frames if base_frames else None
+        damage = self.capture_cpu[True] / damage_frames if damage_frames else None
+        sampling = self.sampler.time
+        if baseline is not None and damage is not None:
+            saved = (baseline - damage) * damage_frames - sampling
+        else:
+            saved = None
+
+        return {"frames": self.frames,
+                "damage_frames": self.damage_frames,
+                "switches": self.switches,
+                "bytes_full": self.bytes_full,
+                "bytes_copied": self.bytes_copied,
+                "copy_saved": copy_saved,
+                "cpu_baseline_ms": baseline * 1000 if baseline is not None else None,
+                "cpu_damage_ms": damage * 1000 if damage is not None else None,
+                "sampling_ms": self.sampler.get_cost(),
+                "cpu_saved": saved}
+
+    def log_summary(self):
+        s = self.get_summary()
+        logger.debug("Damage capture of {0}: {1} frames, XDamage used for {2}, {3} mode switch(es).".format(
+            self.videosrc.get_name(), s["frames"], s["damage_frames"], s["switches"]))
+        logger.debug("  Copied {0:.1f} MB of {1:.1f} MB, {2:.0%} of the copying saved.".format(
+            s["bytes_copied"] / 1048576.0, s["bytes_full"] / 1048576.0, s["copy_saved"]))
+        if s["cpu_saved"] is None:
+            logger.debug("  Recording too short to measure the CPU time saved.")
+            return
+        logger.debug("  Capture CPU {0:.2f} ms per frame without XDamage, {1:.2f} ms with it, sampling {2:.2f} ms per frame.".format(
+            s["cpu_baseline_ms"], s["cpu_damage_ms"], s["sampling_ms"]))
+        logger.debug("  CPU time saved: {0:.2f} s.".format(s["cpu_saved"]))
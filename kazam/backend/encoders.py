@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+#       encoders.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger("Encoders")
+
+from gi.repository import GObject, Gst
+
+from kazam.backend.prefs import *
+
+#
+# Built-in encoder profiles, video encoder properties by element. Threads
+# are left out, those come from the thread budget.
+#
+ENCODER_PROFILES = {
+    "balanced": {
+        "vp8enc": {"cpu-used": 2,
+                   "end-usage": "vbr",
+                   "target-bitrate": 800000000,
+                   "static-threshold": 1000,
+                   "token-partitions": 2,
+                   "max-quantizer": 30},
+        "x264enc": {"speed-preset": "ultrafast",
+                    "pass": 4,
+                    "quantizer": 15},
+        "avenc_huffyuv": {"bitrate": 500000},
+    },
+    # Good framerate, bad memory
+    "low-cpu": {
+        "vp8enc": {"cpu-used": 6,
+                   "deadline": 1000000,
+                   "end-usage": "vbr",
+                   "target-bitrate": 800000000,
+                   "static-threshold": 1000,
+                   "token-partitions": 2,
+                   "min-quantizer": 15,
+                   "max-quantizer": 15},
+        "x264enc": {"speed-preset": "ultrafast",
+                    "pass": 4,
+                    "quantizer": 21},
+        "avenc_huffyuv": {"bitrate": 500000},
+    },
+    "small-file": {
+        "vp8enc": {"cpu-used": 1,
+                   "end-usage": "cq",
+                   "cq-level": 20,
+                   "static-threshold": 1000,
+                   "token-partitions": 2,
+                   "max-quantizer": 40},
+        "x264enc": {"speed-preset": "veryfast",
+                    "pass": 5,
+                    "quantizer": 23},
+        "avenc_huffyuv": {"bitrate": 500000},
+    },
+    # vp8enc has no lossless mode, even at quantizer 0. It is left out and
+    # gets the default profile instead.
+    "lossless": {
+        "x264enc": {"speed-preset": "ultrafast",
+                    "pass": 4,
+                    "quantizer": 0},
+        "avenc_huffyuv": {"bitrate": 500000},
+    },
+}
+
+DEFAULT_PROFILE = "balanced"
+
+#
+# One instance of every encoder we have looked at, for property lookups.
+#
+_elements = {}
+
+
+def get_profile_names():
+    """Returns the names of built-in profiles and those defined in kazam.conf."""
+    names = list(ENCODER_PROFILES)
+    for section in prefs.config.sections():
+        if section.startswith("encoder_profile_"):
+            name = section[len("encoder_profile_"):]
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def convert_value(pspec, value):
+    """Turns a value from kazam.conf into what the property expects."""
+    if not isinstance(value, str):
+        return value
+    fundamental = GObject.type_fundamental(pspec.value_type)
+    if fundamental in (GObject.TYPE_INT, GObject.TYPE_UINT, GObject.TYPE_LONG,
+                       GObject.TYPE_ULONG, GObject.TYPE_INT64, GObject.TYPE_UINT64):
+        return int(value)
+    if fundamental in (GObject.TYPE_FLOAT, GObject.TYPE_DOUBLE):
+        return float(value)
+    if fundamental == GObject.TYPE_BOOLEAN:
+        return value.lower() in ("true", "yes", "on", "1")
+    if fundamental in (GObject.TYPE_ENUM, GObject.TYPE_FLAGS) and value.isdigit():
+        return int(value)
+    return value
+
+
+def validate_props(factory, props):
+    """Drops properties the element doesn't have or can't set, converts
+    the rest to the right type."""
+    element = _elements.get(factory)
+    if element is None:
+        element = Gst.ElementFactory.make(factory, None)
+        if element is None:
+            return props
+        _elements[factory] = element
+
+    valid = {}
+    for (prop, value) in props.items():
+        pspec = element.find_property(prop)
+        if pspec is None or not pspec.flags & GObject.ParamFlags.WRITABLE:
+            logger.warning("{0} has no property {1}, ignoring it.".format(factory, prop))
+            continue
+        try:
+            valid[prop] = convert_value(pspec, value)
+        except ValueError:
+            logger.warning("Invalid value for {0}.{1}: {2}".format(factory, prop, value))
+    return valid
+
+
+def get_encoder_props(factory, profile=None):
+    """Returns video encoder properties for an element in a given profile.
+
+    Profiles can be defined or tweaked in kazam.conf, in a section named
+    encoder_profile_<profile> with keys like vp8enc.cpu-used or
+    x264enc.speed-preset.
+    """
+    if profile is None:
+        profile = prefs.encoder_profile
+
+    section = "encoder_profile_{0}".format(profile)
+    if profile not in ENCODER_PROFILES and not prefs.config.has_section(section):
+        logger.warning("Unknown encoder profile '{0}', using {1}.".format(profile, DEFAULT_PROFILE))
+        profile = DEFAULT_PROFILE
+
+    builtin = ENCODER_PROFILES.get(profile, ENCODER_PROFILES[DEFAULT_PROFILE])
+    if factory not in builtin and factory in ENCODER_PROFILES[DEFAULT_PROFILE]:
+        logger.warning("{0} can't do the {1} profile, using {2}.".format(factory, profile, DEFAULT_PROFILE))
+        builtin = ENCODER_PROFILES[DEFAULT_PROFILE]
+    props = dict(builtin.get(factory, {}))
+
+    if prefs.config.has_section(section):
+        prefix = "{0}.".format(factory)
+        for key in prefs.config.options(section):
+            if key.startswith(prefix):
+                props[key[len(prefix):]] = prefs.config.get(section, key)
+
+    return validate_props(factory, props)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+#       geometry.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+#
+# Plain arithmetic on frame sizes, no GStreamer or GTK in here.
+#
+
+#
+# videoscale methods by name, cheapest first.
+#
+SCALE_METHODS = {"nearest": 0,
+                 "bilinear": 1,
+                 "4-tap": 2,
+                 "lanczos": 3,
+                 }
+
+
+def even(value):
+    """Rounds down to an even number, never below 2."""
+    return max(value - value % 2, 2)
+
+
+def get_scaled_size(width, height, scale, align=False):
+    """Returns the size a width x height frame is scaled to.
+
+    scale is empty (no scaling), WIDTHxHEIGHT (a fixed size), N% (a
+    percentage) or N (the longer side is at most N pixels, smaller frames
+    are left alone). With align both sides are rounded down to even numbers.
+    Raises ValueError when scale doesn't make sense.
+    """
+    scale = scale.strip().lower()
+    if not scale:
+        (new_width, new_height) = (width, height)
+    elif "x" in scale:
+        (new_width, new_height) = [int(v) for v in scale.split("x")]
+    elif scale.endswith("%"):
+        percent = float(scale[:-1])
+        new_width = int(round(width * percent / 100))
+        new_height = int(round(height * percent / 100))
+    else:
+        limit = int(scale)
+        if max(width, height) <= limit:
+            (new_width, new_height) = (width, height)
+        elif width >= height:
+            (new_width, new_height) = (limit, int(round(float(height) * limit / width)))
+        else:
+            (new_width, new_height) = (int(round(float(width) * limit / height)), limit)
+
+    if new_width <= 0 or new_height <= 0:
+        raise ValueError("Invalid output scale: {0}".format(scale))
+
+    if align:
+        return (even(new_width), even(new_height))
+    return (new_width, new_height)
+
+
+def get_region(x, y, width, height, bounds=None, align=False):
+    """Returns the (x, y, width, height) rectangle to capture.
+
+    The rectangle is clipped to bounds, given as (x, y, width, height),
+    when there are any. With align the size is rounded down to even
+    numbers by dropping the last column and row, the origin stays put.
+    """
+    if bounds is not None:
+        (bx, by, bw, bh) = bounds
+        (x2, y2) = (min(x + width, bx + bw), min(y + height, by + bh))
+        (x, y) = (max(x, bx), max(y, by))
+        (width, height) = (x2 - x, y2 - y)
+
+    if width <= 0 or height <= 0:
+        raise ValueError("Empty capture region: {0}x{1}".format(width, height))
+
+    if align:
+        return (x, y, even(width), even(height))
+    return (x, y, width, height)
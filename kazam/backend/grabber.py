@@ -28,6 +28,7 @@ logger = logging.getLogger("Grabber")
 from gi.repository import GObject, Gtk, Gdk, GdkPixbuf, GdkX11
 
 from kazam.backend.prefs import *
+from kazam.backend.geometry import get_region
 from kazam.frontend.save_dialog import SaveDialog
 from gettext import gettext as _
 
@@ -91,11 +92,23 @@ class Grabber(GObject.GObject):
                 win = GdkX11.X11Window.foreign_new_for_display(disp, self.xid)
                 (x, y, w, h) = win.get_geometry()
         else:
+            #
+            # Only the area (or the screen) is copied from the X server,
+            # not the whole root window.
+            #
             win = Gdk.get_default_root_window()
-            (x, y, w, h) = (self.video_source['x'],
-                            self.video_source['y'],
-                            self.video_source['width'],
-                            self.video_source['height'])
+            if self.area is not None:
+                logger.debug("Capturing area.")
+                (x, y, w, h) = get_region(min(self.area[0], self.area[2]),
+                                          min(self.area[1], self.area[3]),
+                                          self.area[4],
+                                          self.area[5],
+                                          (0, 0, win.get_width(), win.get_height()))
+            else:
+                (x, y, w, h) = (self.video_source['x'],
+                                self.video_source['y'],
+                                self.video_source['width'],
+                                self.video_source['height'])
 
         self.pixbuf = Gdk.pixbuf_get_from_window(win, x, y, w, h)
         logger.debug("Coordinates     X {0}  Y {1}  W {2}  H {3}".format(x, y, w, h))
@@ -135,10 +148,8 @@ class Grabber(GObject.GObject):
 
             else:
                 (scr, px, py) = pntr_device.get_position()
-                cur = scr.get_monitor_at_point(x, y)
-
-                px = px - HW.screens[cur]['x']
-                py = py - HW.screens[cur]['y']
+                px = px - x
+                py = py - y
 
                 #
                 # Cursor is offset by 6 pixels to the right and 2 down
@@ -153,13 +164,6 @@ class Grabber(GObject.GObject):
 
                 logger.debug("Cursor coords: {0} {1}".format(px, py))
 
-        if self.area is not None:
-            logger.debug("Cropping image.")
-            self.area_buf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, self.area[4], self.area[5])
-            self.pixbuf.copy_area(self.area[0], self.area[1], self.area[4], self.area[5], self.area_buf, 0, 0)
-            self.pixbuf = None
-            self.pixbuf = self.area_buf
-
         self.emit("flush-done")
 
     def save(self, filename):
@@ -20,11 +20,11 @@
 #       MA 02110-1301, USA.
 
 import os
+import time
 import logging
 logger = logging.getLogger("GStreamer")
 
 import tempfile
-import multiprocessing
 
 #
 # This needs to be set before we load GStreamer modules!
@@ -35,6 +35,21 @@ os.putenv("GST_DEBUG_DUMP_DOT_DIR", "/tmp")
 from gi.repository import GObject, Gst
 
 from kazam.backend.prefs import *
+from kazam.backend.stats import PipelineStats, SourceTiming
+from kazam.backend.timing import write_sidecar, remove_sidecar
+from kazam.backend.segments import get_segment_pattern, get_segment_glob, get_segments
+from kazam.backend.replay import ReplayBuffer
+from kazam.backend.adaptive import AdaptiveQuality
+from kazam.backend.threads import ThreadBudget, CpuLimit
+from kazam.backend.priority import ThreadPriorities, CAPTURE_PRIORITY, ENCODER_PRIORITY
+from kazam.backend.encoders import get_encoder_props
+from kazam.backend.outputs import OutputBranch, ScreenBranch, parse_outputs, get_mp4mux_props
+from kazam.backend.geometry import SCALE_METHODS, get_region, get_scaled_size
+from kazam.backend.transcode import get_capture_codec
+from kazam.backend.queues import QueueMonitor, get_queue_props
+from kazam.backend.damage import DamageController
+from kazam.backend.vfr import StaticFrameFilter, vfr_enabled
+from kazam.backend.pipeline import PipelineGraph, PipelineBuilder
 
 
 GObject.threads_init()
@@ -44,35 +59,105 @@ if prefs.debug:
 else:
     Gst.debug_set_active(False)
 
+builder = PipelineBuilder()
+
+#
+# In segmented and replay mode encoders are asked for a keyframe at least
+# this often. splitmuxsink can only start a new segment on one and the
+# replay buffer drops whole GOPs.
+#
+SEGMENT_KEYFRAME_SECONDS = 2
+
 
 class Screencast(GObject.GObject):
     __gsignals__ = {"flush-done": (GObject.SIGNAL_RUN_LAST,
                     None,
                     (),),
+                    "replay-saved": (GObject.SIGNAL_RUN_LAST,
+                    None,
+                    [GObject.TYPE_STRING],),
                     }
 
     def __init__(self):
         GObject.GObject.__init__(self)
-        self.temp_fh = tempfile.mkstemp(prefix="kazam_", dir=prefs.video_dest, suffix=".movie")
-        self.tempfile = self.temp_fh[1]
-        self.muxer_tempfile = "{0}.mux".format(self.tempfile)
-        self.pipeline = Gst.Pipeline()
+        self.tempfile = None
+        self.muxer_tempfile = None
+        self.pipeline = None
+        self.graph = None
+        self.bus = None
+        self.bus_watch = None
         self.area = None
         self.xid = None
-        self.crop_vid = False
+        self.scale_vid = False
+        self.gate_probes = []
+        self.start_time = None
+        self.stop_time = None
+        self.warm_start = False
+        self.takes = 0
+        self.full_setup_time = None
+        self.damage = []
+        self.static_filter = None
+        self.vfr = False
+        self.codec = None
+        self.segmented = False
+        self.replay = False
+        self.replay_buffer = None
+        self.mux_factory = None
+        self.outputs = []
+        self.screens = []
+        self.limit = None
+        self.budget = None
+        self.threads = None
+        self.framerate = None
+        self.encoder_profile = None
+        self.priorities = ThreadPriorities()
+        self.timings = []
+        self.width = None
+        self.height = None
+        self.stats = PipelineStats()
+        self.queue_monitor = QueueMonitor()
+        self.adaptive = AdaptiveQuality()
+        self.stats.connect("stats-updated", self.cb_stats_updated)
+
+    def new_take(self):
+        (fd, self.tempfile) = tempfile.mkstemp(prefix="kazam_", dir=prefs.video_dest, suffix=".movie")
+        os.close(fd)
+        self.muxer_tempfile = "{0}.mux".format(self.tempfile)
+        self.segment_pattern = get_segment_pattern(self.tempfile)
+        for output in self.outputs + self.screens:
+            output.new_take()
+        self.takes += 1
 
     def setup_sources(self,
                       video_source,
                       audio_source,
                       audio2_source,
                       area,
-                      xid):
+                      xid,
+                      screens=None):
 
-        # Get the number of cores available then use all except one for encoding
-        self.cores = multiprocessing.cpu_count()
+        #
+        # A CPU limit means fewer threads, maybe a lower framerate and a
+        # cheaper encoder profile, and encoder threads at a lower priority.
+        #
+        self.limit = CpuLimit(prefs.cpu_limit)
+        self.framerate = self.limit.get_framerate(prefs.framerate)
+        self.encoder_profile = self.limit.get_profile(prefs.encoder_profile)
+        if self.limit.enabled():
+            logger.debug("CPU limit: {0}%, {1} of {2} CPU(s)".format(self.limit.percent,
+                                                                    self.limit.get_cpus(),
+                                                                    self.limit.cpus))
 
-        if self.cores > 1:
-            self.cores -= 1
+        #
+        # With more than one screen the first one is recorded as usual,
+        # every other one gets a source and an encoder of its own.
+        #
+        if screens and len(screens) > 1 and not prefs.replay_mode:
+            video_source = screens[0]
+            self.screens = [ScreenBranch(index, prefs.codec, screen, self.framerate)
+                            for (index, screen) in enumerate(screens[1:], 1)]
+        else:
+            self.screens = []
 
         self.audio_source = audio_source
         self.audio2_source = audio2_source
@@ -87,218 +172,303 @@ class Screencast(GObject.GObject):
         logger.debug("Area: {0}".format(area))
 
         logger.debug("Capture Cursor: {0}".format(prefs.capture_cursor))
-        logger.debug("Framerate : {0}".format(prefs.framerate))
+        logger.debug("Framerate : {0}".format(self.framerate))
+        logger.debug("Queue profile: {0}".format(prefs.queue_profile))
+
+        #
+        # In two-stage mode we record with a cheap intermediate codec and
+        # transcode to the chosen one afterwards. The geometry still has to
+        # suit the final codec. The replay buffer lives in memory, it always
+        # holds the chosen codec, intermediates are far too big for it.
+        #
+        self.replay = prefs.replay_mode
+        logger.debug("Replay buffer: {0}".format(self.replay))
+        if self.replay:
+            self.codec = prefs.codec
+        else:
+            self.codec = get_capture_codec(prefs.codec)
+        logger.debug("Capture codec: {0}".format(CODEC_LIST[self.codec][2]))
+
+        self.segmented = not self.replay and prefs.segment_mode and \
+            (prefs.segment_seconds > 0 or prefs.segment_megabytes > 0)
+        logger.debug("Segmented: {0}".format(self.segmented))
+
+        #
+        # Extra outputs branch off after colour conversion and write files of
+        # their own, each with its own codec, size and framerate.
+        #
+        if self.replay:
+            self.outputs = []
+        else:
+            self.outputs = [OutputBranch(index, **spec)
+                            for (index, spec) in enumerate(parse_outputs(prefs.extra_outputs))]
+        logger.debug("Extra outputs: {0}, extra screens: {1}".format(len(self.outputs), len(self.screens)))
+
+        #
+        # Every encoder in the pipeline, ours and those of the branches,
+        # gets its share of the CPUs we are allowed to use.
+        #
+        encoders = {"video_encoder": CODEC_LIST[self.codec][1]}
+        for output in self.outputs + self.screens:
+            encoders[output.name("encoder")] = CODEC_LIST[output.codec][1]
+        self.budget = ThreadBudget(self.limit.get_cpus())
+        self.threads = self.budget.plan(encoders, audio=bool(audio_source or audio2_source))
+
+        self.priorities.set_priorities(self.get_thread_priorities())
+
+        self.new_take()
+        setup_start = time.time()
+
+        old_graph = self.graph
+        self.graph = PipelineGraph()
 
         if self.video_source or self.area:
             self.setup_video_source()
 
         self.setup_audio_sources()
+        self.setup_outputs()
 
         self.setup_filesink()
-        self.setup_pipeline()
         self.setup_links()
 
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect("message", self.on_message)
+        if self.pipeline is None:
+            self.pipeline = builder.build(self.graph)
+            self.attach_bus()
+        else:
+            builder.update(self.pipeline, old_graph, self.graph)
+        self.setup_elements()
+
+        setup_time = (time.time() - setup_start) * 1000
+        if old_graph is None:
+            self.full_setup_time = setup_time
+            logger.debug("Take {0}: pipeline setup took {1:.1f} ms.".format(self.takes, setup_time))
+        else:
+            logger.debug("Take {0}: pipeline setup took {1:.1f} ms, saved {2:.1f} ms.".format(
+                self.takes, setup_time, self.full_setup_time - setup_time))
+
+    def get_thread_priorities(self):
+        #
+        # Source threads only capture and hand frames to a queue, the
+        # threads of the queues in front of encoders do the heavy lifting.
+        #
+        priorities = {}
+        if prefs.thread_priorities:
+            sources = ["video_src", "audio_src", "audio2_src"]
+            sources += [screen.name("src") for screen in self.screens]
+            for name in sources:
+                priorities[name] = CAPTURE_PRIORITY
+
+        encoder = self.limit.get_encoder_priority()
+        if encoder is None and prefs.thread_priorities:
+            encoder = ENCODER_PRIORITY
+        if encoder is not None:
+            for name in self.get_encoder_queues():
+                priorities[name] = encoder
+        return priorities
+
+    def get_encoder_queues(self):
+        #
+        # The queues whose streaming threads run the video encoders.
+        #
+        queues = ["queue_v_main" if self.outputs else "queue_v1"]
+        queues += [output.name("queue") for output in self.outputs + self.screens]
+        return queues
 
     def setup_video_source(self):
 
         if prefs.test:
-            self.videosrc = Gst.ElementFactory.make("videotestsrc", "video_src")
-            self.videosrc.set_property("pattern", "smpte")
+            self.graph.add("video_src", "videotestsrc", {"pattern": "smpte",
+                                                         "is-live": True})
         else:
-            self.videosrc = Gst.ElementFactory.make("ximagesrc", "video_src")
-
-        if self.area:
-            logger.debug("Capturing area.")
-            startx = self.area[0] if self.area[0] > 0 else 0
-            starty = self.area[1] if self.area[1] > 0 else 0
-            endx = self.area[2]
-            endy = self.area[3]
-        else:
-            startx = self.video_source['x']
-            starty = self.video_source['y']
-            width = self.video_source['width']
-            height = self.video_source['height']
-            endx = startx + width - 1
-            endy = starty + height - 1
+            self.graph.add("video_src", "ximagesrc")
 
         #
-        # H264 requirement is that video dimensions are divisible by 2.
-        # If they are not, we have to get rid of that extra pixel.
+        # Only the region we record is requested from the X server, for a
+        # window that is relative to the window itself. H264 requirement is
+        # that video dimensions are divisible by 2, the odd column and row
+        # are left out at the source instead of being cropped later.
         #
-        if not abs(startx - endx) % 2 and prefs.codec == CODEC_H264:
-            endx -= 1
-
-        if not abs(starty - endy) % 2 and prefs.codec == CODEC_H264:
-            endy -= 1
+        align = self.codec == CODEC_H264 or prefs.codec == CODEC_H264
+        if self.xid:
+            region = get_region(0, 0, prefs.xid_geometry[2], prefs.xid_geometry[3], align=align)
+        elif self.area:
+            logger.debug("Capturing area.")
+            bounds = (0, 0, HW.default_screen.get_width(), HW.default_screen.get_height())
+            region = get_region(min(self.area[0], self.area[2]), min(self.area[1], self.area[3]),
+                                self.area[4], self.area[5], bounds, align)
+        else:
+            region = get_region(self.video_source['x'], self.video_source['y'],
+                                self.video_source['width'], self.video_source['height'], align=align)
 
+        (startx, starty, self.width, self.height) = region
+        endx = startx + self.width - 1
+        endy = starty + self.height - 1
         logger.debug("Coordinates SX: {0} SY: {1} EX: {2} EY: {3}".format(startx, starty, endx, endy))
 
+        videosrc = self.graph.nodes["video_src"]
+
         if prefs.test:
             logger.info("Using test signal instead of screen capture.")
-            self.vid_caps = Gst.caps_from_string("video/x-raw, framerate={0}/1".format(
-                  int(prefs.framerate)))
-            self.vid_caps_filter = Gst.ElementFactory.make("capsfilter", "vid_filter")
-            self.vid_caps_filter.set_property("caps", self.vid_caps)
         else:
             logger.debug("testing for xid: {0}".format(self.xid))
             if self.xid:   # xid was passed, so we have to capture a single window.
                 logger.debug("Capturing Window: {0} {1}".format(self.xid, prefs.xid_geometry))
-                self.videosrc.set_property("xid", self.xid)
-
-                if prefs.codec == CODEC_H264:
-                    self.videocrop = Gst.ElementFactory.make("videocrop", "cropper")
-                    if prefs.xid_geometry[2] % 2:
-                        self.videocrop.set_property("left", 1)
-                        self.crop_vid = True
-                    if prefs.xid_geometry[3] % 2:
-                        self.videocrop.set_property("bottom", 1)
-                        self.crop_vid = True
-            else:
-                self.videosrc.set_property("startx", startx)
-                self.videosrc.set_property("starty", starty)
-                self.videosrc.set_property("endx", endx)
-                self.videosrc.set_property("endy", endy)
-
-            self.videosrc.set_property("use-damage", False)
-            self.videosrc.set_property("show-pointer", prefs.capture_cursor)
-
-            self.vid_caps = Gst.caps_from_string("video/x-raw, framerate={0}/1".format(int(prefs.framerate)))
-            self.vid_caps_filter = Gst.ElementFactory.make("capsfilter", "vid_filter")
-            self.vid_caps_filter.set_property("caps", self.vid_caps)
-
-        self.videoconvert = Gst.ElementFactory.make("videoconvert", "videoconvert")
-        self.videorate = Gst.ElementFactory.make("videorate", "video_rate")
-
-        logger.debug("Codec: {0}".format(CODEC_LIST[prefs.codec][2]))
-
-        if prefs.codec is not CODEC_RAW:
-            self.videnc = Gst.ElementFactory.make(CODEC_LIST[prefs.codec][1], "video_encoder")
-
-        if prefs.codec == CODEC_RAW:
-            self.mux = Gst.ElementFactory.make("avimux", "muxer")
-        elif prefs.codec == CODEC_VP8:
-            self.videnc.set_property("cpu-used", 2)
-            self.videnc.set_property("end-usage", "vbr")
-            self.videnc.set_property("target-bitrate", 800000000)
-            self.videnc.set_property("static-threshold", 1000)
-            self.videnc.set_property("token-partitions", 2)
-            self.videnc.set_property("max-quantizer", 30)
-            self.videnc.set_property("threads", self.cores)
-
-            # Good framerate, bad memory
-            #self.videnc.set_property("cpu-used", 6)
-            #self.videnc.set_property("deadline", 1000000)
-            #self.videnc.set_property("min-quantizer", 15)
-            #self.videnc.set_property("max-quantizer", 15)
-            #self.videnc.set_property("threads", self.cores)
-
-
-            self.mux = Gst.ElementFactory.make("webmmux", "muxer")
-        elif prefs.codec == CODEC_H264:
-            self.videnc.set_property("speed-preset", "ultrafast")
-            self.videnc.set_property("pass", 4)
-            self.videnc.set_property("quantizer", 15)
-            #
-            # x264enc supports maximum of four cores
-            #
-            self.videnc.set_property("threads", self.cores if self.cores <= 4 else 4)
-            self.mux = Gst.ElementFactory.make("mp4mux", "muxer")
-            self.mux.set_property("faststart", 1)
-            self.mux.set_property("faststart-file", self.muxer_tempfile)
-            self.mux.set_property("streamable", 1)
-        elif prefs.codec == CODEC_HUFF:
-            self.mux = Gst.ElementFactory.make("avimux", "muxer")
-            self.videnc.set_property("bitrate", 500000)
-        elif prefs.codec == CODEC_JPEG:
-            self.mux = Gst.ElementFactory.make("avimux", "muxer")
-
-        self.vid_in_queue = Gst.ElementFactory.make("queue", "queue_v1")
-        self.vid_out_queue = Gst.ElementFactory.make("queue", "queue_v2")
+                videosrc.props["xid"] = self.xid
+            videosrc.props["startx"] = startx
+            videosrc.props["starty"] = starty
+            videosrc.props["endx"] = endx
+            videosrc.props["endy"] = endy
+
+            videosrc.props["use-damage"] = prefs.damage_mode != DAMAGE_OFF
+            videosrc.props["show-pointer"] = prefs.capture_cursor
+
+        #
+        # In variable framerate mode the source itself is asked for the
+        # framerate and static frames are dropped instead of duplicated.
+        #
+        self.vfr = vfr_enabled(self.codec)
+        logger.debug("Variable framerate: {0}".format(self.vfr))
+
+        self.graph.add("queue_v1", "queue", get_queue_props("queue_v1"))
+        if not self.vfr:
+            self.graph.add("video_rate", "videorate")
+        self.graph.add("vid_filter", "capsfilter",
+                       {"caps": "video/x-raw, framerate={0}/1".format(int(self.framerate))})
+        self.setup_scaler()
+        self.graph.add("videoconvert", "videoconvert", {"n-threads": self.threads["convert"]})
+        if self.outputs:
+            self.graph.add("video_tee", "tee")
+            self.graph.add("queue_v_main", "queue", get_queue_props("queue_v_main"))
+
+        logger.debug("Codec: {0}, encoder profile: {1}".format(CODEC_LIST[self.codec][2], self.encoder_profile))
+
+        keyframe_dist = int(self.framerate * SEGMENT_KEYFRAME_SECONDS)
+
+        if self.codec == CODEC_RAW:
+            self.setup_muxer("avimux")
+        elif self.codec == CODEC_VP8:
+            encoder = self.graph.add("video_encoder", "vp8enc", get_encoder_props("vp8enc", self.encoder_profile))
+            encoder.props["threads"] = self.get_threads("video_encoder")
+            if self.segmented or self.replay:
+                encoder.props["keyframe-max-dist"] = keyframe_dist
+
+            self.setup_muxer("webmmux")
+        elif self.codec == CODEC_H264:
+            encoder = self.graph.add("video_encoder", "x264enc", get_encoder_props("x264enc", self.encoder_profile))
+            encoder.props["threads"] = self.get_threads("video_encoder")
+            if self.segmented or self.replay:
+                encoder.props["key-int-max"] = keyframe_dist
+            (props, volatile) = get_mp4mux_props(self.muxer_tempfile)
+            self.setup_muxer("mp4mux", props, volatile=volatile)
+        elif self.codec == CODEC_HUFF:
+            self.graph.add("video_encoder", CODEC_LIST[self.codec][1], get_encoder_props(CODEC_LIST[self.codec][1], self.encoder_profile))
+            self.setup_muxer("avimux")
+        elif self.codec == CODEC_JPEG:
+            self.graph.add("video_encoder", CODEC_LIST[self.codec][1], get_encoder_props(CODEC_LIST[self.codec][1], self.encoder_profile))
+            self.setup_muxer("avimux")
+
+        self.graph.add("queue_v2", "queue", get_queue_props("queue_v2"))
+
+    def setup_scaler(self):
+        #
+        # Scaling happens before colour conversion and encoding, both of them
+        # only ever see the smaller frames.
+        #
+        self.scale_vid = False
+        try:
+            (width, height) = get_scaled_size(self.width, self.height, prefs.output_scale,
+                                              align=self.codec == CODEC_H264 or prefs.codec == CODEC_H264)
+        except ValueError:
+            logger.warning("Invalid output scale '{0}', recording at capture size.".format(prefs.output_scale))
+            return
+        if (width, height) == (self.width, self.height):
+            return
+
+        method = SCALE_METHODS.get(prefs.scale_method, SCALE_METHODS["bilinear"])
+        logger.debug("Scaling {0}x{1} to {2}x{3} ({4})".format(self.width, self.height, width, height,
+                                                              prefs.scale_method))
+        self.graph.add("scaler", "videoscale", {"method": method})
+        self.graph.add("scale_filter", "capsfilter",
+                       {"caps": "video/x-raw, width={0}, height={1}, pixel-aspect-ratio=1/1".format(width, height)})
+        (self.width, self.height) = (width, height)
+        self.scale_vid = True
+
+    def get_threads(self, name):
+        return self.threads["video"].get(name, 1)
+
+    def setup_muxer(self, factory, props=None, volatile=None):
+        #
+        # In segmented mode splitmuxsink creates a muxer of its own for every
+        # segment. Each segment is complete on its own, so faststart is moot.
+        #
+        self.mux_factory = factory
+        if not self.segmented and not self.replay:
+            self.graph.add("muxer", factory, props, volatile)
 
     def setup_audio_sources(self):
         if self.audio_source or self.audio2_source:
             logger.debug("Setup audio elements.")
-            self.aud_out_queue = Gst.ElementFactory.make("queue", "queue_a_out")
-            self.audioconv = Gst.ElementFactory.make("audioconvert", "audio_conv")
-            if prefs.codec == CODEC_VP8:
-                self.audioenc = Gst.ElementFactory.make("vorbisenc", "audio_encoder")
-                self.audioenc.set_property("quality", 1)
+            self.graph.add("queue_a_out", "queue", get_queue_props("queue_a_out"))
+            self.graph.add("audio_conv", "audioconvert")
+            if self.outputs:
+                self.graph.add("audio_tee", "tee")
+                self.graph.add("queue_a_main", "queue", get_queue_props("queue_a_main"))
+            if self.codec == CODEC_VP8:
+                self.graph.add("audio_encoder", "vorbisenc", {"quality": 1})
             else:
-                self.audioenc = Gst.ElementFactory.make("lamemp3enc", "audio_encoder")
-                self.audioenc.set_property("quality", 0)
+                self.graph.add("audio_encoder", "lamemp3enc", {"quality": 0})
 
         if self.audio_source:
             logger.debug("Audio1 Source:\n  {0}".format(self.audio_source))
-            self.audiosrc = Gst.ElementFactory.make("pulsesrc", "audio_src")
-            self.audiosrc.set_property("device", self.audio_source)
-            self.aud_caps = Gst.caps_from_string("audio/x-raw")
-            self.aud_caps_filter = Gst.ElementFactory.make("capsfilter", "aud_filter")
-            self.aud_caps_filter.set_property("caps", self.aud_caps)
-
-            self.aud_in_queue = Gst.ElementFactory.make("queue", "queue_a_in")
+            self.graph.add("audio_src", "pulsesrc", {"device": self.audio_source})
+            self.graph.add("queue_a_in", "queue", get_queue_props("queue_a_in"))
+            self.graph.add("aud_filter", "capsfilter", {"caps": "audio/x-raw"})
 
         if self.audio2_source:
             logger.debug("Audio2 Source:\n  {0}".format(self.audio2_source))
-            self.audio2src = Gst.ElementFactory.make("pulsesrc", "audio2_src")
-            self.audio2src.set_property("device", self.audio2_source)
-            self.aud2_caps = Gst.caps_from_string("audio/x-raw")
-            self.aud2_caps_filter = Gst.ElementFactory.make("capsfilter", "aud2_filter")
-            self.aud2_caps_filter.set_property("caps", self.aud2_caps)
-            self.aud2_in_queue = Gst.ElementFactory.make("queue", "queue_a2_in")
-            self.audio2conv = Gst.ElementFactory.make("audioconvert", "audio2_conv")
+            self.graph.add("audio2_src", "pulsesrc", {"device": self.audio2_source})
+            self.graph.add("queue_a2_in", "queue", get_queue_props("queue_a2_in"))
+            self.graph.add("aud2_filter", "capsfilter", {"caps": "audio/x-raw"})
 
         if self.audio_source and self.audio2_source:
-            self.audiomixer = Gst.ElementFactory.make("adder", "audiomixer")
-
-    def setup_filesink(self):
-        logger.debug("Filesink: {0}".format(self.tempfile))
-        self.sink = Gst.ElementFactory.make("filesink", "sink")
-        self.sink.set_property("location", self.tempfile)
-        self.file_queue = Gst.ElementFactory.make("queue", "queue_file")
-
-    #
-    # One day, this horrific code will be optimised... I promise!
-    #
-    def setup_pipeline(self):
-        #
-        # Behold, setup the master pipeline
-        #
-        self.pipeline.add(self.videosrc)
-        self.pipeline.add(self.vid_in_queue)
-        if self.crop_vid:
-            self.pipeline.add(self.videocrop)
-        self.pipeline.add(self.videorate)
-        self.pipeline.add(self.vid_caps_filter)
-        self.pipeline.add(self.videoconvert)
-        self.pipeline.add(self.vid_out_queue)
-        self.pipeline.add(self.file_queue)
-
-        if prefs.codec is not CODEC_RAW:
-            self.pipeline.add(self.videnc)
-
-        if self.audio_source or self.audio2_source:
-            self.pipeline.add(self.audioconv)
-            self.pipeline.add(self.audioenc)
-            self.pipeline.add(self.aud_out_queue)
-
-        if self.audio_source:
-            self.pipeline.add(self.audiosrc)
-            self.pipeline.add(self.aud_in_queue)
-            self.pipeline.add(self.aud_caps_filter)
-
-        if self.audio2_source:
-            self.pipeline.add(self.audio2src)
-            self.pipeline.add(self.aud2_in_queue)
-            self.pipeline.add(self.aud2_caps_filter)
+            self.graph.add("audiomixer", "adder")
 
-        if self.audio_source and self.audio2_source:
-            self.pipeline.add(self.audiomixer)
+    def setup_outputs(self):
+        audio = self.graph.has("audio_tee")
+        for output in self.outputs:
+            output.add_nodes(self.graph, self.width, self.height, self.framerate,
+                             self.get_threads(output.name("encoder")), audio, self.encoder_profile)
+        for screen in self.screens:
+            screen.add_nodes(self.graph, self.get_threads(screen.name("encoder")),
+                             profile=self.encoder_profile)
 
-        self.pipeline.add(self.mux)
-        self.pipeline.add(self.sink)
+    def setup_filesink(self):
+        if self.replay:
+            #
+            # Encoded streams end up in the replay buffer, nothing touches
+            # the disk until a replay is saved.
+            #
+            logger.debug("Replay buffer: {0} s / {1} MB".format(prefs.replay_seconds, prefs.replay_megabytes))
+            self.graph.add("replay_video", "appsink", {"emit-signals": True, "sync": False})
+            if self.graph.has("queue_a_out"):
+                self.graph.add("replay_audio", "appsink", {"emit-signals": True, "sync": False})
+        elif self.segmented:
+            logger.debug("Segments: {0}, every {1} s / {2} MB".format(self.segment_pattern,
+                                                                    prefs.segment_seconds,
+                                                                    prefs.segment_megabytes))
+            #
+            # Keyframe requests only work for time based splitting.
+            #
+            self.graph.add("sink", "splitmuxsink",
+                           {"muxer-factory": self.mux_factory,
+                            "max-size-time": prefs.segment_seconds * Gst.SECOND,
+                            "max-size-bytes": prefs.segment_megabytes * 1024 * 1024,
+                            "send-keyframe-requests": prefs.segment_megabytes == 0},
+                           volatile={"location": self.segment_pattern})
+        else:
+            logger.debug("Filesink: {0}".format(self.tempfile))
+            self.graph.add("queue_file", "queue", get_queue_props("queue_file"))
+            self.graph.add("sink", "filesink", volatile={"location": self.tempfile})
 
     # gst-launch-1.0 -e ximagesrc endx=1919 endy=1079 use-damage=false show-pointer=true ! \
     #   queue ! videorate ! video/x-raw,framerate=15/1 ! videoconvert ! \
@@ -307,90 +477,168 @@ class Screencast(GObject.GObject):
     #   queue ! filesink location="test-videorate.webm"
 
     def setup_links(self):
-        # Connect everything together
-        self.videosrc.link(self.vid_in_queue)
-        if self.crop_vid:
-            self.vid_in_queue.link(self.videocrop)
-            self.videocrop.link(self.videorate)
+        if self.vfr:
+            video = ["video_src", "vid_filter", "queue_v1"]
         else:
-            self.vid_in_queue.link(self.videorate)
-        self.videorate.link(self.vid_caps_filter)
-        self.vid_caps_filter.link(self.videoconvert)
-        if prefs.codec is CODEC_RAW:
-            self.videoconvert.link(self.vid_out_queue)
-            logger.debug("Linking RAW Video")
+            video = ["video_src", "queue_v1"]
+        if not self.vfr:
+            video += ["video_rate", "vid_filter"]
+        if self.scale_vid:
+            video += ["scaler", "scale_filter"]
+        video.append("videoconvert")
+        if self.outputs:
+            video += ["video_tee", "queue_v_main"]
+        if self.graph.has("video_encoder"):
+            video.append("video_encoder")
+        video.append("queue_v2")
+        self.graph.chain(*video)
+
+        if self.replay:
+            self.graph.link("queue_v2", "replay_video")
+        elif self.segmented:
+            self.graph.link("queue_v2", "sink", dst_pad="video")
         else:
-            logger.debug("Linking Video")
-            self.videoconvert.link(self.videnc)
-            self.videnc.link(self.vid_out_queue)
+            self.graph.link("queue_v2", "muxer")
 
-        self.vid_out_queue.link(self.mux)
+        if self.audio_source:
+            self.graph.chain("audio_src", "queue_a_in", "aud_filter")
+        if self.audio2_source:
+            self.graph.chain("audio2_src", "queue_a2_in", "aud2_filter")
 
         if self.audio_source and self.audio2_source:
-            logger.debug("Linking Audio")
-            ret = self.audiosrc.link(self.aud_in_queue)
-            logger.debug(" Link audiosrc -> aud_in_queue: %s" % ret)
-            ret = self.aud_in_queue.link(self.aud_caps_filter)
-            logger.debug(" Link aud_in_queue -> aud_caps_filter: %s" % ret)
-
-            logger.debug("Linking Audio2")
-            # Link first audio source to mixer
-            ret = self.aud_caps_filter.link(self.audiomixer)
-            logger.debug(" Link aud_caps_filter -> audiomixer: %s" % ret)
-
-            # Link second audio source to mixer
-            ret = self.audio2src.link(self.aud2_in_queue)
-            logger.debug(" Link audio2src -> aud2_in_queue: %s" % ret)
-            ret = self.aud2_in_queue.link(self.aud2_caps_filter)
-            logger.debug(" Link aud2_in_queue -> aud2_caps_filter: %s" % ret)
-            ret = self.aud2_caps_filter.link(self.audiomixer)
-            logger.debug(" Link aud2_caps_filter -> audiomixer: %s" % ret)
-
-            # Link mixer to audio convert
-            ret = self.audiomixer.link(self.audioconv)
-            logger.debug(" Link audiomixer -> audioconv: %s" % ret)
-
+            self.graph.link("aud_filter", "audiomixer")
+            self.graph.link("aud2_filter", "audiomixer")
+            self.graph.link("audiomixer", "audio_conv")
         elif self.audio_source:
+            self.graph.link("aud_filter", "audio_conv")
+        elif self.audio2_source:
+            self.graph.link("aud2_filter", "audio_conv")
 
-            logger.debug("Linking Audio")
-            ret = self.audiosrc.link(self.aud_in_queue)
-            logger.debug(" Link audiosrc -> aud_in_queue: %s" % ret)
-            ret = self.aud_in_queue.link(self.aud_caps_filter)
-            logger.debug(" Link aud_in_queue -> aud_caps_filter: %s" % ret)
+        if self.audio_source or self.audio2_source:
+            if self.outputs:
+                self.graph.chain("audio_conv", "audio_tee", "queue_a_main", "audio_encoder", "queue_a_out")
+            else:
+                self.graph.chain("audio_conv", "audio_encoder", "queue_a_out")
+            if self.replay:
+                self.graph.link("queue_a_out", "replay_audio")
+            elif self.segmented:
+                self.graph.link("queue_a_out", "sink", dst_pad="audio_%u")
+            else:
+                self.graph.link("queue_a_out", "muxer")
 
-            # Link first audio source to audio convert
-            ret = self.aud_caps_filter.link(self.audioconv)
-            logger.debug(" Link aud_caps_filter -> audioconv: %s" % ret)
+        if not self.segmented and not self.replay:
+            self.graph.chain("muxer", "queue_file", "sink")
 
-        elif self.audio2_source:
-            # Link second audio source to mixer
-            ret = self.audio2src.link(self.aud2_in_queue)
-            logger.debug(" Link audio2src -> aud2_in_queue: %s" % ret)
-            ret = self.aud2_in_queue.link(self.aud2_caps_filter)
-            logger.debug(" Link aud2_in_queue -> aud2_caps_filter: %s" % ret)
+        for output in self.outputs:
+            output.add_links(self.graph, "video_tee", "audio_tee")
+        for screen in self.screens:
+            screen.add_links(self.graph)
 
-            # Link second audio source to audio convert
-            ret = self.aud2_caps_filter.link(self.audioconv)
-            logger.debug(" Link aud2_caps_filter -> audioconv: %s" % ret)
+    def setup_elements(self):
+        self.videosrc = self.pipeline.get_by_name("video_src")
+        self.audiosrc = self.pipeline.get_by_name("audio_src")
+        self.audio2src = self.pipeline.get_by_name("audio2_src")
+        self.videnc = self.pipeline.get_by_name("video_encoder")
+        self.mux = self.pipeline.get_by_name("muxer")
+        self.sink = self.pipeline.get_by_name("sink")
 
-        if self.audio_source or self.audio2_source:
-            # Link audio to muxer
-            ret = self.audioconv.link(self.audioenc)
-            logger.debug("Link audioconv -> audioenc: %s" % ret)
-            ret = self.audioenc.link(self.aud_out_queue)
-            logger.debug("Link audioenc -> aud_out_queue: %s" % ret)
-            ret = self.aud_out_queue.link(self.mux)
-            logger.debug("Link aud_out_queue -> mux: %s" % ret)
-
-        ret = self.mux.link(self.file_queue)
-        logger.debug("Link mux -> file queue: %s" % ret)
-        ret = self.file_queue.link(self.sink)
-        logger.debug("Link file queue -> sink: %s" % ret)
+        #
+        # Reused pipelines may still carry the offsets of a previous warm start.
+        #
+        for src in self.get_source_elements():
+            src.get_static_pad("src").set_offset(0)
 
-    def start_recording(self):
-        logger.debug("Setting STATE_PLAYING")
+        #
+        # Every capture source with its own XDamage setting, the queue
+        # behind it is where frames are sampled.
+        #
+        self.damage = []
+        if prefs.damage_mode != DAMAGE_OFF and not prefs.test:
+            captures = [(self.videosrc, self.pipeline.get_by_name("queue_v1"))]
+            captures += [(screen.get_source(self.pipeline), self.pipeline.get_by_name(screen.name("queue")))
+                         for screen in self.screens]
+            for (src, queue) in captures:
+                self.damage.append(DamageController(src, queue.get_static_pad("src"),
+                                                    prefs.damage_mode, self.framerate))
+
+        if self.vfr:
+            queue = self.pipeline.get_by_name("queue_v1")
+            self.static_filter = StaticFrameFilter(queue.get_static_pad("src"))
+        else:
+            self.static_filter = None
+
+        if self.replay:
+            if self.replay_buffer is None:
+                self.replay_buffer = ReplayBuffer(prefs.replay_seconds, prefs.replay_megabytes)
+                self.replay_buffer.connect("replay-saved", self.cb_replay_saved)
+            self.replay_buffer.attach(self.pipeline.get_by_name("replay_video"),
+                                      self.pipeline.get_by_name("replay_audio"))
+
+    def get_source_elements(self):
+        sources = [self.videosrc]
+        sources += [screen.get_source(self.pipeline) for screen in self.screens]
+        if self.audio_source:
+            sources.append(self.audiosrc)
+        if self.audio2_source:
+            sources.append(self.audio2src)
+        return sources
+
+    def preroll_recording(self):
+        #
+        # Live sources can't preroll in PAUSED, so we go all the way to PLAYING and
+        # drop everything the sources produce until the countdown is over. Devices are
+        # opened, caps are negotiated and encoders are allocated while the user waits.
+        #
+        logger.debug("Setting STATE_PLAYING - WARM START")
+        for src in self.get_source_elements():
+            pad = src.get_static_pad("src")
+            probe = pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_gate_probe, None)
+            self.gate_probes.append((pad, probe))
         self.pipeline.set_state(Gst.State.PLAYING)
 
+    def cb_gate_probe(self, pad, info, data):
+        return Gst.PadProbeReturn.DROP
+
+    def cb_first_buffer_probe(self, pad, info, data):
+        latency = (time.time() - self.start_time) * 1000
+        logger.debug("Start latency: {0:.1f} ms (warm start: {1})".format(latency, self.warm_start))
+        return Gst.PadProbeReturn.REMOVE
+
+    def start_recording(self):
+        self.start_time = time.time()
+        self.warm_start = len(self.gate_probes) > 0
+        self.videosrc.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER,
+                                                      self.cb_first_buffer_probe,
+                                                      None)
+        for damage in self.damage:
+            damage.start()
+        if self.static_filter:
+            self.static_filter.start()
+        if self.replay:
+            self.replay_buffer.reset()
+        self.timings = [SourceTiming(src, self.framerate) for src in self.get_source_elements()]
+        for timing in self.timings:
+            timing.start()
+        self.stats.start(self.pipeline)
+        self.queue_monitor.start(self.pipeline)
+        if prefs.adaptive_quality or self.limit.enabled():
+            self.adaptive.set_cpu_load(0.0)
+            self.adaptive.start(self.pipeline, "queue_v_main" if self.outputs else "queue_v1")
+        if self.warm_start:
+            #
+            # Shift timestamps so that the recording starts at zero and not
+            # at the time the pipeline went to PLAYING.
+            #
+            logger.debug("Opening source gates")
+            running_time = self.pipeline.get_clock().get_time() - self.pipeline.get_base_time()
+            for (pad, probe) in self.gate_probes:
+                pad.set_offset(-running_time)
+                pad.remove_probe(probe)
+            self.gate_probes = []
+        else:
+            logger.debug("Setting STATE_PLAYING")
+            self.pipeline.set_state(Gst.State.PLAYING)
+
     def pause_recording(self):
         logger.debug("Setting STATE_PAUSED")
         self.pipeline.set_state(Gst.State.PAUSED)
@@ -401,8 +649,125 @@ class Screencast(GObject.GObject):
 
     def stop_recording(self):
         logger.debug("Sending new EOS event")
+        self.stop_time = time.time()
         self.pipeline.send_event(Gst.Event.new_eos())
 
+    def cancel_recording(self):
+        logger.debug("Recording canceled, setting pipeline to READY.")
+        self.pipeline.set_state(Gst.State.READY)
+        for (pad, probe) in self.gate_probes:
+            pad.remove_probe(probe)
+        self.gate_probes = []
+        files = [self.tempfile, self.muxer_tempfile] + self.get_segments()
+        for output in self.outputs + self.screens:
+            files += output.get_files()
+        for fname in files:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        remove_sidecar(self.tempfile)
+
+    def teardown(self):
+        logger.debug("Tearing down the pipeline.")
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.release_bus()
+
+    def attach_bus(self):
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus_watch = self.bus.connect("message", self.on_message)
+        self.priorities.attach(self.bus)
+
+    def release_bus(self):
+        if self.bus_watch is not None:
+            self.bus.disconnect(self.bus_watch)
+            self.bus.remove_signal_watch()
+            self.bus_watch = None
+            self.priorities.detach()
+
+    def get_stats(self):
+        return self.stats.get_snapshot()
+
+    def get_queue_report(self):
+        return self.queue_monitor.get_report()
+
+    def cb_stats_updated(self, stats, snapshot):
+        if self.limit and self.limit.enabled():
+            self.adaptive.set_cpu_load(snapshot["cpu"]["percent"] / self.limit.percent)
+
+    def get_timing_report(self):
+        #
+        # Written next to the recording at the end of a session, queue
+        # high-water marks and quality adjustments go along with the timing.
+        #
+        return {"framerate": self.framerate,
+                "duration": time.time() - self.start_time,
+                "codec": CODEC_LIST[self.codec][2],
+                "sources": [timing.to_dict() for timing in self.timings],
+                "queues": self.get_queue_report(),
+                "quality": self.get_quality_report()}
+
+    def write_timing(self):
+        try:
+            write_sidecar(self.tempfile, self.get_timing_report())
+            logger.debug("Timing report written next to {0}".format(self.tempfile))
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write the timing report: {0}".format(e))
+
+    def get_quality_report(self):
+        return self.adaptive.get_report()
+
+    def get_segments(self):
+        return get_segments(self.tempfile)
+
+    def get_segment_glob(self):
+        #
+        # Segments share codecs and caps, they are joined without decoding
+        # by a finalize job. Until then each one is a playable file.
+        #
+        if self.segmented:
+            return get_segment_glob(self.tempfile)
+        return None
+
+    def get_outputs(self):
+        return [(output.tempfile, output.codec) for output in self.screens + self.outputs]
+
+    def get_muxer(self):
+        return self.mux_factory
+
+    def flush_done(self):
+        if self.stop_time is not None:
+            logger.debug("Stop latency: {0:.1f} ms (codec: {1}, fragmented: {2}, segmented: {3})".format(
+                (time.time() - self.stop_time) * 1000,
+                CODEC_LIST[self.codec][2],
+                prefs.mp4_fragmented,
+                self.segmented))
+            self.stop_time = None
+        logger.debug("Emitting flush-done.")
+        self.emit("flush-done")
+
+    def save_replay(self):
+        if not self.replay:
+            return
+        (fd, fname) = tempfile.mkstemp(prefix="kazam_", dir=prefs.video_dest, suffix=".movie")
+        os.close(fd)
+        logger.debug("Replay status: {0}".format(self.replay_buffer.get_status()))
+        self.replay_buffer.save(fname, self.mux_factory)
+
+    def cb_replay_saved(self, replay_buffer, fname, success):
+        if fname == self.tempfile:
+            # Stopping a replay session keeps the last replay as the recording.
+            self.flush_done()
+        elif success:
+            self.emit("replay-saved", fname)
+        else:
+            os.remove(fname)
+
+    def get_codec(self):
+        return self.codec
+
     def get_tempfile(self):
         return self.tempfile
 
@@ -412,9 +777,36 @@ class Screencast(GObject.GObject):
     def on_message(self, bus, message):
         t = message.type
         if t == Gst.MessageType.EOS:
-            logger.debug("Received EOS, setting pipeline to NULL.")
-            self.pipeline.set_state(Gst.State.NULL)
-            logger.debug("Emitting flush-done.")
-            self.emit("flush-done")
+            logger.debug("Received EOS.")
+            for damage in self.damage:
+                damage.stop()
+            if self.static_filter:
+                self.static_filter.stop()
+            self.stats.stop()
+            self.queue_monitor.stop()
+            self.adaptive.stop()
+            for timing in self.timings:
+                timing.stop()
+            #
+            # Statistics are polled for the last time above, the pipeline
+            # is only stopped once they have it.
+            #
+            logger.debug("Setting pipeline to READY.")
+            self.pipeline.set_state(Gst.State.READY)
+            if prefs.timing_sidecar:
+                self.write_timing()
+            if self.limit.enabled():
+                logger.info("CPU usage: {0:.0f}% on average, {1:.0f}% at peak, limit {2}%.".format(
+                    self.stats.get_snapshot()["cpu"]["average"],
+                    self.stats.get_snapshot()["cpu"]["peak"],
+                    self.limit.percent))
+                for name in self.get_encoder_queues():
+                    self.priorities.check(name)
+            if self.replay:
+                self.replay_buffer.save(self.tempfile, self.mux_factory)
+            else:
+                self.flush_done()
+        elif t == Gst.MessageType.QOS:
+            self.stats.handle_qos(message)
         elif t == Gst.MessageType.ERROR:
             logger.debug("Received an error message: %s", message.parse_error()[1])
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+#
+#       jobs.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import glob
+import json
+import zlib
+import queue
+import shutil
+import signal
+import tempfile
+import struct
+import hashlib
+import logging
+import multiprocessing
+logger = logging.getLogger("Jobs")
+
+from xdg.BaseDirectory import xdg_cache_home
+from gi.repository import GObject, GLib
+
+from kazam.backend.config import KazamConfig
+from kazam.backend.threads import get_available_cpus
+from kazam.backend.timing import move_sidecar
+from kazam.backend.segments import remove_segments
+
+JOBS_FILE = os.path.join(KazamConfig.CONFIGDIR, "jobs.json")
+
+# Message poll interval in milliseconds
+JOBS_INTERVAL = 250
+
+#
+# Workers run niced, on top of being stopped altogether while we capture.
+#
+JOBS_NICE = 10
+
+#
+# Job kinds, lower priority numbers run first. Finalizing is cheap and
+# makes a recording safe, transcoding takes long, thumbnails are a luxury.
+#
+JOB_FINALIZE = "finalize"
+JOB_MOVE = "move"
+JOB_TRANSCODE = "transcode"
+JOB_SPLIT = "split"
+JOB_CHUNK = "chunk"
+JOB_CONCAT = "concat"
+JOB_THUMBNAIL = "thumbnail"
+
+JOB_PRIORITY = {JOB_FINALIZE: 0,
+                JOB_MOVE: 1,
+                JOB_SPLIT: 2,
+                JOB_CONCAT: 2,
+                JOB_TRANSCODE: 2,
+                JOB_CHUNK: 2,
+                JOB_THUMBNAIL: 3,
+                }
+
+#
+# Jobs that run an encoder, they share the cores between them.
+#
+JOB_ENCODERS = (JOB_TRANSCODE, JOB_CHUNK)
+
+#
+# Jobs whose output is named before they run, by suffix. The name is kept
+# in the job, a job that is run again after a restart writes over what it
+# left behind instead of leaving another file.
+#
+JOB_OUTPUTS = {JOB_CHUNK: ".mkv",
+               JOB_CONCAT: ".movie"}
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+
+THUMBNAIL_SIZE = 128
+THUMBNAIL_DIR = os.path.join(xdg_cache_home, "thumbnails", "normal")
+
+
+def make_job(kind, **args):
+    return {"id": None,
+            "kind": kind,
+            "priority": JOB_PRIORITY[kind],
+            "state": JOB_PENDING,
+            "input": None,
+            "args": args,
+            "then": [],
+            "chain": None,
+            "waits": [],
+            "parent": None,
+            }
+
+
+#
+# Everything below runs in the worker processes.
+#
+
+worker_messages = None
+
+
+def init_worker(messages):
+    global worker_messages
+    worker_messages = messages
+    os.nice(JOBS_NICE)
+
+
+def run_job(job):
+    worker_messages.put(("started", job["id"], os.getpid()))
+    try:
+        output = JOB_RUNNERS[job["kind"]](job)
+        worker_messages.put(("done", job["id"], output))
+    except Exception as e:
+        worker_messages.put(("failed", job["id"], str(e)))
+
+
+def run_loop(runner, signal_name):
+    """Runs a GObject based runner in a main loop of its own."""
+    from gi.repository import Gst
+    Gst.init(None)
+    loop = GLib.MainLoop()
+    result = []
+
+    def cb_done(obj, success):
+        result.append(success)
+        loop.quit()
+
+    runner.connect(signal_name, cb_done)
+    return (loop, result)
+
+
+def run_finalize(job):
+    from kazam.backend.remux import Remuxer
+    remuxer = Remuxer(job["args"]["output"], job["args"]["muxer"])
+    (loop, result) = run_loop(remuxer, "remux-done")
+    remuxer.join(job["input"])
+    loop.run()
+    if not result[0]:
+        raise RuntimeError("Unable to join {0}".format(job["input"]))
+
+    remove_segments(job["input"])
+    return job["args"]["output"]
+
+
+def run_transcode(job):
+    from kazam.backend.transcode import Transcoder
+    transcoder = Transcoder(job["input"], job["args"]["codec"], job["args"].get("threads"))
+    (loop, result) = run_loop(transcoder, "transcode-done")
+    transcoder.connect("transcode-progress",
+                       lambda obj, progress: worker_messages.put(("progress", job["id"], progress)))
+    transcoder.start()
+    loop.run()
+    if not result[0]:
+        raise RuntimeError("Unable to transcode {0}".format(job["input"]))
+    os.remove(job["input"])
+    move_sidecar(job["input"], transcoder.output)
+    return transcoder.output
+
+
+def run_split(job):
+    """Finds chunk boundaries for parallel transcoding.
+
+    A key unit seek snaps to the keyframe before each nominal boundary, so
+    every chunk starts on one. Lossless intermediates are all keyframes.
+    """
+    from gi.repository import Gst
+    Gst.init(None)
+
+    playbin = Gst.ElementFactory.make("playbin", None)
+    playbin.set_property("uri", GLib.filename_to_uri(os.path.abspath(job["input"]), None))
+    playbin.set_property("video-sink", Gst.ElementFactory.make("fakesink", None))
+    playbin.set_property("audio-sink", Gst.ElementFactory.make("fakesink", None))
+    playbin.set_state(Gst.State.PAUSED)
+    playbin.get_state(Gst.CLOCK_TIME_NONE)
+
+    (ok, duration) = playbin.query_duration(Gst.Format.TIME)
+    audio = playbin.get_property("n-audio") > 0
+    if not ok:
+        playbin.set_state(Gst.State.NULL)
+        raise RuntimeError("Unable to get duration of {0}".format(job["input"]))
+
+    step = job["args"]["chunk_seconds"] * Gst.SECOND
+    bounds = [0]
+    for nominal in range(step, duration - step // 2, step):
+        playbin.seek_simple(Gst.Format.TIME,
+                            Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_BEFORE,
+                            nominal)
+        playbin.get_state(Gst.CLOCK_TIME_NONE)
+        (ok, position) = playbin.query_position(Gst.Format.TIME)
+        if ok and position > bounds[-1]:
+            bounds.append(position)
+    bounds.append(duration)
+    playbin.set_state(Gst.State.NULL)
+
+    return {"chunks": list(zip(bounds, bounds[1:])), "audio": audio}
+
+
+def run_chunk(job):
+    from kazam.backend.transcode import Transcoder
+    args = job["args"]
+    transcoder = Transcoder(job["input"], args["codec"], args.get("threads"),
+                            streams=("audio",) if args.get("audio") else ("video",),
+                            muxer="matroskamux",
+                            output=args["output"])
+    (loop, result) = run_loop(transcoder, "transcode-done")
+    transcoder.connect("transcode-progress",
+                       lambda obj, progress: worker_messages.put(("progress", job["id"], progress)))
+    transcoder.start(args.get("start"), args.get("stop"))
+    loop.run()
+    if not result[0]:
+        raise RuntimeError("Unable to transcode chunk of {0}".format(job["input"]))
+    return transcoder.output
+
+
+def run_concat(job):
+    """Joins encoded chunks and the audio track without re-encoding."""
+    from gi.repository import Gst
+    from kazam.backend.transcode import TRANSCODE_FORMATS
+    Gst.init(None)
+
+    args = job["args"]
+    videos = [args["outputs"][str(part)] for part in args["videos"]]
+    audio = args["outputs"].get(str(args["audio"]))
+    output = args["output"]
+
+    pipeline = Gst.Pipeline()
+    concat = Gst.ElementFactory.make("concat", None)
+    queue_v = Gst.ElementFactory.make("queue", None)
+    mux = Gst.ElementFactory.make(TRANSCODE_FORMATS[args["codec"]][2], None)
+    sink = Gst.ElementFactory.make("filesink", None)
+    sink.set_property("location", output)
+    for element in (concat, queue_v, mux, sink):
+        pipeline.add(element)
+    concat.link(queue_v)
+    queue_v.link(mux)
+    mux.link(sink)
+
+    def add_demuxer(path, target):
+        src = Gst.ElementFactory.make("filesrc", None)
+        src.set_property("location", path)
+        demux = Gst.ElementFactory.make("matroskademux", None)
+        pipeline.add(src)
+        pipeline.add(demux)
+        src.link(demux)
+        demux.connect("pad-added", lambda element, pad: pad.link(target))
+
+    #
+    # concat plays its sink pads in the order they were requested.
+    #
+    for path in videos:
+        add_demuxer(path, concat.get_request_pad("sink_%u"))
+
+    if audio:
+        queue_a = Gst.ElementFactory.make("queue", None)
+        pipeline.add(queue_a)
+        queue_a.link(mux)
+        add_demuxer(audio, queue_a.get_static_pad("sink"))
+
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        os.remove(output)
+        raise RuntimeError(message.parse_error()[1])
+
+    for path in videos + ([audio] if audio else []) + [job["input"]]:
+        os.remove(path)
+    move_sidecar(job["input"], output)
+    return output
+
+
+def run_move(job):
+    from kazam.utils import get_next_filename
+    dest = get_next_filename(job["args"]["dir"], job["args"]["name"], job["args"]["ext"])
+    shutil.move(job["input"], dest)
+    move_sidecar(job["input"], dest)
+    return dest
+
+
+def run_thumbnail(job):
+    """Writes a freedesktop.org thumbnail, so that file managers don't
+    have to decode the recording to show one."""
+    from gi.repository import Gst
+    Gst.init(None)
+
+    path = os.path.abspath(job["input"])
+    uri = GLib.filename_to_uri(path, None)
+    thumbnail = os.path.join(THUMBNAIL_DIR, "{0}.png".format(hashlib.md5(uri.encode("utf-8")).hexdigest()))
+    if not os.path.isdir(THUMBNAIL_DIR):
+        os.makedirs(THUMBNAIL_DIR)
+
+    pipeline = Gst.parse_launch("filesrc name=src ! decodebin ! videoconvert ! videoscale ! "
+                                "video/x-raw, width={0}, pixel-aspect-ratio=1/1 ! "
+                                "pngenc snapshot=true ! filesink name=sink".format(THUMBNAIL_SIZE))
+    pipeline.get_by_name("src").set_property("location", path)
+    pipeline.get_by_name("sink").set_property("location", thumbnail)
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        raise RuntimeError(message.parse_error()[1])
+
+    add_png_text(thumbnail, {"Thumb::URI": uri,
+                             "Thumb::MTime": str(int(os.stat(path).st_mtime)),
+                             "Software": "Kazam"})
+    return job["input"]
+
+
+def add_png_text(fname, text):
+    """Inserts tEXt chunks right after the PNG header chunk."""
+    with open(fname, "rb") as f:
+        data = f.read()
+    # 8 bytes of signature, IHDR is always 13 bytes of data plus 12 of framing.
+    pos = 8 + 25
+    chunks = b""
+    for (key, value) in text.items():
+        body = b"tEXt" + key.encode("latin-1") + b"\0" + value.encode("latin-1", "replace")
+        chunks += struct.pack(">I", len(body) - 4) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+    with open(fname, "wb") as f:
+        f.write(data[:pos] + chunks + data[pos:])
+
+
+JOB_RUNNERS = {JOB_FINALIZE: run_finalize,
+               JOB_MOVE: run_move,
+               JOB_TRANSCODE: run_transcode,
+               JOB_SPLIT: run_split,
+               JOB_CHUNK: run_chunk,
+               JOB_CONCAT: run_concat,
+               JOB_THUMBNAIL: run_thumbnail,
+               }
+
+
+class JobQueue(GObject.GObject):
+    """Persistent queue of post-processing jobs.
+
+    Jobs come in chains, every job gets the output of the one before as its
+    input. When a chain is done, chain-done carries the resulting file, its
+    codec and whether it should be offered for saving. Jobs run in a pool
+    of spawned processes, they are written to JOBS_FILE whenever something
+    changes and picked up again on the next start.
+
+    While a capture is running the queue is suspended, running workers are
+    stopped with SIGSTOP and nothing new is started.
+
+    A split job fans out into chunk jobs that run in parallel and a concat
+    job that waits for all of them and carries the chain on.
+    """
+    __gsignals__ = {"jobs-progress": (GObject.SIGNAL_RUN_LAST,
+                                      None,
+                                      [GObject.TYPE_INT, GObject.TYPE_FLOAT],),
+                    "chain-done": (GObject.SIGNAL_RUN_LAST,
+                                   None,
+                                   [GObject.TYPE_STRING, GObject.TYPE_INT, GObject.TYPE_BOOLEAN],),
+                    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.size = max(1, get_available_cpus() - 1)
+        self.context = multiprocessing.get_context("spawn")
+        self.messages = None
+        self.pool = None
+        self.timer = None
+        self.suspended = False
+        self.pids = {}
+        self.progress = {}
+        self.jobs = self.load()
+        self.next_id = max([job["id"] for job in self.jobs] + [0]) + 1
+
+    def load(self):
+        try:
+            with open(JOBS_FILE) as f:
+                jobs = json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+        for job in jobs:
+            job["state"] = JOB_PENDING
+        if jobs:
+            logger.debug("Resuming {0} job(s).".format(len(jobs)))
+        return jobs
+
+    def save(self):
+        try:
+            with open(JOBS_FILE, "w") as f:
+                json.dump(self.jobs, f, indent=1)
+        except (IOError, OSError):
+            logger.warning("Unable to write {0}".format(JOBS_FILE))
+
+    def submit(self, fname, jobs, codec, offer):
+        chain = {"codec": codec, "offer": offer}
+        first = jobs[0]
+        first["input"] = fname
+        first["then"] = jobs[1:]
+        first["chain"] = chain
+        self.add(first)
+
+    def add(self, job, dispatch=True):
+        job["id"] = self.next_id
+        self.next_id += 1
+        self.jobs.append(job)
+        logger.debug("Job {0}: {1} {2}".format(job["id"], job["kind"], job["input"]))
+        if dispatch:
+            self.save()
+            self.dispatch()
+
+    def start(self):
+        if self.jobs:
+            self.dispatch()
+
+    def dispatch(self):
+        if self.suspended:
+            return
+        if self.pool is None:
+            self.messages = self.context.Queue()
+            self.pool = self.context.Pool(self.size, initializer=init_worker, initargs=(self.messages,))
+        if self.timer is None:
+            self.timer = GLib.timeout_add(JOBS_INTERVAL, self.cb_poll)
+
+        queued = set(job["id"] for job in self.jobs)
+        running = len([job for job in self.jobs if job["state"] == JOB_RUNNING])
+        for job in sorted(self.jobs, key=lambda job: (job["priority"], job["id"])):
+            if running >= self.size:
+                break
+            if job["state"] != JOB_PENDING or queued.intersection(job["waits"]):
+                continue
+            if job["kind"] in JOB_ENCODERS:
+                job["args"]["threads"] = max(1, get_available_cpus() // self.size)
+            if job["kind"] in JOB_OUTPUTS and not job["args"].get("output"):
+                (fd, job["args"]["output"]) = tempfile.mkstemp(prefix="kazam_",
+                                                               dir=os.path.dirname(job["input"]),
+                                                               suffix=JOB_OUTPUTS[job["kind"]])
+                os.close(fd)
+            job["state"] = JOB_RUNNING
+            running += 1
+            self.pool.apply_async(run_job, (job,))
+        self.save()
+
+    def suspend(self):
+        logger.debug("Suspending {0} running job(s).".format(len(self.pids)))
+        self.suspended = True
+        for pid in self.pids.values():
+            os.kill(pid, signal.SIGSTOP)
+
+    def resume(self):
+        logger.debug("Resuming {0} running job(s).".format(len(self.pids)))
+        self.suspended = False
+        for pid in self.pids.values():
+            os.kill(pid, signal.SIGCONT)
+        if self.jobs:
+            self.dispatch()
+
+    def shutdown(self):
+        if self.pool is not None:
+            for pid in self.pids.values():
+                os.kill(pid, signal.SIGCONT)
+            self.pool.terminate()
+            self.pool = None
+        self.save()
+
+    def get_files(self):
+        """Returns the files (and segment globs) queued jobs still need."""
+        files = set()
+        for job in self.jobs:
+            files.add(job["input"])
+            if job["args"].get("output"):
+                files.add(job["args"]["output"])
+        return files
+
+    def get_job(self, job_id):
+        for job in self.jobs:
+            if job["id"] == job_id:
+                return job
+        return None
+
+    def cb_poll(self):
+        while True:
+            try:
+                (what, job_id, value) = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            job = self.get_job(job_id)
+            if job is None:
+                continue
+            if what == "started":
+                self.pids[job_id] = value
+                if self.suspended:
+                    os.kill(value, signal.SIGSTOP)
+            elif what == "progress":
+                self.progress[job_id] = value
+            elif what == "done":
+                self.job_done(job, value)
+            elif what == "failed":
+                logger.warning("Job {0} ({1}) failed: {2}".format(job_id, job["kind"], value))
+                self.job_failed(job)
+
+        if self.jobs:
+            running = [job["id"] for job in self.jobs if job["state"] == JOB_RUNNING]
+            progress = sum(self.progress.get(job_id, 0.0) for job_id in running) / max(len(running), 1)
+            self.emit("jobs-progress", len(self.jobs), progress)
+            return True
+
+        self.emit("jobs-progress", 0, 1.0)
+        self.timer = None
+        return False
+
+    def remove(self, job):
+        self.jobs.remove(job)
+        self.pids.pop(job["id"], None)
+        self.progress.pop(job["id"], None)
+
+    def job_done(self, job, output):
+        logger.debug("Job {0} ({1}) done: {2}".format(job["id"], job["kind"], output))
+        self.remove(job)
+        chain = job["chain"]
+        if job["kind"] in (JOB_TRANSCODE, JOB_CONCAT):
+            chain["codec"] = job["args"]["codec"]
+
+        if job["kind"] == JOB_SPLIT:
+            self.split(job, output)
+        elif job["kind"] == JOB_CHUNK:
+            parent = self.get_job(job["parent"])
+            if parent is None:
+                os.remove(output)
+            else:
+                parent["args"]["outputs"][str(job["id"])] = output
+                self.save()
+                self.dispatch()
+        else:
+            self.next_job(job, output)
+
+    def split(self, job, result):
+        codec = job["args"]["codec"]
+        chunks = result["chunks"]
+        if len(chunks) < 2:
+            job["then"].insert(0, make_job(JOB_TRANSCODE, codec=codec))
+            self.next_job(job, job["input"])
+            return
+
+        logger.debug("Transcoding {0} in {1} chunk(s).".format(job["input"], len(chunks)))
+        concat = make_job(JOB_CONCAT, codec=codec, videos=[], audio=None, outputs={})
+        concat["input"] = job["input"]
+        concat["then"] = job["then"]
+        concat["chain"] = job["chain"]
+        self.add(concat, dispatch=False)
+
+        parts = [make_job(JOB_CHUNK, codec=codec, start=start, stop=stop) for (start, stop) in chunks]
+        if result["audio"]:
+            parts.append(make_job(JOB_CHUNK, codec=codec, audio=True))
+        for part in parts:
+            part["input"] = job["input"]
+            part["chain"] = job["chain"]
+            part["parent"] = concat["id"]
+            self.add(part, dispatch=False)
+
+        concat["args"]["videos"] = [part["id"] for part in parts if not part["args"].get("audio")]
+        if result["audio"]:
+            concat["args"]["audio"] = parts[-1]["id"]
+        concat["waits"] = [part["id"] for part in parts]
+        self.save()
+        self.dispatch()
+
+    def job_failed(self, job):
+        self.remove(job)
+        if job["kind"] == JOB_THUMBNAIL:
+            self.next_job(job, job["input"])
+        elif job["kind"] == JOB_CHUNK:
+            #
+            # Drop the whole group and transcode the usual way. Chunks that
+            # are still running are cleaned up when they finish.
+            #
+            parent = self.get_job(job["parent"])
+            if parent is None:
+                return
+            for sibling in [j for j in self.jobs if j["parent"] == parent["id"]]:
+                if sibling["state"] == JOB_PENDING:
+                    self.remove(sibling)
+            for path in parent["args"]["outputs"].values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.remove(parent)
+            parent["then"].insert(0, make_job(JOB_TRANSCODE, codec=parent["args"]["codec"]))
+            self.next_job(parent, parent["input"])
+        elif job["kind"] == JOB_FINALIZE:
+            #
+            # Input is a glob, not a file. Every segment is playable on its
+            # own, so they are kept and offered one by one, the half joined
+            # output is of no use.
+            #
+            segments = sorted(glob.glob(job["input"]))
+            logger.warning("Unable to join {0} segment(s), offering them separately.".format(len(segments)))
+            try:
+                os.remove(job["args"]["output"])
+            except OSError:
+                pass
+            for segment in segments:
+                self.emit("chain-done", segment, job["chain"]["codec"], True)
+            self.save()
+            self.dispatch()
+        else:
+            #
+            # Whatever we have so far is better than nothing, offer it even
+            # if it was meant to be autosaved.
+            #
+            self.emit("chain-done", job["input"], job["chain"]["codec"], True)
+            self.save()
+            self.dispatch()
+
+    def next_job(self, job, output):
+        if job["then"]:
+            follow = job["then"][0]
+            follow["input"] = output
+            follow["then"] = job["then"][1:]
+            follow["chain"] = job["chain"]
+            self.add(follow)
+        else:
+            self.emit("chain-done", output, job["chain"]["codec"], job["chain"]["offer"])
+            self.save()
+            self.dispatch()
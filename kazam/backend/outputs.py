@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+#       outputs.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import logging
+import tempfile
+logger = logging.getLogger("Outputs")
+
+from gi.repository import Gst
+
+from kazam.backend.prefs import *
+from kazam.backend.queues import QUEUE_OVERRUN, get_queue_props
+from kazam.backend.geometry import get_region, get_scaled_size
+from kazam.backend.encoders import get_encoder_props
+
+#
+# Video encoder, audio encoder and muxer of extra outputs. Video encoders
+# use the same encoder profile as the main recording, these have to keep
+# up with the capture too.
+#
+OUTPUT_FORMATS = {
+    CODEC_RAW: (None,
+                ("lamemp3enc", {"quality": 0}),
+                "avimux"),
+    CODEC_VP8: ("vp8enc",
+                ("vorbisenc", {"quality": 1}),
+                "webmmux"),
+    CODEC_H264: ("x264enc",
+                 ("lamemp3enc", {"quality": 0}),
+                 "mp4mux"),
+    CODEC_HUFF: ("avenc_huffyuv",
+                 ("lamemp3enc", {"quality": 0}),
+                 "avimux"),
+    CODEC_JPEG: ("avenc_ljpeg",
+                 ("lamemp3enc", {"quality": 0}),
+                 "avimux"),
+}
+
+#
+# Video branch queues drop their oldest frames instead of blocking the tee,
+# a branch that can't keep up loses frames but never stalls the others.
+# They hold raw video, so the byte limit is what counts at large sizes.
+# Audio is cheap to encode and a gap in it is heard, audio branch queues
+# are generous and block. Queue profiles can override these for
+# "queue_branch" and "queue_branch_audio".
+#
+BRANCH_QUEUE = {"max-size-buffers": 0,
+                "max-size-bytes": 256 * 1024 * 1024,
+                "max-size-time": 2 * Gst.SECOND,
+                "leaky": QUEUE_OVERRUN["drop-old"]}
+
+BRANCH_AUDIO_QUEUE = {"max-size-buffers": 0,
+                      "max-size-bytes": 0,
+                      "max-size-time": 5 * Gst.SECOND,
+                      "leaky": QUEUE_OVERRUN["block"]}
+
+
+def get_mp4mux_props(muxer_tempfile):
+    """Returns mp4mux properties and volatile properties for a recording.
+
+    Fragmented files carry an index with every fragment and survive a crash,
+    at EOS mp4mux only writes out the last one instead of rewriting the
+    whole file. Otherwise the index is moved to the front at EOS.
+    """
+    if prefs.mp4_fragmented:
+        return ({"fragment-duration": prefs.mp4_fragment_duration,
+                 "streamable": 1}, None)
+    return ({"faststart": 1,
+             "streamable": 1}, {"faststart-file": muxer_tempfile})
+
+
+def parse_outputs(value):
+    """Parses the extra_outputs preference.
+
+    Outputs are separated by semicolons, each one is codec:size:framerate.
+    Size is WIDTHxHEIGHT or xHEIGHT (width follows the aspect ratio), empty
+    size or framerate keep those of the capture. "3;2:x720:15" is a HUFFYUV
+    copy and a 720p, 15 fps H264 proxy.
+    """
+    outputs = []
+    for entry in value.split(";"):
+        if not entry.strip():
+            continue
+        fields = (entry.split(":") + ["", ""])[:3]
+        try:
+            codec = int(fields[0])
+            (width, height) = (0, 0)
+            if fields[1].strip():
+                (w, h) = fields[1].lower().split("x")
+                (width, height) = (int(w or 0), int(h))
+            framerate = float(fields[2]) if fields[2].strip() else 0
+        except ValueError:
+            logger.warning("Invalid output: {0}".format(entry))
+            continue
+        if codec not in OUTPUT_FORMATS:
+            logger.warning("Unknown codec in output: {0}".format(entry))
+            continue
+        outputs.append({"codec": codec, "width": width, "height": height, "framerate": framerate})
+    return outputs
+
+
+class OutputBranch(object):
+    """One extra output of a recording, fed from the tees after colour conversion.
+
+    Scales and drops frames as needed, encodes and muxes into a file of its own.
+    Nodes are named after the branch index, so that an unchanged branch
+    survives pipeline updates between takes.
+    """
+    def __init__(self, index, codec, width, height, framerate):
+        self.index = index
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.tempfile = None
+        self.muxer_tempfile = None
+
+    def name(self, node):
+        return "out{0}_{1}".format(self.index, node)
+
+    def new_take(self):
+        (fd, self.tempfile) = tempfile.mkstemp(prefix="kazam_", dir=prefs.video_dest, suffix=".movie")
+        os.close(fd)
+        self.muxer_tempfile = "{0}.mux".format(self.tempfile)
+
+    def get_size(self, src_width, src_height):
+        (width, height) = (self.width, self.height)
+        if not height:
+            (width, height) = (src_width, src_height)
+        elif not width:
+            width = int(round(float(src_width) * height / src_height))
+        if self.codec == CODEC_H264:
+            (width, height) = (width - width % 2, height - height % 2)
+        return (width, height)
+
+    def get_video_queue_props(self):
+        return dict(BRANCH_QUEUE, **get_queue_props("queue_branch"))
+
+    def add_nodes(self, graph, src_width, src_height, framerate, threads, audio, profile=None):
+        (video, audio_enc, muxer) = OUTPUT_FORMATS[self.codec]
+
+        graph.add(self.name("queue"), "queue", self.get_video_queue_props())
+        self.video = [self.name("queue")]
+
+        (width, height) = self.get_size(src_width, src_height)
+        if (width, height) != (src_width, src_height):
+            logger.debug("Output {0}: scaling to {1}x{2}".format(self.index, width, height))
+            graph.add(self.name("scale"), "videoscale")
+            graph.add(self.name("size"), "capsfilter",
+                      {"caps": "video/x-raw, width={0}, height={1}".format(width, height)})
+            self.video += [self.name("scale"), self.name("size")]
+
+        if self.framerate and self.framerate < framerate:
+            logger.debug("Output {0}: {1} fps".format(self.index, self.framerate))
+            graph.add(self.name("rate"), "videorate", {"drop-only": True})
+            graph.add(self.name("fps"), "capsfilter",
+                      {"caps": "video/x-raw, framerate={0}/1".format(int(self.framerate))})
+            self.video += [self.name("rate"), self.name("fps")]
+
+        graph.add(self.name("convert"), "videoconvert")
+        self.video.append(self.name("convert"))
+
+        factory = video
+        if factory:
+            props = get_encoder_props(factory, profile)
+            if factory in ("vp8enc", "x264enc"):
+                props["threads"] = threads
+            graph.add(self.name("encoder"), factory, props)
+            self.video.append(self.name("encoder"))
+
+        self.audio = []
+        if audio:
+            (factory, props) = audio_enc
+            graph.add(self.name("audio_queue"), "queue",
+                      dict(BRANCH_AUDIO_QUEUE, **get_queue_props("queue_branch_audio")))
+            graph.add(self.name("audio_convert"), "audioconvert")
+            graph.add(self.name("audio_encoder"), factory, props)
+            self.audio = [self.name("audio_queue"), self.name("audio_convert"), self.name("audio_encoder")]
+
+        if muxer == "mp4mux":
+            (props, volatile) = get_mp4mux_props(self.muxer_tempfile)
+            graph.add(self.name("muxer"), muxer, props, volatile=volatile)
+        else:
+            graph.add(self.name("muxer"), muxer)
+        graph.add(self.name("sink"), "filesink", volatile={"location": self.tempfile})
+
+    def add_links(self, graph, video_tee, audio_tee):
+        graph.link(video_tee, self.video[0])
+        graph.chain(*(self.video + [self.name("muxer"), self.name("sink")]))
+        if self.audio:
+            graph.link(audio_tee, self.audio[0])
+            graph.chain(*(self.audio + [self.name("muxer")]))
+
+    def get_files(self):
+        return [self.tempfile, self.muxer_tempfile]
+
+
+class ScreenBranch(OutputBranch):
+    """Captures one more monitor into a file of its own.
+
+    Used when all screens are recorded, every monitor gets a source and an
+    encoder of its own instead of one huge frame going through a single
+    encoder. Branches share the pipeline clock, so their timestamps line up
+    with the main recording. As in the main recording a queue sits right
+    behind the source, the capture thread does nothing else, and XDamage is
+    driven per screen by the recorder. Screens are always recorded at a
+    constant framerate, static frames are only dropped from the main one.
+    """
+    def __init__(self, index, codec, screen, framerate):
+        OutputBranch.__init__(self, index, codec, 0, 0, 0)
+        self.screen = screen
+        self.capture_framerate = framerate
+
+    def name(self, node):
+        return "screen{0}_{1}".format(self.index, node)
+
+    def get_video_queue_props(self):
+        #
+        # This is the only capture path of the screen, not a copy hanging
+        # off a tee. It queues like the main recording does.
+        #
+        return get_queue_props("queue_v1")
+
+    def add_nodes(self, graph, threads, audio=False, profile=None):
+        align = self.codec == CODEC_H264
+        (x, y, width, height) = get_region(self.screen["x"], self.screen["y"],
+                                           self.screen["width"], self.screen["height"], align=align)
+        try:
+            (self.width, self.height) = get_scaled_size(width, height, prefs.output_scale, align)
+        except ValueError:
+            (self.width, self.height) = (width, height)
+        logger.debug("Screen {0}: {1}x{2}+{3}+{4}".format(self.index, width, height, x, y))
+
+        if prefs.test:
+            graph.add(self.name("src"), "videotestsrc", {"pattern": "ball", "is-live": True})
+        else:
+            graph.add(self.name("src"), "ximagesrc", {"startx": x,
+                                                      "starty": y,
+                                                      "endx": x + width - 1,
+                                                      "endy": y + height - 1,
+                                                      "use-damage": prefs.damage_mode != DAMAGE_OFF,
+                                                      "show-pointer": prefs.capture_cursor})
+        OutputBranch.add_nodes(self, graph, width, height, self.capture_framerate, threads, False, profile)
+        graph.add(self.name("src_rate"), "videorate")
+        graph.add(self.name("src_fps"), "capsfilter",
+                  {"caps": "video/x-raw, framerate={0}/1".format(int(self.capture_framerate))})
+        self.video[1:1] = [self.name("src_rate"), self.name("src_fps")]
+
+    def add_links(self, graph, video_tee=None, audio_tee=None):
+        OutputBranch.add_links(self, graph, self.name("src"), None)
+
+    def get_source(self, pipeline):
+        return pipeline.get_by_name(self.name("src"))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+#       pipeline.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger("Pipeline")
+
+from collections import OrderedDict
+
+from gi.repository import Gst
+
+
+class Node(object):
+    """A single element in a pipeline description.
+
+    Properties in props are compared when a pipeline is updated, only those
+    that changed are set again. Volatile properties (file locations and
+    such) change on every recording, they are set every time.
+    """
+    def __init__(self, name, factory, props=None, volatile=None):
+        self.name = name
+        self.factory = factory
+        self.props = props or {}
+        self.volatile = volatile or {}
+
+
+class PipelineGraph(object):
+    """Declarative description of a GStreamer pipeline.
+
+    Nodes are added by name and then linked together by name. Linking code
+    doesn't care what is on either side, adding a tee, a preview branch or
+    an extra sink is a matter of adding nodes and links.
+    """
+    def __init__(self):
+        self.nodes = OrderedDict()
+        self.links = []
+
+    def add(self, name, factory, props=None, volatile=None):
+        self.nodes[name] = Node(name, factory, props, volatile)
+        return self.nodes[name]
+
+    def has(self, name):
+        return name in self.nodes
+
+    def link(self, src, dst, src_pad=None, dst_pad=None):
+        self.links.append((src, dst, src_pad, dst_pad))
+
+    def chain(self, *names):
+        for (src, dst) in zip(names, names[1:]):
+            self.link(src, dst)
+
+
+def set_properties(element, props):
+    for (prop, value) in props.items():
+        if prop == "caps" and isinstance(value, str):
+            value = Gst.caps_from_string(value)
+        element.set_property(prop, value)
+
+
+def make_element(node):
+    element = Gst.ElementFactory.make(node.factory, node.name)
+    if element is None:
+        raise RuntimeError("Unable to create {0} element ({1}).".format(node.name, node.factory))
+    set_properties(element, node.props)
+    return element
+
+
+def link_elements(pipeline, link):
+    (src, dst, src_pad, dst_pad) = link
+    src_el = pipeline.get_by_name(src)
+    dst_el = pipeline.get_by_name(dst)
+    if src_pad or dst_pad:
+        ret = src_el.link_pads(src_pad, dst_el, dst_pad)
+    else:
+        ret = src_el.link(dst_el)
+    logger.debug(" Link {0} -> {1}: {2}".format(src, dst, ret))
+    return ret
+
+
+def unlink_elements(pipeline, link):
+    #
+    # Element.unlink() also releases request pads on both sides, which is
+    # what we want for muxers, tees and mixers.
+    #
+    (src, dst, src_pad, dst_pad) = link
+    pipeline.get_by_name(src).unlink(pipeline.get_by_name(dst))
+    logger.debug(" Unlink {0} -> {1}".format(src, dst))
+
+
+class PipelineBuilder(object):
+    """Builds pipelines from descriptions.
+
+    Pipelines are not kept around, whoever built one keeps it and turns it
+    into the next one with update(), only the parts that changed are rebuilt.
+    """
+    def build(self, graph):
+        logger.debug("Building new pipeline.")
+        pipeline = Gst.Pipeline()
+        for node in graph.nodes.values():
+            pipeline.add(make_element(node))
+        for link in graph.links:
+            link_elements(pipeline, link)
+
+        for node in graph.nodes.values():
+            set_properties(pipeline.get_by_name(node.name), node.volatile)
+
+        return pipeline
+
+    def update(self, pipeline, old, new):
+        """Turn a pipeline built from old graph into the one described by new.
+
+        Only elements whose factory changed (or that are new) are rebuilt,
+        elements that are kept just get their changed properties set.
+        The pipeline has to be in the NULL or READY state.
+
+        Returns a tuple of rebuilt and retuned element counts.
+        """
+        replaced = set(name for (name, node) in old.nodes.items()
+                       if name not in new.nodes or new.nodes[name].factory != node.factory)
+        added = set(name for (name, node) in new.nodes.items()
+                    if name not in old.nodes or name in replaced)
+
+        for link in old.links:
+            if link[0] in replaced or link[1] in replaced or link not in new.links:
+                unlink_elements(pipeline, link)
+
+        for name in replaced:
+            element = pipeline.get_by_name(name)
+            element.set_state(Gst.State.NULL)
+            pipeline.remove(element)
+
+        retuned = 0
+        for (name, node) in new.nodes.items():
+            if name in added:
+                element = make_element(node)
+                pipeline.add(element)
+                element.sync_state_with_parent()
+                continue
+
+            element = pipeline.get_by_name(name)
+            old_props = old.nodes[name].props
+            changed = dict((prop, value) for (prop, value) in node.props.items()
+                           if prop not in old_props or old_props[prop] != value)
+            for prop in old_props:
+                if prop not in node.props:
+                    changed[prop] = element.find_property(prop).default_value
+            if changed:
+                logger.debug(" Retuning {0}: {1}".format(name, ", ".join(sorted(changed))))
+                set_properties(element, changed)
+                retuned += 1
+
+        for link in new.links:
+            if link[0] in added or link[1] in added or link not in old.links:
+                link_elements(pipeline, link)
+
+        for node in new.nodes.values():
+            set_properties(pipeline.get_by_name(node.name), node.volatile)
+
+        logger.debug("Pipeline updated, {0} element(s) rebuilt, {1} retuned.".format(len(added), retuned))
+        return (len(added), retuned)
@@ -66,6 +66,7 @@ class Prefs():
 
         self.countdown_splash = True
         self.silent_start = False
+        self.warm_start = True
 
         #
         # Other stuff
@@ -78,6 +79,30 @@ class Prefs():
         self.codec = None
         self.pa_q = None
         self.framerate = 15
+        self.damage_mode = 0
+        self.vfr_codecs = []
+        self.queue_profile = "default"
+        self.segment_mode = False
+        self.segment_seconds = 60
+        self.segment_megabytes = 0
+        self.mp4_fragmented = False
+        self.mp4_fragment_duration = 1000
+        self.two_stage = False
+        self.two_stage_codec = 3
+        self.transcode_chunk_seconds = 60
+        self.replay_mode = False
+        self.replay_seconds = 30
+        self.replay_megabytes = 256
+        self.extra_outputs = ""
+        self.output_scale = ""
+        self.scale_method = "bilinear"
+        self.split_screens = False
+        self.encoder_profile = "balanced"
+        self.calibration = ""
+        self.adaptive_quality = False
+        self.cpu_limit = 0
+        self.thread_priorities = False
+        self.timing_sidecar = False
         self.autosave_video = False
         self.autosave_video_dir = None
         self.autosave_video_file = None
@@ -208,6 +233,30 @@ class Prefs():
         if self.countdown_timer > 10:
             self.countdown_timer = 10
         self.framerate = float(self.config.get("main", "framerate"))
+        self.damage_mode = int(self.config.get("main", "damage_mode"))
+        self.vfr_codecs = [int(c) for c in self.config.get("main", "vfr_codecs").split(",") if c.strip()]
+        self.queue_profile = self.config.get("main", "queue_profile")
+        self.segment_mode = self.config.getboolean("main", "segment_mode")
+        self.segment_seconds = int(self.config.get("main", "segment_seconds"))
+        self.segment_megabytes = int(self.config.get("main", "segment_megabytes"))
+        self.mp4_fragmented = self.config.getboolean("main", "mp4_fragmented")
+        self.mp4_fragment_duration = int(self.config.get("main", "mp4_fragment_duration"))
+        self.two_stage = self.config.getboolean("main", "two_stage")
+        self.two_stage_codec = int(self.config.get("main", "two_stage_codec"))
+        self.transcode_chunk_seconds = int(self.config.get("main", "transcode_chunk_seconds"))
+        self.replay_mode = self.config.getboolean("main", "replay_mode")
+        self.replay_seconds = int(self.config.get("main", "replay_seconds"))
+        self.replay_megabytes = int(self.config.get("main", "replay_megabytes"))
+        self.extra_outputs = self.config.get("main", "extra_outputs")
+        self.output_scale = self.config.get("main", "output_scale")
+        self.scale_method = self.config.get("main", "scale_method")
+        self.split_screens = self.config.getboolean("main", "split_screens")
+        self.encoder_profile = self.config.get("main", "encoder_profile")
+        self.calibration = self.config.get("main", "calibration")
+        self.adaptive_quality = self.config.getboolean("main", "adaptive_quality")
+        self.cpu_limit = int(self.config.get("main", "cpu_limit"))
+        self.thread_priorities = self.config.getboolean("main", "thread_priorities")
+        self.timing_sidecar = self.config.getboolean("main", "timing_sidecar")
 
         self.capture_cursor = self.config.getboolean("main", "capture_cursor")
         self.capture_microphone = self.config.getboolean("main", "capture_microphone")
@@ -217,6 +266,7 @@ class Prefs():
         self.capture_borders_pic = self.config.getboolean("main", "capture_borders_pic")
 
         self.countdown_splash = self.config.getboolean("main", "countdown_splash")
+        self.warm_start = self.config.getboolean("main", "warm_start")
 
         self.autosave_video = self.config.getboolean("main", "autosave_video")
         self.autosave_video_dir = self.config.get("main", "autosave_video_dir")
@@ -269,8 +319,33 @@ class Prefs():
 
         self.config.set("main", "countdown_splash", self.countdown_splash)
         self.config.set("main", "counter", self.countdown_timer)
+        self.config.set("main", "warm_start", self.warm_start)
         self.config.set("main", "codec", self.codec)
         self.config.set("main", "framerate", self.framerate)
+        self.config.set("main", "damage_mode", self.damage_mode)
+        self.config.set("main", "vfr_codecs", ",".join(str(c) for c in self.vfr_codecs))
+        self.config.set("main", "queue_profile", self.queue_profile)
+        self.config.set("main", "segment_mode", self.segment_mode)
+        self.config.set("main", "segment_seconds", self.segment_seconds)
+        self.config.set("main", "segment_megabytes", self.segment_megabytes)
+        self.config.set("main", "mp4_fragmented", self.mp4_fragmented)
+        self.config.set("main", "mp4_fragment_duration", self.mp4_fragment_duration)
+        self.config.set("main", "two_stage", self.two_stage)
+        self.config.set("main", "two_stage_codec", self.two_stage_codec)
+        self.config.set("main", "transcode_chunk_seconds", self.transcode_chunk_seconds)
+        self.config.set("main", "replay_mode", self.replay_mode)
+        self.config.set("main", "replay_seconds", self.replay_seconds)
+        self.config.set("main", "replay_megabytes", self.replay_megabytes)
+        self.config.set("main", "extra_outputs", self.extra_outputs)
+        self.config.set("main", "output_scale", self.output_scale)
+        self.config.set("main", "scale_method", self.scale_method)
+        self.config.set("main", "split_screens", self.split_screens)
+        self.config.set("main", "encoder_profile", self.encoder_profile)
+        self.config.set("main", "calibration", self.calibration)
+        self.config.set("main", "adaptive_quality", self.adaptive_quality)
+        self.config.set("main", "cpu_limit", self.cpu_limit)
+        self.config.set("main", "thread_priorities", self.thread_priorities)
+        self.config.set("main", "timing_sidecar", self.timing_sidecar)
         self.config.set("main", "autosave_video", self.autosave_video)
         self.config.set("main", "autosave_video_dir", self.autosave_video_dir)
         self.config.set("main", "autosave_video_file", self.autosave_video_file)
@@ -397,6 +472,11 @@ CODEC_LIST = [[0, None, 'RAW (AVI)', '.avi', True],
               [4, 'avenc_ljpeg', 'Lossless JPEG (AVI)', '.avi', True],
               ]
 
+# XDamage capture modes
+DAMAGE_OFF = 0
+DAMAGE_ON = 1
+DAMAGE_ADAPTIVE = 2
+
 # PulseAudio Error Codes
 PA_LOAD_ERROR = 1
 PA_GET_STATE_ERROR = 2
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+#       priority.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import logging
+import threading
+logger = logging.getLogger("Priority")
+
+from gi.repository import GLib, Gst
+
+from kazam.backend.threads import get_nice_floor, get_thread_nice
+
+#
+# Capture threads run a little ahead of the rest of Kazam, where we are
+# allowed to (CAP_SYS_NICE or RLIMIT_NICE), encoders behind the queues in
+# front of them a little behind. A late encoder only makes the queue grow,
+# a late capture thread is a missed or uneven frame.
+#
+CAPTURE_PRIORITY = (-5, getattr(os, "SCHED_OTHER", None))
+ENCODER_PRIORITY = (5, getattr(os, "SCHED_OTHER", None))
+
+POLICY_NAMES = dict((getattr(os, name), name) for name in ("SCHED_OTHER", "SCHED_BATCH", "SCHED_IDLE")
+                    if hasattr(os, name))
+
+
+class ThreadPriorities(object):
+    """Sets the priority of pipeline streaming threads by the element that owns them.
+
+    Streaming threads announce themselves with a stream-status message that
+    is delivered synchronously, from the thread itself, so it can be reniced
+    right there. Threads an encoder starts later on inherit its priority.
+    Nice values are relative to the rest of Kazam.
+
+    Streaming threads are pooled and reused, and without privileges a
+    thread that was made nicer can never be brought back. Elements that are
+    made nicer get a task pool of their own for each take, so their threads
+    are never handed to a capture source. Threads from the shared pool only
+    ever go up to the priority of Kazam, which anybody may undo.
+    """
+    def __init__(self):
+        self.bus = None
+        self.handler = None
+        self.priorities = {}
+        self.applied = {}
+        self.pool = None
+        self.floor = get_nice_floor()
+        self.warned = False
+
+    def attach(self, bus):
+        self.bus = bus
+        self.bus.enable_sync_message_emission()
+        self.handler = self.bus.connect("sync-message::stream-status", self.cb_stream_status)
+
+    def detach(self):
+        if self.handler is not None:
+            self.bus.disconnect(self.handler)
+            self.bus.disable_sync_message_emission()
+            self.handler = None
+        self.release_pool()
+
+    def release_pool(self):
+        if self.pool is not None:
+            self.pool.cleanup()
+            self.pool = None
+
+    def set_priorities(self, priorities):
+        """Takes a dict of element names and (nice, policy), policy may be None.
+
+        Called between takes, while no streaming thread is running.
+        """
+        self.priorities = dict(priorities)
+        self.applied = {}
+        self.release_pool()
+        if any(delta > 0 for (delta, policy) in self.priorities.values()):
+            self.pool = Gst.TaskPool.new()
+            try:
+                self.pool.prepare()
+            except GLib.Error as e:
+                logger.warning("Unable to create a task pool: {0}".format(e))
+                self.pool = None
+
+        base = os.getpriority(os.PRIO_PROCESS, os.getpid())
+        lowest = min(base + delta for (delta, policy) in self.priorities.values()) if self.priorities else base
+        if lowest < min(base, self.floor) and not self.warned:
+            self.warned = True
+            logger.warning("Not allowed to raise thread priorities (RLIMIT_NICE), "
+                           "only encoder threads are made nicer.")
+
+    def check(self, name):
+        """Checks that the thread of an element got the priority it was
+        meant to, returns the (nice, policy) it runs with or None."""
+        wanted = self.priorities.get(name)
+        applied = self.applied.get(name)
+        if wanted is None:
+            return applied
+        if applied is None:
+            logger.warning("No streaming thread of {0} was seen, its priority is unchanged.".format(name))
+        elif applied[0] != wanted[0] or (wanted[1] is not None and applied[1] != wanted[1]):
+            logger.warning("{0} runs at nice {1:+d}, {2} instead of nice {3:+d}, {4}.".format(
+                name, applied[0], POLICY_NAMES.get(applied[1], applied[1]),
+                wanted[0], POLICY_NAMES.get(wanted[1], wanted[1])))
+        return applied
+
+    def cb_stream_status(self, bus, message):
+        (status, owner) = message.parse_stream_status()
+        if owner is None:
+            return
+        (delta, policy) = self.priorities.get(owner.get_name(), (0, getattr(os, "SCHED_OTHER", None)))
+
+        if status == Gst.StreamStatusType.CREATE:
+            if delta > 0 and self.pool is not None:
+                message.get_stream_status_object().set_pool(self.pool)
+            return
+        if status != Gst.StreamStatusType.ENTER:
+            return
+
+        tid = threading.get_native_id()
+        try:
+            base = os.getpriority(os.PRIO_PROCESS, os.getpid())
+            current = os.getpriority(os.PRIO_PROCESS, tid)
+            nice = get_thread_nice(base, delta, current, self.floor)
+            #
+            # Switching between SCHED_OTHER and SCHED_BATCH needs no privileges.
+            #
+            if policy is not None and os.sched_getscheduler(tid) != policy:
+                os.sched_setscheduler(tid, policy, os.sched_param(0))
+            if current != nice:
+                os.setpriority(os.PRIO_PROCESS, tid, nice)
+            if delta:
+                #
+                # Read back, that is what the thread and those it starts really run with.
+                #
+                applied = (os.getpriority(os.PRIO_PROCESS, tid) - base, os.sched_getscheduler(tid))
+                self.applied[owner.get_name()] = applied
+                logger.debug("Thread {0} of {1}: nice {2:+d}, {3}".format(
+                    tid, owner.get_name(), applied[0], POLICY_NAMES.get(applied[1], applied[1])))
+        except (AttributeError, OSError) as e:
+            logger.warning("Can't set priority of {0}: {1}".format(owner.get_name(), e))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+#       queues.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import time
+import logging
+logger = logging.getLogger("Queues")
+
+from gi.repository import Gst
+
+from kazam.backend.prefs import *
+
+#
+# What a full queue does: block upstream, drop the new buffer or drop the oldest one.
+#
+QUEUE_OVERRUN = {"block": 0,
+                 "drop-new": 1,
+                 "drop-old": 2,
+                 }
+
+#
+# Built-in queue profiles. Queues that aren't mentioned keep GStreamer defaults
+# (200 buffers, 10 MB, 1 second, whichever comes first, blocking).
+#
+# queue_v1 carries raw video, so that's the one that eats memory when the
+# encoder stalls. Everything after the encoder is small.
+#
+QUEUE_PROFILES = {
+    "default": {},
+    "balanced": {
+        "queue_v1": {"max-size-buffers": 0,
+                     "max-size-bytes": 512 * 1024 * 1024,
+                     "max-size-time": 2 * Gst.SECOND,
+                     "leaky": QUEUE_OVERRUN["block"]},
+        "queue_v2": {"max-size-buffers": 0,
+                     "max-size-bytes": 64 * 1024 * 1024,
+                     "max-size-time": 0},
+        "queue_a_out": {"max-size-buffers": 0,
+                        "max-size-bytes": 0,
+                        "max-size-time": 5 * Gst.SECOND},
+        "queue_file": {"max-size-buffers": 0,
+                       "max-size-bytes": 64 * 1024 * 1024,
+                       "max-size-time": 0},
+    },
+    "low-memory": {
+        "queue_v1": {"max-size-buffers": 0,
+                     "max-size-bytes": 64 * 1024 * 1024,
+                     "max-size-time": 0,
+                     "leaky": QUEUE_OVERRUN["drop-old"]},
+        "queue_v2": {"max-size-buffers": 0,
+                     "max-size-bytes": 16 * 1024 * 1024,
+                     "max-size-time": 0},
+    },
+}
+
+
+def get_queue_props(name, profile=None):
+    """Returns queue properties for a named queue in a given profile.
+
+    Profiles can be defined or tweaked in kazam.conf, in a section named
+    queue_profile_<profile> with keys like queue_v1.max-size-bytes or
+    queue_v1.leaky (block, drop-new or drop-old).
+    """
+    if profile is None:
+        profile = prefs.queue_profile
+
+    if profile not in QUEUE_PROFILES and not prefs.config.has_section("queue_profile_{0}".format(profile)):
+        logger.warning("Unknown queue profile '{0}', using defaults.".format(profile))
+        profile = "default"
+
+    props = dict(QUEUE_PROFILES.get(profile, {}).get(name, {}))
+
+    section = "queue_profile_{0}".format(profile)
+    if prefs.config.has_section(section):
+        prefix = "{0}.".format(name)
+        for key in prefs.config.options(section):
+            if not key.startswith(prefix):
+                continue
+            prop = key[len(prefix):]
+            value = prefs.config.get(section, key)
+            try:
+                if prop == "leaky":
+                    props[prop] = QUEUE_OVERRUN[value] if value in QUEUE_OVERRUN else int(value)
+                else:
+                    props[prop] = int(value)
+            except (KeyError, ValueError):
+                logger.warning("Invalid value for {0} in [{1}]: {2}".format(key, section, value))
+
+    return props
+
+
+class QueueMonitor(object):
+    """Records high-water marks and overrun events of every queue in a pipeline."""
+
+    def __init__(self):
+        self.probes = []
+        self.handlers = []
+        self.marks = {}
+        self.overruns = {}
+
+    def start(self, pipeline):
+        self.start_time = time.time()
+        self.marks = {}
+        self.overruns = {}
+        for queue in pipeline.iterate_elements():
+            if queue.get_factory().get_name() != "queue":
+                continue
+            name = queue.get_name()
+            self.marks[name] = {"buffers": 0, "bytes": 0, "time": 0}
+            self.overruns[name] = []
+            pad = queue.get_static_pad("sink")
+            self.probes.append((pad, pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_queue_probe, queue)))
+            self.handlers.append((queue, queue.connect("overrun", self.cb_overrun)))
+
+    def stop(self):
+        for (pad, probe) in self.probes:
+            pad.remove_probe(probe)
+        for (queue, handler) in self.handlers:
+            queue.disconnect(handler)
+        self.probes = []
+        self.handlers = []
+        self.log_summary()
+
+    def cb_queue_probe(self, pad, info, queue):
+        mark = self.marks[queue.get_name()]
+        mark["buffers"] = max(mark["buffers"], queue.get_property("current-level-buffers"))
+        mark["bytes"] = max(mark["bytes"], queue.get_property("current-level-bytes"))
+        mark["time"] = max(mark["time"], queue.get_property("current-level-time"))
+        return Gst.PadProbeReturn.OK
+
+    def cb_overrun(self, queue):
+        when = time.time() - self.start_time
+        self.overruns[queue.get_name()].append(when)
+        logger.debug("Queue {0} overrun at {1:.2f} s, leaky: {2}.".format(queue.get_name(),
+                                                                       when,
+                                                                       queue.get_property("leaky")))
+
+    def get_report(self):
+        return dict((name, {"high_buffers": mark["buffers"],
+                            "high_bytes": mark["bytes"],
+                            "high_time": mark["time"],
+                            "overruns": len(self.overruns[name])})
+                    for (name, mark) in self.marks.items())
+
+    def log_summary(self):
+        for (name, entry) in sorted(self.get_report().items()):
+            logger.debug("  {0}: high-water {1} buffers, {2:.1f} MB, {3:.2f} s, {4} overrun(s).".format(
+                name,
+                entry["high_buffers"],
+                entry["high_bytes"] / 1048576.0,
+                entry["high_time"] / float(Gst.SECOND),
+                entry["overruns"]))
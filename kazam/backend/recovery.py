@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+#       recovery.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import re
+import json
+import time
+import struct
+import logging
+import tempfile
+logger = logging.getLogger("Recovery")
+
+from gi.repository import GObject
+
+from kazam.backend.prefs import *
+from kazam.backend.config import KazamConfig
+from kazam.backend.remux import Remuxer
+from kazam.backend.timing import move_sidecar
+from kazam.backend.segments import get_segment_glob
+
+RECOVERY_CACHE = os.path.join(KazamConfig.CONFIGDIR, "recovery.json")
+
+#
+# Files touched this recently may belong to another running instance.
+#
+RECOVERY_GRACE = 30
+
+#
+# Tempfiles, faststart scratch files and splitmuxsink segments.
+#
+ORPHAN_RE = re.compile(r"^(kazam_\w+\.movie)(\.mux|\.seg\d{5})?$")
+
+#
+# What we find in an orphan and what can be done about it.
+#
+KIND_PENDING = None
+KIND_EMPTY = "empty"
+KIND_BROKEN = "broken"
+KIND_WEBM = "webm"
+KIND_AVI = "avi"
+KIND_MP4 = "mp4"
+KIND_MP4_FRAGMENTED = "mp4-fragmented"
+
+#
+# Demuxer, muxer and codec (for the file extension) of repairable containers.
+#
+RECOVERY_FORMATS = {KIND_WEBM: ("matroskademux", "webmmux", CODEC_VP8),
+                    KIND_AVI: ("avidemux", "avimux", CODEC_RAW),
+                    KIND_MP4: ("qtdemux", "mp4mux", CODEC_H264),
+                    KIND_MP4_FRAGMENTED: ("qtdemux", "mp4mux", CODEC_H264),
+                    }
+
+
+def probe_container(path):
+    """Guesses what is in a file from its first bytes.
+
+    For MP4 the top level atoms are walked as well, that's a seek per atom.
+    A file without a moov atom was cut off before mp4mux finished it and
+    can't be repaired, one with moof atoms is fragmented and just needs a
+    new index.
+    """
+    with open(path, "rb") as f:
+        head = f.read(12)
+        if len(head) < 12:
+            return KIND_EMPTY
+        if head[:4] == b"\x1a\x45\xdf\xa3":
+            return KIND_WEBM
+        if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+            return KIND_AVI
+        if head[4:8] not in (b"ftyp", b"moov", b"mdat", b"free", b"wide"):
+            return KIND_BROKEN
+
+        atoms = set()
+        pos = 0
+        while True:
+            f.seek(pos)
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            (size, atom) = struct.unpack(">I4s", header)
+            if size == 1:
+                (size,) = struct.unpack(">Q", f.read(8))
+            atoms.add(atom)
+            if atom == b"moof" or size < 8:
+                break
+            pos += size
+
+    if b"moof" in atoms:
+        return KIND_MP4_FRAGMENTED
+    if b"moov" in atoms:
+        return KIND_MP4
+    return KIND_BROKEN
+
+
+class OrphanRecovery(GObject.GObject):
+    """Finds tempfiles left behind by a crashed Kazam and repairs them.
+
+    Verdicts are cached per file (size and mtime) together with the mtime of
+    the directory. As long as the directory hasn't changed and nothing is
+    waiting for a decision the scan doesn't even list it. Repairs run one at
+    a time, every recovered file is announced with orphan-recovered.
+    """
+    __gsignals__ = {"orphan-recovered": (GObject.SIGNAL_RUN_LAST,
+                                         None,
+                                         [GObject.TYPE_STRING, GObject.TYPE_INT],),
+                    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.jobs = []
+        self.remuxer = None
+        self.cache = self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(RECOVERY_CACHE) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_cache(self):
+        try:
+            with open(RECOVERY_CACHE, "w") as f:
+                json.dump(self.cache, f)
+        except (IOError, OSError):
+            logger.warning("Unable to write {0}".format(RECOVERY_CACHE))
+
+    def scan(self, path, busy=()):
+        """Scans path for orphans, skipping files whose names start with
+        any of the busy prefixes (files queued jobs are working on)."""
+        start = time.time()
+        busy = [prefix.replace("*", "") for prefix in busy]
+        try:
+            dir_mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+
+        entry = self.cache.get(path)
+        if entry and entry["mtime"] == dir_mtime and \
+                all(f[2] == KIND_BROKEN for f in entry["files"].values()):
+            logger.debug("Nothing new in {0}.".format(path))
+            return False
+
+        known = entry["files"] if entry else {}
+        files = {}
+        groups = {}
+        now = time.time()
+        for name in os.listdir(path):
+            match = ORPHAN_RE.match(name)
+            if not match:
+                continue
+            fname = os.path.join(path, name)
+            if any(fname.startswith(prefix) for prefix in busy):
+                continue
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            if now - st.st_mtime < RECOVERY_GRACE:
+                files[name] = [st.st_size, st.st_mtime, KIND_PENDING]
+                continue
+
+            cached = known.get(name)
+            if cached and cached[:2] == [st.st_size, st.st_mtime]:
+                kind = cached[2]
+            elif match.group(2) == ".mux":
+                kind = KIND_EMPTY
+            else:
+                kind = probe_container(fname)
+            files[name] = [st.st_size, st.st_mtime, kind]
+            groups.setdefault(match.group(1), []).append((name, match.group(2), kind))
+
+        for (base, members) in groups.items():
+            self.plan(path, base, members)
+
+        #
+        # Repaired files are gone once their job is done, the cache only has
+        # to remember what we gave up on and what we haven't looked at yet.
+        #
+        self.cache[path] = {"mtime": dir_mtime,
+                            "files": dict((name, f) for (name, f) in files.items()
+                                          if f[2] in (KIND_BROKEN, KIND_PENDING))}
+        self.save_cache()
+        logger.debug("Scanned {0} in {1:.1f} ms, {2} orphan(s), {3} repair(s).".format(
+            path, (time.time() - start) * 1000, len(files), len(self.jobs)))
+
+        self.next_job()
+        return False
+
+    def plan(self, path, base, members):
+        segments = sorted(name for (name, suffix, kind) in members if suffix and suffix != ".mux")
+        for (name, suffix, kind) in members:
+            fname = os.path.join(path, name)
+            if suffix == ".mux" or kind == KIND_EMPTY:
+                #
+                # Faststart scratch files hold bare sample data, nothing to recover.
+                #
+                logger.debug("Removing {0}".format(fname))
+                os.remove(fname)
+            elif suffix is None and kind in RECOVERY_FORMATS:
+                self.jobs.append(("remux", fname, kind, None))
+            elif suffix is None:
+                logger.info("Unable to recover {0}".format(fname))
+
+        if not segments:
+            return
+
+        #
+        # splitmuxsink finishes every segment but the one it was writing when
+        # we crashed. Only finished ones are joined, a cut off tail is
+        # repaired on its own like any other orphan. An MP4 tail with a moov
+        # atom was finished after all.
+        #
+        kinds = dict((name, kind) for (name, suffix, kind) in members)
+        complete = [name for name in segments[:-1] if kinds[name] in RECOVERY_FORMATS]
+        tail = segments[-1]
+        if kinds[tail] == KIND_MP4:
+            complete.append(tail)
+        elif kinds[tail] in RECOVERY_FORMATS:
+            self.jobs.append(("remux", os.path.join(path, tail), kinds[tail], None))
+        for name in segments:
+            if kinds[name] not in RECOVERY_FORMATS:
+                logger.info("Unable to recover {0}".format(os.path.join(path, name)))
+        if complete:
+            self.jobs.append(("join", os.path.join(path, base), kinds[complete[0]],
+                              [os.path.join(path, name) for name in complete]))
+
+    def next_job(self):
+        if not self.jobs or self.remuxer is not None:
+            return
+        (job, fname, kind, segments) = self.jobs.pop(0)
+        (demuxer, muxer, codec) = RECOVERY_FORMATS[kind]
+
+        if job == "remux" and kind == KIND_MP4:
+            #
+            # Complete file, mp4mux finished but we never got to save it.
+            #
+            self.emit("orphan-recovered", fname, codec)
+            self.next_job()
+            return
+
+        (fd, output) = tempfile.mkstemp(prefix="kazam_", dir=os.path.dirname(fname), suffix=".movie")
+        os.close(fd)
+        self.remuxer = Remuxer(output, muxer)
+        self.remuxer.connect("remux-done", self.cb_remux_done, job, fname, output, codec, segments)
+        if job == "join":
+            self.remuxer.join(get_segment_glob(fname), segments)
+        else:
+            self.remuxer.remux(fname, demuxer)
+
+    def cb_remux_done(self, remuxer, success, job, fname, output, codec, segments):
+        self.remuxer = None
+        if success:
+            for source in segments or [fname]:
+                os.remove(source)
+            move_sidecar(fname, output)
+            logger.info("Recovered {0} into {1}".format(fname, output))
+            self.emit("orphan-recovered", output, codec)
+        elif job == "join":
+            #
+            # Every finished segment is playable on its own, offer them one
+            # by one rather than giving up on all of them.
+            #
+            os.remove(output)
+            logger.info("Unable to join {0} segment(s) of {1}, offering them separately.".format(
+                len(segments), fname))
+            for segment in segments:
+                self.emit("orphan-recovered", segment, codec)
+        else:
+            os.remove(output)
+            logger.info("Unable to recover {0}".format(fname))
+            self.mark_broken(fname)
+        self.next_job()
+
+    def mark_broken(self, fname):
+        (path, base) = os.path.split(fname)
+        files = self.cache.setdefault(path, {"mtime": None, "files": {}})["files"]
+        st = os.stat(fname)
+        files[base] = [st.st_size, st.st_mtime, KIND_BROKEN]
+        self.save_cache()
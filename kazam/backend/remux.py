@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+#       remux.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger("Remux")
+
+from gi.repository import GObject, Gst
+
+
+class Remuxer(GObject.GObject):
+    """Copies encoded streams into a fresh container without re-encoding.
+
+    join() concatenates segments written by splitmuxsink, remux() rewrites a
+    single file through a demuxer, which rebuilds whatever index the muxer
+    didn't get to write. Both run asynchronously and emit remux-done with
+    the outcome when they are finished.
+    """
+    __gsignals__ = {"remux-done": (GObject.SIGNAL_RUN_LAST,
+                                   None,
+                                   [GObject.TYPE_BOOLEAN],),
+                    }
+
+    def __init__(self, output, muxer):
+        GObject.GObject.__init__(self)
+        self.output = output
+        self.muxer = muxer
+        self.pipeline = None
+
+    def join(self, pattern, files=None):
+        """Joins the segments matching pattern, or only those in files."""
+        logger.debug("Joining {0} into {1}".format(pattern, self.output))
+        src = Gst.ElementFactory.make("splitmuxsrc", "remux_src")
+        src.set_property("location", pattern)
+        if files is not None:
+            src.connect("format-location", lambda element: files)
+        self.run(src)
+
+    def remux(self, path, demuxer):
+        logger.debug("Remuxing {0} into {1}".format(path, self.output))
+        filesrc = Gst.ElementFactory.make("filesrc", "remux_filesrc")
+        filesrc.set_property("location", path)
+        demux = Gst.ElementFactory.make(demuxer, "remux_src")
+        self.run(demux, filesrc)
+
+    def run(self, src, filesrc=None):
+        self.pipeline = Gst.Pipeline()
+        self.mux = Gst.ElementFactory.make(self.muxer, "remux_mux")
+        sink = Gst.ElementFactory.make("filesink", "remux_sink")
+        sink.set_property("location", self.output)
+
+        for element in (filesrc, src, self.mux, sink):
+            if element is not None:
+                self.pipeline.add(element)
+        if filesrc is not None:
+            filesrc.link(src)
+        self.mux.link(sink)
+        src.connect("pad-added", self.cb_pad_added)
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        self.bus_watch = bus.connect("message", self.on_message)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def cb_pad_added(self, element, pad):
+        queue = Gst.ElementFactory.make("queue", None)
+        self.pipeline.add(queue)
+        queue.sync_state_with_parent()
+        pad.link(queue.get_static_pad("sink"))
+        if not queue.link(self.mux):
+            logger.warning("Unable to remux stream: {0}".format(pad.get_current_caps()))
+
+    def finish(self, success):
+        bus = self.pipeline.get_bus()
+        bus.disconnect(self.bus_watch)
+        bus.remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline = None
+        self.emit("remux-done", success)
+
+    def on_message(self, bus, message):
+        t = message.type
+        if t == Gst.MessageType.EOS:
+            logger.debug("Remux finished: {0}".format(self.output))
+            self.finish(True)
+        elif t == Gst.MessageType.ERROR:
+            logger.warning("Remux failed: {0}".format(message.parse_error()[1]))
+            self.finish(False)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+#       replay.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import logging
+import threading
+logger = logging.getLogger("Replay")
+
+from collections import deque
+
+from gi.repository import GObject, Gst
+
+
+class ReplayBuffer(GObject.GObject):
+    """Keeps the last few seconds of encoded video and audio in memory.
+
+    Video is kept as a ring of GOPs, each starting with a keyframe, so any
+    dump starts with one. Whole GOPs are evicted from the front as soon as
+    either the time or the byte cap is exceeded, audio older than the first
+    GOP goes with them. Memory use is bounded by the caps no matter how long
+    the capture runs.
+
+    Samples come in on the streaming threads, dumps are made from the main
+    loop, the ring is guarded by a lock.
+    """
+    __gsignals__ = {"replay-saved": (GObject.SIGNAL_RUN_LAST,
+                                     None,
+                                     [GObject.TYPE_STRING, GObject.TYPE_BOOLEAN],),
+                    }
+
+    def __init__(self, seconds, megabytes):
+        GObject.GObject.__init__(self)
+        self.max_time = seconds * Gst.SECOND
+        self.max_bytes = megabytes * 1024 * 1024
+        self.lock = threading.Lock()
+        self.handlers = []
+        self.dumps = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.gops = deque()
+            self.audio = deque()
+            self.bytes = 0
+            self.video_caps = None
+            self.audio_caps = None
+            self.evicted = 0
+
+    def attach(self, video_sink, audio_sink):
+        for (sink, handler) in self.handlers:
+            sink.disconnect(handler)
+        self.handlers = []
+        for (sink, kind) in ((video_sink, "video"), (audio_sink, "audio")):
+            if sink is not None:
+                self.handlers.append((sink, sink.connect("new-sample", self.cb_new_sample, kind)))
+
+    def cb_new_sample(self, sink, kind):
+        sample = sink.emit("pull-sample")
+        buf = sample.get_buffer()
+        size = buf.get_size()
+
+        with self.lock:
+            if kind == "video":
+                self.video_caps = sample.get_caps()
+                if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                    self.gops.append([])
+                if not self.gops:
+                    # Nothing to hang a delta frame on before the first keyframe.
+                    return Gst.FlowReturn.OK
+                self.gops[-1].append(buf)
+            else:
+                self.audio_caps = sample.get_caps()
+                self.audio.append(buf)
+            self.bytes += size
+            self.evict()
+
+        return Gst.FlowReturn.OK
+
+    def evict(self):
+        while len(self.gops) > 1:
+            span = self.gops[-1][-1].pts - self.gops[1][0].pts
+            if span < self.max_time and self.bytes <= self.max_bytes:
+                break
+            gop = self.gops.popleft()
+            self.bytes -= sum(buf.get_size() for buf in gop)
+            self.evicted += 1
+
+        if self.gops:
+            start = self.gops[0][0].pts
+            while self.audio and self.audio[0].pts < start:
+                self.bytes -= self.audio.popleft().get_size()
+
+    def get_status(self):
+        with self.lock:
+            if not self.gops:
+                return {"seconds": 0.0, "bytes": self.bytes, "gops": 0, "evicted": self.evicted}
+            span = self.gops[-1][-1].pts - self.gops[0][0].pts
+            return {"seconds": float(span) / Gst.SECOND,
+                    "bytes": self.bytes,
+                    "gops": len(self.gops),
+                    "evicted": self.evicted}
+
+    def save(self, fname, muxer):
+        """Writes the current contents of the ring to fname. Capture keeps
+        going, replay-saved is emitted once the file is complete."""
+        with self.lock:
+            video = [buf for gop in self.gops for buf in gop]
+            audio = list(self.audio)
+            video_caps = self.video_caps
+            audio_caps = self.audio_caps
+
+        if not video:
+            logger.warning("Replay buffer is empty, nothing to save.")
+            self.emit("replay-saved", fname, False)
+            return
+
+        offset = video[0].pts
+        logger.debug("Saving {0:.1f} s of replay to {1}".format(
+            float(video[-1].pts - offset) / Gst.SECOND, fname))
+
+        pipeline = Gst.Pipeline()
+        mux = Gst.ElementFactory.make(muxer, None)
+        sink = Gst.ElementFactory.make("filesink", None)
+        sink.set_property("location", fname)
+        for element in (mux, sink):
+            pipeline.add(element)
+        mux.link(sink)
+
+        sources = []
+        for (buffers, caps) in ((video, video_caps), (audio, audio_caps)):
+            if not buffers:
+                continue
+            src = Gst.ElementFactory.make("appsrc", None)
+            src.set_property("caps", caps)
+            src.set_property("format", Gst.Format.TIME)
+            queue = Gst.ElementFactory.make("queue", None)
+            pipeline.add(src)
+            pipeline.add(queue)
+            src.link(queue)
+            queue.link(mux)
+            sources.append((src, buffers))
+
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        self.dumps[fname] = (pipeline, bus.connect("message", self.on_message, fname))
+        pipeline.set_state(Gst.State.PLAYING)
+
+        #
+        # Buffers are shared with the ring, so they are copied before the
+        # timestamps are moved to start at zero.
+        #
+        for (src, buffers) in sources:
+            for buf in buffers:
+                out = buf.copy_region(Gst.BufferCopyFlags.ALL, 0, buf.get_size())
+                out.pts = buf.pts - offset
+                if buf.dts != Gst.CLOCK_TIME_NONE:
+                    out.dts = max(buf.dts - offset, 0)
+                src.emit("push-buffer", out)
+            src.emit("end-of-stream")
+
+    def on_message(self, bus, message, fname):
+        t = message.type
+        if t not in (Gst.MessageType.EOS, Gst.MessageType.ERROR):
+            return
+        if t == Gst.MessageType.ERROR:
+            logger.warning("Unable to save replay: {0}".format(message.parse_error()[1]))
+        (pipeline, handler) = self.dumps.pop(fname)
+        bus.disconnect(handler)
+        bus.remove_signal_watch()
+        pipeline.set_state(Gst.State.NULL)
+        self.emit("replay-saved", fname, t == Gst.MessageType.EOS)
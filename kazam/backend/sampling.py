@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+#       sampling.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import time
+import zlib
+
+
+class FrameSampler(object):
+    """Cheap change detection for raw video buffers.
+
+    Only every row_step-th row of a frame is extracted, each sampled row is
+    cut into tiles and every tile is hashed with adler32. Comparing the tile
+    hashes with the ones from the previous frame tells us roughly how much
+    of the frame changed, without ever touching most of the pixels. The
+    time spent sampling is kept, get_cost() returns it per frame.
+    """
+    def __init__(self, row_step=8, tiles=16):
+        self.row_step = row_step
+        self.tiles = tiles
+        self.height = None
+        self.last = None
+        self.frames = 0
+        self.time = 0.0
+
+    def reset(self):
+        self.height = None
+        self.last = None
+        self.frames = 0
+        self.time = 0.0
+
+    def get_cost(self):
+        """Returns the average time spent sampling a frame, in milliseconds."""
+        return self.time * 1000 / self.frames if self.frames else 0.0
+
+    def set_caps(self, caps):
+        self.height = caps.get_structure(0).get_value("height")
+
+    def sample(self, buf):
+        """Returns the fraction of sampled tiles that changed, 1.0 for the first frame."""
+        start = time.perf_counter()
+        stride = buf.get_size() // self.height
+        tile = max(1, stride // self.tiles)
+        hashes = []
+        for row in range(0, self.height, self.row_step):
+            data = memoryview(buf.extract_dup(row * stride, stride))
+            for offset in range(0, stride, tile):
+                hashes.append(zlib.adler32(data[offset:offset + tile]))
+
+        if self.last is None or len(self.last) != len(hashes):
+            changed = 1.0
+        else:
+            changed = sum(1 for (a, b) in zip(hashes, self.last) if a != b) / float(len(hashes))
+
+        self.last = hashes
+        self.frames += 1
+        self.time += time.perf_counter() - start
+        return changed
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+#       segments.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import glob
+
+#
+# Names of splitmuxsink segments, no GStreamer or GTK in here. Segments
+# get a suffix of their own, so that nothing else kept next to a recording,
+# like its timing sidecar, is ever taken for one.
+#
+SEGMENT_SUFFIX = ".seg"
+
+
+def get_segment_pattern(fname):
+    """Returns the splitmuxsink location for segments of a recording."""
+    return "{0}{1}%05d".format(fname, SEGMENT_SUFFIX)
+
+
+def get_segment_glob(fname):
+    """Returns the glob splitmuxsrc joins the segments of a recording with."""
+    return "{0}{1}*".format(fname, SEGMENT_SUFFIX)
+
+
+def get_segments(fname):
+    return sorted(glob.glob("{0}{1}{2}".format(fname, SEGMENT_SUFFIX, "[0-9]" * 5)))
+
+
+def remove_segments(pattern):
+    """Removes the segments matched by a segment glob."""
+    for path in glob.glob(pattern):
+        os.remove(path)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+#       stats.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import time
+import logging
+logger = logging.getLogger("Stats")
+
+from gi.repository import GObject, GLib, Gst
+
+from kazam.backend.timing import Histogram
+from kazam.backend.threads import get_available_cpus
+
+# Poll interval in milliseconds
+STATS_INTERVAL = 1000
+
+#
+# Source timing histograms, bins in milliseconds. Audio drift is signed,
+# positive when audio timestamps run ahead of the pipeline clock.
+#
+INTERVAL_BIN = 1
+INTERVAL_BINS = 200
+JITTER_BIN = 0.5
+JITTER_BINS = 100
+DRIFT_BIN = 1
+DRIFT_BINS = 200
+DRIFT_LOW = -100
+
+
+class PipelineStats(GObject.GObject):
+    """Collects statistics about a running recording pipeline.
+
+    QoS messages are fed in from the bus handler, videorate counters and
+    queue levels are polled once per STATS_INTERVAL and encoder throughput
+    is counted with a probe on the encoder source pad. CPU usage of the
+    whole process is in percent of the CPUs we may use. A fresh snapshot is
+    emitted with stats-updated after every poll, get_snapshot() returns the
+    latest one.
+    """
+    __gsignals__ = {"stats-updated": (GObject.SIGNAL_RUN_LAST,
+                                      None,
+                                      [GObject.TYPE_PYOBJECT],),
+                    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.pipeline = None
+        self.timer = None
+        self.probe = None
+        self.enc_pad = None
+        self.snapshot = {}
+        #
+        # QoS messages may come in before start(), while a warm pipeline
+        # waits in PLAYING for the countdown to end.
+        #
+        self.qos = {}
+        self.enc_frames = 0
+        self.enc_bytes = 0
+
+    def start(self, pipeline):
+        self.pipeline = pipeline
+        self.start_time = time.time()
+        self.qos = {}
+        self.enc_frames = 0
+        self.enc_bytes = 0
+        self.cpus = get_available_cpus()
+        self.cpu_start = self.get_cpu_time()
+        self.cpu_peak = 0.0
+        self.last_poll = (self.start_time, 0, 0, self.cpu_start)
+
+        self.videorate = pipeline.get_by_name("video_rate")
+        self.queues = [el for el in pipeline.iterate_elements()
+                       if el.get_factory().get_name() == "queue"]
+
+        encoder = pipeline.get_by_name("video_encoder")
+        if encoder is None:
+            encoder = pipeline.get_by_name("videoconvert")
+        self.enc_pad = encoder.get_static_pad("src")
+        self.probe = self.enc_pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_encoder_probe, None)
+
+        self.timer = GLib.timeout_add(STATS_INTERVAL, self.cb_poll)
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.probe is not None:
+            self.enc_pad.remove_probe(self.probe)
+            self.probe = None
+        self.poll()
+        self.log_summary()
+
+    def cb_encoder_probe(self, pad, info, data):
+        self.enc_frames += 1
+        self.enc_bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def get_cpu_time(self):
+        times = os.times()
+        return times[0] + times[1]
+
+    def handle_qos(self, message):
+        (fmt, processed, dropped) = message.parse_qos_stats()
+        name = message.src.get_name()
+        entry = self.qos.setdefault(name, {"messages": 0, "processed": 0, "dropped": 0})
+        entry["messages"] += 1
+        entry["processed"] = processed
+        entry["dropped"] = dropped
+        logger.debug("QoS from {0}: processed {1}, dropped {2}.".format(name, processed, dropped))
+
+    def cb_poll(self):
+        self.poll()
+        self.emit("stats-updated", self.snapshot)
+        return True
+
+    def poll(self):
+        now = time.time()
+        (last_time, last_frames, last_bytes, last_cpu) = self.last_poll
+        interval = max(now - last_time, 0.001)
+        frames = self.enc_frames
+        enc_bytes = self.enc_bytes
+        cpu_time = self.get_cpu_time()
+        self.last_poll = (now, frames, enc_bytes, cpu_time)
+
+        cpu = (cpu_time - last_cpu) * 100 / interval / self.cpus
+        self.cpu_peak = max(self.cpu_peak, cpu)
+
+        if self.videorate is not None:
+            videorate = {"in": self.videorate.get_property("in"),
+                         "out": self.videorate.get_property("out"),
+                         "drop": self.videorate.get_property("drop"),
+                         "duplicate": self.videorate.get_property("duplicate")}
+        else:
+            videorate = None
+
+        queues = {}
+        for queue in self.queues:
+            queues[queue.get_name()] = {"buffers": queue.get_property("current-level-buffers"),
+                                        "bytes": queue.get_property("current-level-bytes"),
+                                        "time": queue.get_property("current-level-time")}
+
+        self.snapshot = {"elapsed": now - self.start_time,
+                         "qos": dict((name, dict(entry)) for (name, entry) in self.qos.items()),
+                         "videorate": videorate,
+                         "queues": queues,
+                         "encoder": {"frames": frames,
+                                     "bytes": enc_bytes,
+                                     "fps": (frames - last_frames) / interval,
+                                     "kbps": (enc_bytes - last_bytes) * 8 / interval / 1000},
+                         "cpu": {"percent": cpu,
+                                 "average": (cpu_time - self.cpu_start) * 100 /
+                                            max(now - self.start_time, 0.001) / self.cpus,
+                                 "peak": self.cpu_peak,
+                                 "cpus": self.cpus}}
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def log_summary(self):
+        s = self.snapshot
+        elapsed = max(s["elapsed"], 0.001)
+        logger.debug("Session statistics after {0:.1f} s:".format(s["elapsed"]))
+        logger.debug("  Encoded {0} frames, {1:.1f} fps, {2:.0f} kbps on average.".format(
+            s["encoder"]["frames"],
+            s["encoder"]["frames"] / elapsed,
+            s["encoder"]["bytes"] * 8 / elapsed / 1000))
+        logger.debug("  CPU: {0:.0f}% of {1} CPU(s) on average, {2:.0f}% at peak.".format(
+            s["cpu"]["average"], s["cpu"]["cpus"], s["cpu"]["peak"]))
+        if s["videorate"]:
+            logger.debug("  Videorate: in {0}, out {1}, dropped {2}, duplicated {3}.".format(
+                s["videorate"]["in"], s["videorate"]["out"],
+                s["videorate"]["drop"], s["videorate"]["duplicate"]))
+        for (name, entry) in sorted(s["qos"].items()):
+            logger.debug("  QoS {0}: {1} message(s), processed {2}, dropped {3}.".format(
+                name, entry["messages"], entry["processed"], entry["dropped"]))
+
+
+class SourceTiming(object):
+    """Measures how regularly a source delivers buffers.
+
+    A probe on the source pad records the time between buffer timestamps
+    and how far that is from the duration of the previous buffer (for video
+    without durations, the frame duration of the negotiated framerate). For
+    audio it also tracks where the end of each buffer lands against the
+    pipeline running time video frames are stamped with. How far that moves
+    from where it started is the A/V drift of a long recording. The sample
+    count can't be used for this, pulsesrc slaves its timestamps to it.
+    """
+    def __init__(self, element, framerate):
+        self.element = element
+        self.name = element.get_name()
+        self.framerate = framerate
+        self.pad = element.get_static_pad("src")
+        self.probe = None
+        self.reset()
+
+    def reset(self):
+        self.kind = None
+        self.first = None
+        self.last = None
+        self.drift = None
+        self.interval = Histogram(INTERVAL_BIN, INTERVAL_BINS)
+        self.jitter = Histogram(JITTER_BIN, JITTER_BINS)
+        self.drifts = Histogram(DRIFT_BIN, DRIFT_BINS, low=DRIFT_LOW)
+
+    def start(self):
+        self.reset()
+        self.probe = self.pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_probe, None)
+
+    def stop(self):
+        if self.probe is not None:
+            self.pad.remove_probe(self.probe)
+            self.probe = None
+        logger.debug("Timing of {0} ({1}):".format(self.name, self.kind))
+        logger.debug("  Interval: {0}".format(self.interval.get_summary()))
+        logger.debug("  Jitter: {0}".format(self.jitter.get_summary()))
+        for line in self.jitter.get_lines():
+            logger.debug("    {0}".format(line))
+        if self.drift is not None:
+            logger.debug("  A/V drift: {0}, {1:+.2f} ms at the end".format(self.drifts.get_summary(), self.drift))
+            for line in self.drifts.get_lines():
+                logger.debug("    {0}".format(line))
+
+    def setup(self, pad):
+        caps = pad.get_current_caps()
+        structure = caps.get_structure(0) if caps is not None else None
+        self.kind = "video"
+        self.duration = Gst.SECOND // max(int(self.framerate), 1)
+        if structure is None:
+            return
+        if structure.get_name().startswith("audio/"):
+            self.kind = "audio"
+            return
+        (ok, num, den) = structure.get_fraction("framerate")
+        if ok and num:
+            self.duration = Gst.SECOND * den // num
+
+    def cb_probe(self, pad, info, data):
+        buf = info.get_buffer()
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        if self.kind is None:
+            self.setup(pad)
+
+        if self.last is not None:
+            (last_pts, last_duration) = self.last
+            interval = buf.pts - last_pts
+            expected = last_duration if last_duration != Gst.CLOCK_TIME_NONE else self.duration
+            self.interval.add(interval / float(Gst.MSECOND))
+            self.jitter.add(abs(interval - expected) / float(Gst.MSECOND))
+        self.last = (buf.pts, buf.duration)
+
+        #
+        # The end of an audio buffer is the moment its last sample was
+        # captured, compare it with the running time right now. The first
+        # offset is the capture latency, only changes to it are drift.
+        #
+        clock = self.element.get_clock()
+        if self.kind == "audio" and clock is not None and buf.duration != Gst.CLOCK_TIME_NONE:
+            running = clock.get_time() - self.element.get_base_time()
+            offset = buf.pts + buf.duration - running
+            if self.first is None:
+                self.first = offset
+                logger.debug("{0} starts {1:+.2f} ms off the running time.".format(
+                    self.name, offset / float(Gst.MSECOND)))
+            self.drift = (offset - self.first) / float(Gst.MSECOND)
+            self.drifts.add(self.drift)
+        return Gst.PadProbeReturn.OK
+
+    def to_dict(self):
+        return {"element": self.name,
+                "kind": self.kind,
+                "interval_ms": self.interval.to_dict(),
+                "jitter_ms": self.jitter.to_dict(),
+                "drift_ms": self.drifts.to_dict() if self.drift is not None else None,
+                "final_drift_ms": self.drift}
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+#       threads.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import logging
+import resource
+import multiprocessing
+logger = logging.getLogger("Threads")
+
+#
+# Encoders that don't scale past a number of threads. x264enc supports
+# maximum of four cores for our use, more only adds latency.
+#
+ENCODER_THREAD_LIMITS = {"x264enc": 4}
+
+#
+# Colour conversion gets a quarter of what is left after capture and audio.
+#
+CONVERT_SHARE = 4
+
+
+def get_nice_floor():
+    """Returns the lowest nice value we may lower a thread to (RLIMIT_NICE)."""
+    if os.geteuid() == 0:
+        return -20
+    try:
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NICE)
+    except (AttributeError, ValueError, OSError):
+        return 20
+    if soft == resource.RLIM_INFINITY:
+        return -20
+    return 20 - min(soft, 40)
+
+
+def get_thread_nice(base, delta, current, floor):
+    """Returns the nice value a thread can get closest to base + delta.
+
+    Making a thread nicer is always allowed, going back down only as far as
+    the floor. A thread that is already below the floor may stay where it is.
+    """
+    return min(max(base + delta, min(current, floor)), 19)
+
+
+#
+# Where cgroup v2 and the v1 cpu controller are mounted.
+#
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_V1_CPU = "/sys/fs/cgroup/cpu"
+
+
+def get_cgroup_paths():
+    """Returns the directories of our cgroup v2 and v1 cpu cgroups, None when not there."""
+    (v2, v1) = (None, None)
+    try:
+        with open("/proc/self/cgroup") as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return (None, None)
+    for line in lines:
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        (hierarchy, controllers, path) = fields
+        if hierarchy == "0" and not controllers:
+            v2 = os.path.normpath(os.path.join(CGROUP_ROOT, path.lstrip("/")))
+        elif "cpu" in controllers.split(","):
+            v1 = os.path.normpath(os.path.join(CGROUP_V1_CPU, path.lstrip("/")))
+    return (v2, v1)
+
+
+def read_cgroup_quota(directory, v2):
+    """Returns the CPU quota of one cgroup as (quota, period), None if there is none."""
+    try:
+        if v2:
+            with open(os.path.join(directory, "cpu.max")) as f:
+                (quota, period) = f.read().split()
+            if quota == "max":
+                return None
+            return (int(quota), int(period))
+        with open(os.path.join(directory, "cpu.cfs_quota_us")) as f:
+            quota = int(f.read())
+        with open(os.path.join(directory, "cpu.cfs_period_us")) as f:
+            period = int(f.read())
+        return (quota, period) if quota > 0 else None
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_cgroup_cpus():
+    """Returns the CPU quota of our cgroup in whole CPUs, or None if there is no limit.
+
+    Quotas of every cgroup from ours up to the root count, a systemd slice
+    with CPUQuota usually sits a few levels above the process.
+    """
+    cpus = None
+    for (directory, root, v2) in zip(get_cgroup_paths(), (CGROUP_ROOT, CGROUP_V1_CPU), (True, False)):
+        while directory is not None and directory.startswith(root):
+            quota = read_cgroup_quota(directory, v2)
+            if quota is not None:
+                limit = max(1, quota[0] // quota[1])
+                cpus = limit if cpus is None else min(cpus, limit)
+            if directory == root:
+                break
+            directory = os.path.dirname(directory)
+    return cpus
+
+
+def get_available_cpus():
+    """Returns the number of CPUs we may actually use, taking CPU affinity
+    and cgroup quotas into account."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    quota = get_cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, cpus)
+
+
+class ThreadBudget(object):
+    """Splits the available CPUs between the parts of a recording.
+
+    A CPU is kept free for the capture thread and one for the audio encoder
+    (when there are enough to go around), neither of them has a thread
+    count to set. Colour conversion gets a share of the rest and video
+    encoders split what remains. Threads an encoder can't use go to colour
+    conversion.
+    """
+    def __init__(self, cpus=None):
+        self.cpus = cpus or get_available_cpus()
+
+    def plan(self, encoders, audio=False):
+        """Returns the thread plan for a recording.
+
+        encoders maps node names to video encoder factories, None for raw
+        video. The plan has the number of colour conversion threads and a
+        dict of video encoder threads by node name.
+        """
+        cpus = self.cpus
+        reserved = (1 if cpus > 1 else 0) + (1 if audio and cpus > 2 else 0)
+        left = max(cpus - reserved, 1)
+
+        convert = max(1, left // CONVERT_SHARE)
+        video_cpus = max(left - convert, 1)
+
+        encoding = [name for (name, factory) in encoders.items() if factory]
+        share = max(1, video_cpus // max(len(encoding), 1))
+
+        video = {}
+        for name in encoding:
+            limit = ENCODER_THREAD_LIMITS.get(encoders[name])
+            video[name] = min(share, limit) if limit else share
+
+        spare = video_cpus - sum(video.values())
+        if spare > 0:
+            convert += spare
+
+        plan = {"cpus": cpus,
+                "convert": convert,
+                "video": video}
+        logger.debug("Thread plan for {0} CPU(s), {1} kept for capture and audio: convert {2}, video {3}".format(
+            cpus, reserved, convert,
+            ", ".join("{0}={1}".format(name, threads) for (name, threads) in sorted(video.items())) or "-"))
+        return plan
+
+
+#
+# How hard a CPU limit cuts back: (limit in percent up to, encoder profile,
+# maximum framerate). Above the last entry only threads and priorities change.
+#
+CPU_LIMIT_LEVELS = ((25, "low-cpu", 10),
+                    (50, "low-cpu", 15),
+                    (75, "balanced", 25))
+
+#
+# Profiles from the cheapest up. A limit never swaps in a profile that is
+# more expensive than the one that was picked.
+#
+CPU_LIMIT_PROFILES = ("low-cpu", "balanced")
+
+#
+# Encoder threads run this much nicer than the rest of Kazam when there
+# is a limit, so that the desktop and the capture win over them.
+#
+CPU_LIMIT_NICE = 10
+
+
+class CpuLimit(object):
+    """Keeps a recording within a share of the CPUs we may use.
+
+    Percent is of all the CPUs available to us, 0 means no limit. The
+    limit decides the number of CPUs the thread budget splits, a maximum
+    framerate, a cheaper encoder profile and the priority of encoder threads.
+    """
+    def __init__(self, percent, cpus=None):
+        self.cpus = cpus or get_available_cpus()
+        self.percent = max(0, min(int(percent), 100))
+        self.level = None
+        if self.enabled():
+            for level in CPU_LIMIT_LEVELS:
+                if self.percent <= level[0]:
+                    self.level = level
+                    break
+
+    def enabled(self):
+        return 0 < self.percent < 100
+
+    def get_cpus(self):
+        if not self.enabled():
+            return self.cpus
+        return max(1, self.cpus * self.percent // 100)
+
+    def get_framerate(self, framerate):
+        if self.level and framerate > self.level[2]:
+            return self.level[2]
+        return framerate
+
+    def get_profile(self, profile):
+        if self.level is None:
+            return profile
+        cheaper = self.level[1]
+        if profile in CPU_LIMIT_PROFILES and \
+                CPU_LIMIT_PROFILES.index(profile) <= CPU_LIMIT_PROFILES.index(cheaper):
+            return profile
+        return cheaper
+
+    def get_encoder_priority(self):
+        """Returns (nice, scheduling policy) for encoder threads."""
+        if not self.enabled():
+            return None
+        return (CPU_LIMIT_NICE, getattr(os, "SCHED_BATCH", None))
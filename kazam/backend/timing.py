@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+#       timing.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import json
+import shutil
+
+#
+# Histograms and sidecar files for frame timing, no GStreamer or GTK in here.
+#
+
+# Width of the histogram bar for the most populated bin in debug logs
+HISTOGRAM_BAR = 40
+
+# Timing of a recording is kept next to it, in a file with this suffix
+SIDECAR_SUFFIX = ".timing.json"
+
+
+class Histogram(object):
+    """Counts values into bins of a fixed width.
+
+    Bins start at low, values below the first bin or above the last one
+    are counted in those. Minimum, maximum and mean are exact, percentiles
+    are the upper edge of the bin they fall into.
+    """
+    def __init__(self, width, bins, low=0.0):
+        self.width = float(width)
+        self.low = float(low)
+        self.counts = [0] * bins
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = int((value - self.low) // self.width)
+        index = max(0, min(index, len(self.counts) - 1))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def get_mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def get_percentile(self, percent):
+        if not self.count:
+            return None
+        needed = self.count * percent / 100.0
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= needed:
+                return min(self.low + (index + 1) * self.width, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"low": self.low,
+                "width": self.width,
+                "counts": list(self.counts),
+                "count": self.count,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.get_mean(),
+                "p50": self.get_percentile(50),
+                "p95": self.get_percentile(95),
+                "p99": self.get_percentile(99)}
+
+    def get_summary(self, unit="ms"):
+        if not self.count:
+            return "no samples"
+        return "{0} samples, mean {1:.2f} {6}, p50 {2:.2f}, p95 {3:.2f}, p99 {4:.2f}, max {5:.2f} {6}".format(
+            self.count, self.get_mean(), self.get_percentile(50), self.get_percentile(95),
+            self.get_percentile(99), self.max, unit)
+
+    def get_lines(self, unit="ms"):
+        """Returns the non-empty bins as text, one line per bin."""
+        top = max(self.counts) or 1
+        last = len(self.counts) - 1
+        lines = []
+        for (index, count) in enumerate(self.counts):
+            if not count:
+                continue
+            start = self.low + index * self.width
+            if index == last:
+                label = "{0:8.2f} +       ".format(start)
+            else:
+                label = "{0:8.2f} - {1:<6.2f}".format(start, start + self.width)
+            lines.append("{0} {1}: {2:7d} {3}".format(label, unit, count,
+                                                      "#" * max(1, count * HISTOGRAM_BAR // top)))
+        return lines
+
+
+def get_sidecar(path):
+    return "{0}{1}".format(path, SIDECAR_SUFFIX)
+
+
+def write_sidecar(path, report):
+    with open(get_sidecar(path), "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def move_sidecar(src, dest):
+    """Moves the sidecar of a recording along with it, if there is one."""
+    if os.path.exists(get_sidecar(src)):
+        shutil.move(get_sidecar(src), get_sidecar(dest))
+
+
+def remove_sidecar(path):
+    try:
+        os.remove(get_sidecar(path))
+    except OSError:
+        pass
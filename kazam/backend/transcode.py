@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+#       transcode.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import logging
+import tempfile
+logger = logging.getLogger("Transcode")
+
+from gi.repository import GObject, GLib, Gst
+
+from kazam.backend.prefs import *
+from kazam.backend.encoders import get_encoder_props, validate_props
+from kazam.backend.threads import get_available_cpus
+
+# Progress poll interval in milliseconds
+TRANSCODE_INTERVAL = 500
+
+#
+# Intermediate codecs, cheap enough to keep up with anything we can capture.
+#
+INTERMEDIATE_CODECS = (CODEC_RAW, CODEC_HUFF)
+
+#
+# Video encoder, audio encoder and muxer for each target codec.
+#
+TRANSCODE_FORMATS = {
+    CODEC_VP8: ("vp8enc",
+                ("vorbisenc", {"quality": 1}),
+                "webmmux"),
+    CODEC_H264: ("x264enc",
+                 ("lamemp3enc", {"quality": 0}),
+                 "mp4mux"),
+}
+
+#
+# Video encoders start from the encoder profile. There is no deadline once
+# the capture is over, so they get slower presets than while recording.
+#
+TRANSCODE_OVERRIDES = {
+    "vp8enc": {"cpu-used": 0,
+               "deadline": 0},
+    "x264enc": {"speed-preset": "faster"},
+}
+
+
+def get_transcode_props(factory):
+    """Returns video encoder properties for transcoding."""
+    props = get_encoder_props(factory)
+    props.update(validate_props(factory, TRANSCODE_OVERRIDES.get(factory, {})))
+    return props
+
+
+def get_capture_codec(codec):
+    """Returns the codec to record with, in two-stage mode that is the
+    intermediate one whenever the chosen codec can be transcoded to."""
+    if prefs.two_stage and codec in TRANSCODE_FORMATS and prefs.two_stage_codec in INTERMEDIATE_CODECS:
+        return prefs.two_stage_codec
+    return codec
+
+
+class Transcoder(GObject.GObject):
+    """Re-encodes a finished recording into the target codec.
+
+    Runs in its own pipeline next to whatever else is going on, progress
+    is reported as a fraction with transcode-progress. For chunked
+    transcoding only some of the streams and a part of the recording can
+    be encoded, into a different container.
+    """
+    __gsignals__ = {"transcode-progress": (GObject.SIGNAL_RUN_LAST,
+                                           None,
+                                           [GObject.TYPE_FLOAT],),
+                    "transcode-done": (GObject.SIGNAL_RUN_LAST,
+                                       None,
+                                       [GObject.TYPE_BOOLEAN],),
+                    }
+
+    def __init__(self, source, codec, threads=None, streams=("video", "audio"), muxer=None, output=None):
+        GObject.GObject.__init__(self)
+        self.source = source
+        self.codec = codec
+        self.streams = streams
+        self.muxer = muxer or TRANSCODE_FORMATS[codec][2]
+        if output is None:
+            (fd, output) = tempfile.mkstemp(prefix="kazam_", dir=os.path.dirname(source), suffix=".movie")
+            os.close(fd)
+        self.output = output
+        self.muxer_tempfile = "{0}.mux".format(self.output)
+        self.threads = threads or get_available_cpus()
+        self.pipeline = None
+        self.timer = None
+        self.segment = None
+        self.blocked = []
+
+    def start(self, start=None, stop=None):
+        logger.debug("Transcoding {0} to {1}".format(self.source, CODEC_LIST[self.codec][2]))
+        muxer = self.muxer
+
+        self.pipeline = Gst.Pipeline()
+        filesrc = Gst.ElementFactory.make("filesrc", "transcode_src")
+        filesrc.set_property("location", self.source)
+        decoder = Gst.ElementFactory.make("decodebin", "transcode_decoder")
+        self.mux = Gst.ElementFactory.make(muxer, "transcode_mux")
+        if muxer == "mp4mux":
+            self.mux.set_property("faststart", True)
+            self.mux.set_property("faststart-file", self.muxer_tempfile)
+        sink = Gst.ElementFactory.make("filesink", "transcode_sink")
+        sink.set_property("location", self.output)
+
+        for element in (filesrc, decoder, self.mux, sink):
+            self.pipeline.add(element)
+        filesrc.link(decoder)
+        self.mux.link(sink)
+        decoder.connect("pad-added", self.cb_pad_added)
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        self.bus_watch = bus.connect("message", self.on_message)
+
+        self.timer = GLib.timeout_add(TRANSCODE_INTERVAL, self.cb_poll)
+        if start is not None:
+            #
+            # Nothing may reach the muxer before the seek, it would write
+            # out a header and frames from the start of the recording.
+            # Decoder pads are blocked as they appear, once decodebin has
+            # added all of them the chunk is sought to and they are let go.
+            # Chunks start on keyframes, so the accurate seek doesn't have
+            # to decode anything twice.
+            #
+            logger.debug("Chunk {0:.2f} - {1:.2f} s".format(float(start) / Gst.SECOND,
+                                                            float(stop) / Gst.SECOND))
+            self.segment = (start, stop)
+            decoder.connect("no-more-pads", self.cb_no_more_pads)
+            self.pipeline.set_state(Gst.State.PAUSED)
+        else:
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def cb_block_probe(self, pad, info, data):
+        return Gst.PadProbeReturn.OK
+
+    def cb_no_more_pads(self, decoder):
+        GLib.idle_add(self.seek_chunk)
+
+    def seek_chunk(self):
+        if self.pipeline is None:
+            return False
+        (start, stop) = self.segment
+        seek = Gst.Event.new_seek(1.0, Gst.Format.TIME,
+                                  Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                                  Gst.SeekType.SET, start,
+                                  Gst.SeekType.SET, stop)
+        #
+        # Muxers don't pass seeks on, this one goes straight upstream
+        # from a decoder pad to the demuxer.
+        #
+        if not self.blocked or not self.blocked[0][0].send_event(seek):
+            logger.warning("Unable to seek to the chunk in {0}".format(self.source))
+            self.finish(False)
+            return False
+        for (pad, probe) in self.blocked:
+            pad.remove_probe(probe)
+        self.blocked = []
+        self.pipeline.set_state(Gst.State.PLAYING)
+        return False
+
+    def make_branch(self, kind):
+        (video, audio, muxer) = TRANSCODE_FORMATS[self.codec]
+        if kind == "video":
+            factory = video
+            props = dict(get_transcode_props(factory), threads=self.threads if factory == "vp8enc" else min(self.threads, 4))
+            factories = [("queue", {}), ("videoconvert", {}), (factory, props), ("queue", {})]
+        else:
+            (factory, props) = audio
+            factories = [("queue", {}), ("audioconvert", {}), ("audioresample", {}), (factory, props), ("queue", {})]
+
+        branch = []
+        for (factory, props) in factories:
+            element = Gst.ElementFactory.make(factory, None)
+            for (prop, value) in props.items():
+                element.set_property(prop, value)
+            self.pipeline.add(element)
+            branch.append(element)
+        for (src, dst) in zip(branch, branch[1:]):
+            src.link(dst)
+        return branch
+
+    def cb_pad_added(self, decoder, pad):
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        kind = caps.get_structure(0).get_name().split("/")[0]
+        if kind not in self.streams:
+            logger.debug("Skipping {0} stream.".format(kind))
+            fakesink = Gst.ElementFactory.make("fakesink", None)
+            fakesink.set_property("sync", False)
+            self.pipeline.add(fakesink)
+            fakesink.sync_state_with_parent()
+            pad.link(fakesink.get_static_pad("sink"))
+            return
+
+        if self.segment is not None:
+            probe = pad.add_probe(Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER, self.cb_block_probe, None)
+            self.blocked.append((pad, probe))
+
+        branch = self.make_branch(kind)
+        branch[-1].link(self.mux)
+        for element in branch:
+            element.sync_state_with_parent()
+        pad.link(branch[0].get_static_pad("sink"))
+
+    def cb_poll(self):
+        (pos_ok, position) = self.pipeline.query_position(Gst.Format.TIME)
+        (dur_ok, duration) = self.pipeline.query_duration(Gst.Format.TIME)
+        if self.segment is not None:
+            position -= self.segment[0]
+            duration = self.segment[1] - self.segment[0]
+        if pos_ok and dur_ok and duration > 0:
+            self.emit("transcode-progress", min(float(position) / duration, 1.0))
+        return True
+
+    def finish(self, success):
+        GLib.source_remove(self.timer)
+        self.timer = None
+        bus = self.pipeline.get_bus()
+        bus.disconnect(self.bus_watch)
+        bus.remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline = None
+        if not success:
+            for fname in (self.output, self.muxer_tempfile):
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+        self.emit("transcode-done", success)
+
+    def on_message(self, bus, message):
+        t = message.type
+        if t == Gst.MessageType.EOS:
+            logger.debug("Transcode finished: {0}".format(self.output))
+            self.finish(True)
+        elif t == Gst.MessageType.ERROR:
+            logger.warning("Transcode failed: {0}".format(message.parse_error()[1]))
+            self.finish(False)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+#       vfr.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger("VFR")
+
+from gi.repository import Gst
+
+from kazam.backend.prefs import *
+from kazam.backend.sampling import FrameSampler
+
+#
+# Codecs whose containers can carry variable framerate video. AVI can't.
+#
+VFR_CODECS = (CODEC_VP8, CODEC_H264)
+
+#
+# Every eighth row, hashed whole, catches any change taller than a line of
+# small text. Anything smaller shows up when a frame is let through anyway,
+# at least once per second. That's around an eighth of the frame, the cost
+# per frame is logged at the end.
+#
+VFR_ROW_STEP = 8
+VFR_TILES = 1
+VFR_MAX_GAP = Gst.SECOND
+
+
+def vfr_enabled(codec):
+    return codec in VFR_CODECS and codec in prefs.vfr_codecs
+
+
+class StaticFrameFilter(object):
+    """Drops frames identical to the previous one before they hit the encoder.
+
+    The muxers write whatever timestamps they get, so the result is a
+    variable framerate file that only holds frames where something happened.
+    """
+    def __init__(self, pad):
+        self.pad = pad
+        self.sampler = FrameSampler(row_step=VFR_ROW_STEP, tiles=VFR_TILES)
+        self.probe = None
+
+    def start(self):
+        self.sampler.reset()
+        self.frames = 0
+        self.dropped = 0
+        self.last_pts = None
+        self.probe = self.pad.add_probe(Gst.PadProbeType.BUFFER, self.cb_buffer_probe, None)
+
+    def stop(self):
+        if self.probe is not None:
+            self.pad.remove_probe(self.probe)
+            self.probe = None
+        logger.debug("Static frames dropped: {0} of {1} ({2:.0%}), sampling took {3:.2f} ms per frame.".format(
+            self.dropped, self.frames, float(self.dropped) / self.frames if self.frames else 0.0,
+            self.sampler.get_cost()))
+
+    def cb_buffer_probe(self, pad, info, data):
+        buf = info.get_buffer()
+        if self.sampler.height is None:
+            self.sampler.set_caps(pad.get_current_caps())
+
+        self.frames += 1
+        changed = self.sampler.sample(buf)
+        stale = self.last_pts is not None and buf.pts - self.last_pts >= VFR_MAX_GAP
+
+        if changed or stale:
+            self.last_pts = buf.pts
+            return Gst.PadProbeReturn.OK
+
+        self.dropped += 1
+        return Gst.PadProbeReturn.DROP
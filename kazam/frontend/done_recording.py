@@ -29,6 +29,7 @@ from gettext import gettext as _
 from gi.repository import Gtk, GObject
 
 from kazam.backend.prefs import *
+from kazam.backend.timing import move_sidecar
 from kazam.frontend.combobox import EditComboBox
 from kazam.frontend.save_dialog import SaveDialog
 
@@ -128,6 +129,7 @@ class DoneRecording(Gtk.Window):
                     uri += CODEC_LIST[self.codec][3]
 
                 shutil.move(self.tempfile, uri)
+                move_sidecar(self.tempfile, uri)
                 dialog.destroy()
                 self.emit("save-done", self.old_path)
                 self.destroy()
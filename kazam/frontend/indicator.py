@@ -48,6 +48,9 @@ class KazamSuperIndicator(GObject.GObject):
         "indicator-start-request" : (GObject.SIGNAL_RUN_LAST,
                                      None,
                                      (), ),
+        "indicator-replay-request" : (GObject.SIGNAL_RUN_LAST,
+                                      None,
+                                      (), ),
 
         "indicator-about-request" : (GObject.SIGNAL_RUN_LAST,
                                      None,
@@ -83,6 +86,12 @@ class KazamSuperIndicator(GObject.GObject):
         self.menuitem_finish.set_sensitive(False)
         self.menuitem_finish.connect("activate", self.on_menuitem_finish_activate)
 
+        self.menuitem_stats = Gtk.MenuItem("")
+        self.menuitem_stats.set_sensitive(False)
+
+        self.menuitem_progress = Gtk.MenuItem("")
+        self.menuitem_progress.set_sensitive(False)
+
         self.menuitem_separator2 = Gtk.SeparatorMenuItem()
 
         self.menuitem_quit = Gtk.MenuItem(_("Quit"))
@@ -93,10 +102,14 @@ class KazamSuperIndicator(GObject.GObject):
         self.menu.append(self.menuitem_start)
         self.menu.append(self.menuitem_pause)
         self.menu.append(self.menuitem_finish)
+        self.menu.append(self.menuitem_stats)
+        self.menu.append(self.menuitem_progress)
         self.menu.append(self.menuitem_separator2)
         self.menu.append(self.menuitem_quit)
 
         self.menu.show_all()
+        self.menuitem_stats.hide()
+        self.menuitem_progress.hide()
 
         #
         # Setup keybindings - Hardcore way
@@ -110,6 +123,7 @@ class KazamSuperIndicator(GObject.GObject):
             Keybinder.bind("<Super><Ctrl>P", self.cb_hotkeys, "pause-request")
             Keybinder.bind("<Super><Ctrl>W", self.cb_hotkeys, "show-request")
             Keybinder.bind("<Super><Ctrl>Q", self.cb_hotkeys, "quit-request")
+            Keybinder.bind("<Super><Ctrl>D", self.cb_hotkeys, "replay-request")
             self.recording = False
         except ImportError:
             logger.info("Unable to import Keybinder, hotkeys not available.")
@@ -129,6 +143,26 @@ class KazamSuperIndicator(GObject.GObject):
             self.emit("indicator-show-request")
         elif action == "quit-request" and not self.recording:
             self.emit("indicator-quit-request")
+        elif action == "replay-request" and self.recording:
+            self.emit("indicator-replay-request")
+
+    def set_stats(self, stats):
+        dropped = sum(entry["dropped"] for entry in stats["qos"].values())
+        duplicated = 0
+        if stats["videorate"]:
+            dropped += stats["videorate"]["drop"]
+            duplicated = stats["videorate"]["duplicate"]
+        self.menuitem_stats.set_label(_("{0:.1f} fps, dropped {1}, duplicated {2}").format(
+            stats["encoder"]["fps"], dropped, duplicated))
+        if self.recording:
+            self.menuitem_stats.show()
+
+    def set_progress(self, jobs, progress):
+        if not jobs:
+            self.menuitem_progress.hide()
+        else:
+            self.menuitem_progress.set_label(_("Processing {0} job(s): {1:.0%}").format(jobs, progress))
+            self.menuitem_progress.show()
 
     def on_menuitem_pause_activate(self, menuitem):
         if self.menuitem_pause.get_active():
@@ -146,6 +180,7 @@ class KazamSuperIndicator(GObject.GObject):
 
     def on_menuitem_finish_activate(self, menuitem):
         self.recording = False
+        self.menuitem_stats.hide()
         self.menuitem_start.set_sensitive(True)
         self.menuitem_pause.set_sensitive(False)
         self.menuitem_pause.set_active(False)
@@ -24,10 +24,15 @@ import math
 import logging
 logger = logging.getLogger("Preferences")
 
+from gettext import gettext as _
+
 from gi.repository import Gtk, Gdk, GObject, Pango
 
 from kazam.utils import *
 from kazam.backend.prefs import *
+from kazam.backend.vfr import VFR_CODECS
+from kazam.backend.encoders import get_profile_names
+from kazam.backend.calibrate import Calibration
 
 class Preferences(GObject.GObject):
     __gsignals__ = {
@@ -47,6 +52,7 @@ class Preferences(GObject.GObject):
 
         self.audio_source_info = None
         self.audio2_source_info = None
+        self.calibration = None
 
         self.builder = Gtk.Builder()
         self.builder.add_from_file(os.path.join(prefs.datadir, "ui", "preferences.ui"))
@@ -79,6 +85,7 @@ class Preferences(GObject.GObject):
         if prefs.sound:
             self.populate_audio_sources()
         self.populate_shutter_sounds()
+        self.populate_encoder_profiles()
 
         self.restore_UI()
 
@@ -134,6 +141,11 @@ class Preferences(GObject.GObject):
         for s_file in prefs.sound_files:
             self.combobox_shutter_type.append(None, s_file[:-4])
 
+    def populate_encoder_profiles(self):
+        self.encoder_profiles = get_profile_names()
+        for name in self.encoder_profiles:
+            self.combobox_encoder_profile.append(None, name)
+
     def restore_UI(self):
         logger.debug("Restoring UI.")
 
@@ -210,6 +222,23 @@ class Preferences(GObject.GObject):
         codec_iter = codec_model.get_iter(cnt)
         self.combobox_codec.set_active_iter(codec_iter)
         prefs.codec = codec_model.get_value(codec_iter, 0)
+        self.restore_static_frames()
+
+        if prefs.encoder_profile in self.encoder_profiles:
+            self.combobox_encoder_profile.set_active(self.encoder_profiles.index(prefs.encoder_profile))
+        else:
+            self.combobox_encoder_profile.set_active(0)
+
+    def restore_static_frames(self):
+        #
+        # Static frame dropping is remembered per codec, AVI can't do variable framerate.
+        #
+        if prefs.codec in VFR_CODECS:
+            self.switch_static_frames.set_sensitive(True)
+            self.switch_static_frames.set_active(prefs.codec in prefs.vfr_codecs)
+        else:
+            self.switch_static_frames.set_sensitive(False)
+            self.switch_static_frames.set_active(False)
 
     #
     # General callbacks
@@ -304,6 +333,38 @@ class Preferences(GObject.GObject):
         c_iter = model.get_iter(i)
         prefs.codec = model.get_value(c_iter, 0)
         logger.debug('Codec selected: {0} - {1}'.format(get_codec(prefs.codec)[2], prefs.codec))
+        self.restore_static_frames()
+
+    def cb_encoder_profile_changed(self, widget):
+        prefs.encoder_profile = widget.get_active_text()
+        logger.debug("Encoder profile: {0}".format(prefs.encoder_profile))
+
+    def cb_calibrate_clicked(self, widget):
+        screen = HW.screens[HW.get_current_screen(self.window)]
+        self.calibration = Calibration(screen["width"], screen["height"], prefs.framerate)
+        self.calibration.connect("calibration-progress", self.cb_calibration_progress)
+        self.calibration.connect("calibration-done", self.cb_calibration_done)
+        self.button_calibrate.set_sensitive(False)
+        self.button_calibrate.set_label(_("Calibrating ..."))
+        self.calibration.start(detect_codecs())
+
+    def cb_calibration_progress(self, calibration, progress):
+        self.button_calibrate.set_label(_("Calibrating {0:.0%}").format(progress))
+
+    def cb_calibration_done(self, calibration, success):
+        self.calibration = None
+        self.button_calibrate.set_label(_("Calibrate"))
+        self.button_calibrate.set_sensitive(True)
+        self.restore_UI()
+
+    def cb_switch_static_frames(self, widget, user_data):
+        if prefs.codec not in VFR_CODECS:
+            return
+        if widget.get_active() and prefs.codec not in prefs.vfr_codecs:
+            prefs.vfr_codecs.append(prefs.codec)
+        elif not widget.get_active() and prefs.codec in prefs.vfr_codecs:
+            prefs.vfr_codecs.remove(prefs.codec)
+        logger.debug("Drop static frames for {0}: {1}.".format(get_codec(prefs.codec)[2], widget.get_active()))
 
     def cb_switch_autosave_video(self, widget, user_data):
         prefs.autosave_video = widget.get_active()
@@ -107,10 +107,10 @@ class InstantApp(GObject.GObject):
             self.area_window.starty,
             self.area_window.endx,
             self.area_window.endy))
-        prefs.area = (self.area_window.startx,
-                      self.area_window.starty,
-                      self.area_window.endx,
-                      self.area_window.endy,
+        prefs.area = (self.area_window.g_startx,
+                      self.area_window.g_starty,
+                      self.area_window.g_endx,
+                      self.area_window.g_endy,
                       self.area_window.width,
                       self.area_window.height)
         self.grabber.setup_sources(self.video_source, prefs.area, None)
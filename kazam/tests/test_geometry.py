@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+#       test_geometry.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+from unittest import TestCase, main
+
+from kazam.backend.geometry import get_region, get_scaled_size
+
+
+class ScaledSizeTest(TestCase):
+
+    def test_no_scale(self):
+        self.assertEqual(get_scaled_size(3840, 2160, ""), (3840, 2160))
+
+    def test_fixed_size(self):
+        self.assertEqual(get_scaled_size(3840, 2160, "1280x720"), (1280, 720))
+
+    def test_percent(self):
+        self.assertEqual(get_scaled_size(3840, 2160, "50%"), (1920, 1080))
+
+    def test_max_dimension(self):
+        self.assertEqual(get_scaled_size(7680, 2160, "1920"), (1920, 540))
+        self.assertEqual(get_scaled_size(1080, 1920, "960"), (540, 960))
+        self.assertEqual(get_scaled_size(1280, 720, "1920"), (1280, 720))
+
+    def test_align(self):
+        self.assertEqual(get_scaled_size(1001, 501, "", align=True), (1000, 500))
+        self.assertEqual(get_scaled_size(1366, 768, "33%", align=True), (450, 252))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, get_scaled_size, 1920, 1080, "half")
+        self.assertRaises(ValueError, get_scaled_size, 1920, 1080, "0%")
+
+
+class RegionTest(TestCase):
+
+    def test_region(self):
+        self.assertEqual(get_region(10, 20, 301, 201), (10, 20, 301, 201))
+        self.assertEqual(get_region(10, 20, 301, 201, align=True), (10, 20, 300, 200))
+
+    def test_bounds(self):
+        bounds = (1920, 0, 1280, 1024)
+        self.assertEqual(get_region(1800, -10, 500, 500, bounds), (1920, 0, 380, 490))
+        self.assertEqual(get_region(3000, 900, 500, 500, bounds), (3000, 900, 200, 124))
+        self.assertRaises(ValueError, get_region, 0, 0, 100, 100, bounds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+#       test_segments.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import glob
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from kazam.backend.timing import get_sidecar, write_sidecar
+from kazam.backend.segments import get_segment_pattern, get_segment_glob, get_segments, remove_segments
+
+
+class SegmentTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.dir, "kazam_1.movie")
+        self.segments = [get_segment_pattern(self.recording) % index for index in range(3)]
+        for path in [self.recording] + self.segments:
+            open(path, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_segments(self):
+        self.assertEqual(get_segments(self.recording), self.segments)
+        self.assertEqual(sorted(glob.glob(get_segment_glob(self.recording))), self.segments)
+
+    def test_timing_sidecar(self):
+        # Segmented recording with timing_sidecar on, the sidecar is
+        # written at EOS, before the segments are joined.
+        write_sidecar(self.recording, {"framerate": 15})
+        self.assertEqual(sorted(glob.glob(get_segment_glob(self.recording))), self.segments)
+
+        remove_segments(get_segment_glob(self.recording))
+        self.assertEqual(get_segments(self.recording), [])
+        self.assertTrue(os.path.exists(get_sidecar(self.recording)))
+        self.assertTrue(os.path.exists(self.recording))
+
+
+if __name__ == '__main__':
+    main()
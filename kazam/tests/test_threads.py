@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+#       test_threads.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+
+from kazam.backend import threads
+from kazam.backend.threads import ThreadBudget, get_cgroup_cpus, get_nice_floor, get_thread_nice
+
+
+class CgroupTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.slice = os.path.join(self.root, "user.slice", "user-1000.slice")
+        self.leaf = os.path.join(self.slice, "app.slice", "kazam.scope")
+        os.makedirs(self.leaf)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_max(self, directory, value):
+        with open(os.path.join(directory, "cpu.max"), "w") as f:
+            f.write(value)
+
+    def get_cpus(self):
+        with mock.patch.object(threads, "CGROUP_ROOT", self.root), \
+                mock.patch.object(threads, "get_cgroup_paths", return_value=(self.leaf, None)):
+            return get_cgroup_cpus()
+
+    def test_no_limit(self):
+        self.write_max(self.root, "max 100000")
+        self.assertEqual(self.get_cpus(), None)
+
+    def test_nested_limit(self):
+        self.write_max(self.leaf, "max 100000")
+        self.write_max(self.slice, "200000 100000")
+        self.assertEqual(self.get_cpus(), 2)
+
+    def test_tightest_limit(self):
+        self.write_max(self.leaf, "400000 100000")
+        self.write_max(self.slice, "300000 100000")
+        self.write_max(self.root, "50000 100000")
+        self.assertEqual(self.get_cpus(), 1)
+
+
+class ThreadBudgetTest(TestCase):
+
+    def test_plan(self):
+        plan = ThreadBudget(8).plan({"video_encoder": "x264enc"}, audio=True)
+        self.assertEqual(plan["video"], {"video_encoder": 4})
+        self.assertEqual(plan["convert"], 2)
+        self.assertNotIn("capture", plan)
+
+    def test_single_cpu(self):
+        plan = ThreadBudget(1).plan({"video_encoder": "vp8enc"}, audio=True)
+        self.assertEqual(plan["video"], {"video_encoder": 1})
+        self.assertEqual(plan["convert"], 1)
+
+
+class NiceTest(TestCase):
+
+    def test_floor(self):
+        with mock.patch("os.geteuid", return_value=1000), \
+                mock.patch("resource.getrlimit", return_value=(0, 0)):
+            self.assertEqual(get_nice_floor(), 20)
+        with mock.patch("os.geteuid", return_value=1000), \
+                mock.patch("resource.getrlimit", return_value=(25, 25)):
+            self.assertEqual(get_nice_floor(), -5)
+        with mock.patch("os.geteuid", return_value=0):
+            self.assertEqual(get_nice_floor(), -20)
+
+    def test_unprivileged(self):
+        # Encoders are made nicer, capture threads stay at base.
+        self.assertEqual(get_thread_nice(0, 5, 0, 20), 5)
+        self.assertEqual(get_thread_nice(0, -5, 0, 20), 0)
+        # A raised thread can always be brought back, a nicer one can't.
+        self.assertEqual(get_thread_nice(0, 0, -5, 20), 0)
+        self.assertEqual(get_thread_nice(0, 0, 5, 20), 5)
+
+    def test_privileged(self):
+        self.assertEqual(get_thread_nice(0, -5, 0, -20), -5)
+        self.assertEqual(get_thread_nice(0, 0, 5, -20), 0)
+        self.assertEqual(get_thread_nice(0, -5, 0, -3), -3)
+        self.assertEqual(get_thread_nice(15, 10, 15, 20), 19)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+#       test_timing.py
+#
+#       Copyright 2012 David Klasinc <bigwhale@lubica.net>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from kazam.backend.timing import Histogram, get_sidecar, write_sidecar, move_sidecar, remove_sidecar
+
+
+class HistogramTest(TestCase):
+
+    def test_empty(self):
+        h = Histogram(1, 10)
+        self.assertEqual(h.count, 0)
+        self.assertEqual(h.get_mean(), None)
+        self.assertEqual(h.get_percentile(50), None)
+        self.assertEqual(h.get_summary(), "no samples")
+
+    def test_bins(self):
+        h = Histogram(1, 10)
+        for value in (0.2, 0.7, 1.5, 3.0, 25.0):
+            h.add(value)
+        self.assertEqual(h.counts, [2, 1, 0, 1, 0, 0, 0, 0, 0, 1])
+        self.assertEqual((h.min, h.max), (0.2, 25.0))
+        self.assertAlmostEqual(h.get_mean(), 6.08)
+
+    def test_negative(self):
+        h = Histogram(10, 4, low=-20)
+        for value in (-50, -15, 5, 15, 99):
+            h.add(value)
+        self.assertEqual(h.counts, [2, 0, 1, 2])
+
+    def test_percentile(self):
+        h = Histogram(1, 100)
+        for value in range(100):
+            h.add(value + 0.5)
+        self.assertEqual(h.get_percentile(50), 50)
+        self.assertEqual(h.get_percentile(99), 99)
+        self.assertEqual(h.get_percentile(100), 99.5)
+
+    def test_lines(self):
+        h = Histogram(1, 3)
+        for value in (0.5, 0.5, 2.5, 7):
+            h.add(value)
+        lines = h.get_lines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("#" * 40))
+        self.assertIn("+", lines[1])
+
+
+class SidecarTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.dir, "kazam_1.movie")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        write_sidecar(self.recording, {"framerate": 15})
+        with open(get_sidecar(self.recording)) as f:
+            self.assertEqual(json.load(f), {"framerate": 15})
+
+    def test_move(self):
+        dest = os.path.join(self.dir, "screencast.mp4")
+        write_sidecar(self.recording, {})
+        move_sidecar(self.recording, dest)
+        self.assertFalse(os.path.exists(get_sidecar(self.recording)))
+        self.assertTrue(os.path.exists(get_sidecar(dest)))
+
+    def test_missing(self):
+        move_sidecar(self.recording, os.path.join(self.dir, "screencast.mp4"))
+        remove_sidecar(self.recording)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    main()